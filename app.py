@@ -1,4 +1,4 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, g
 import subprocess
 import threading
 import time
@@ -6,140 +6,2628 @@ import re
 import json
 import os
 import logging
+import logging.handlers
 import uuid
+import sqlite3
+import base64
+import hashlib
+import hmac
+import struct
+import gzip
+import zlib
+import selectors
+import mmap
+import fcntl
+import socket
+import signal
+import sys
+import heapq
+import asyncio
+import contextvars
+import random
+import shutil
+import bisect
+import collections
+import math
+import itertools
+import http.client
+import urllib.parse
+import weakref
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from werkzeug.serving import make_server
+
+try:
+    import brotli  # 選用：安裝後對支援 br 的瀏覽器回傳 brotli 壓縮
+except ImportError:
+    brotli = None
 from datetime import datetime
 
-app = Flask(__name__)
-gpu_info = {}
-processes = []
-disk_info = []
+app = Flask(__name__)
+gpu_info = {}
+processes = []
+disk_info = []
+
+# 數據文件路徑
+COMMANDS_FILE = "gpu_commands.json"
+COMMANDS_JOURNAL_FILE = "gpu_commands.journal"  # 指令佇列的追加式操作日誌
+COMMANDS_COMPACT_THRESHOLD = 500  # 日誌累積多少筆操作後壓縮成快照
+DEFAULT_COMMAND_OWNER = "default"  # 未指定擁有者的指令
+QUEUE_AGING_PER_HOUR = 1.0  # 每等待一小時增加的優先權，避免低優先權或重度使用者的任務永遠等不到
+FAIR_SHARE_HALF_LIFE = 6 * 3600  # 公平分配所看的 GPU 使用量半衰期（秒）
+FAIR_SHARE_PENALTY_PER_GPU = 1.0  # 近期平均或目前佔用的每張 GPU 相當於扣多少優先權
+DEPENDENCY_CONDITIONS = ('success', 'any')  # 依賴條件：上游成功結束 / 上游以任何方式結束
+BULK_MAX_COMMANDS = 10000  # 單次批次新增（含參數展開後）最多幾筆指令
+RUNTIME_HISTORY_LIMIT = 5000  # 預測執行時間時最多讀取幾筆成功的執行記錄
+RUNTIME_SAMPLES = 20  # 每種指令保留最近幾次的執行時間
+RUNTIME_PERCENTILE = 0.8  # 以最近執行時間的這個百分位作為預測值，寧可高估，插隊的任務才不會拖過保留時間
+BACKFILL_OVERRUN_GRACE = 60  # 已超過預測時間仍在執行的任務，視為再過多久結束（秒）
+SCHEDULER_BACKFILL = os.environ.get("SCHEDULER_BACKFILL", "easy")  # easy：為最前面放不下的多 GPU 任務保留 GPU；off：停用
+FAIR_SHARE_WEIGHTS = os.environ.get("FAIR_SHARE_WEIGHTS", "")  # "alice=2,bob=0.5"，權重越高可用的份額越大，預設 1
+
+# GPU 收集設定
+NVIDIA_SMI_BIN = os.environ.get("NVIDIA_SMI_BIN", "nvidia-smi")
+GPU_COLLECTOR_MODE = os.environ.get("GPU_COLLECTOR_MODE", "stream")  # stream: 常駐查詢程序；table: 每次執行 nvidia-smi 並解析表格
+GPU_POLL_INTERVAL_MS = 5000
+GPU_RESERVATION_GRACE = 60  # 任務啟動後等待其程序出現在 nvidia-smi 的最長時間（秒）
+SCHEDULER_FALLBACK_INTERVAL = 5  # 沒有任何喚醒事件時的備援排程間隔（秒）
+NVIDIA_SMI_GPU_FIELDS = ('timestamp', 'index', 'uuid', 'name', 'memory.used', 'memory.total', 'utilization.gpu')
+NVIDIA_SMI_APP_FIELDS = ('timestamp', 'gpu_uuid', 'pid', 'process_name', 'used_memory')
+COLLECTOR_PROBE_TIMEOUT = float(os.environ.get("COLLECTOR_PROBE_TIMEOUT", "10"))  # 單次探針的硬性逾時，超過即強制結束其子程序（秒）
+COLLECTOR_JITTER = 0.1  # 探針間隔隨機增減的比例，避免各探針（以及多台機器）總是同時觸發
+COLLECTOR_STALE_INTERVALS = 3  # 超過幾個取樣間隔（再加上逾時）沒有成功，資料即標記為 stale
+COLLECTOR_MAX_BACKOFF = float(os.environ.get("COLLECTOR_MAX_BACKOFF", "300"))  # 連續逾時時探針間隔加倍的上限（秒）
+GPU_TOPOLOGY_TIMEOUT = 10  # 執行 nvidia-smi topo -m 的逾時（秒）
+GPU_TOPOLOGY_RETRY_INTERVAL = 300  # 讀取拓撲失敗後多久再重試（秒），期間所有 GPU 視為相同距離
+GPU_TOPOLOGY_LINK_SCORES = {'PIX': 40, 'PXB': 30, 'PHB': 20, 'NODE': 10, 'SYS': 0, 'SOC': 0}  # NV# 為 100 + 連結數
+GPU_PLACEMENT_SEARCH_LIMIT = 5000  # "count:N" 的候選組合超過這麼多時改用貪婪法挑選
+LOG_FILE = "gpu_monitor.log"
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text；json 則記錄檔每行為一筆 JSON，/logs 篩選時不必解析文字
+LOG_MAX_BYTES = 10 * 1024 * 1024  # 記錄檔超過此大小即輪替
+LOG_BACKUP_COUNT = 5  # 保留 gpu_monitor.log.1 ~ .5
+EXECUTION_LOG_DIR = "task_executions"  # 任務執行記錄目錄
+EXECUTION_INDEX_FILE = "task_executions.db"  # 執行記錄的 SQLite 索引
+EXECUTION_INDEX_INTERVAL = 10  # 索引同步間隔（秒）
+LOG_ARCHIVE_DELAY = 600  # 執行結束多久後壓縮其記錄檔（秒）
+LOG_ARCHIVE_INTERVAL = 60  # 背景壓縮檢查間隔（秒）
+RETENTION_MAX_BYTES = int(os.environ.get("RETENTION_MAX_BYTES", "0"))  # task_executions 總容量上限（位元組），0 表示不限
+RETENTION_MAX_AGE_DAYS = float(os.environ.get("RETENTION_MAX_AGE_DAYS", "0"))  # 執行結束後保留天數，0 表示不限
+RETENTION_MAX_COUNT = int(os.environ.get("RETENTION_MAX_COUNT", "0"))  # 最多保留幾筆執行記錄，0 表示不限
+RETENTION_FAILED_EXTRA_DAYS = float(os.environ.get("RETENTION_FAILED_EXTRA_DAYS", "7"))  # 失敗的執行在所有規則中視為晚這麼多天結束
+RETENTION_INTERVAL = 300  # 背景清理間隔（秒）
+RETENTION_SIZE_BATCH = 200  # 每輪最多計算幾個目錄的大小
+RETENTION_DELETE_BATCH = 50  # 每輪最多刪除幾個目錄
+SSE_KEEPALIVE_INTERVAL = 15  # SSE 無變更時送出 keepalive 的間隔（秒）
+RESPONSE_COMPRESS_MIN_BYTES = 512  # 小於此大小的回應不壓縮
+GPU_HISTORY_TIERS = (  # (解析度, 桶大小秒數, 保留樣本數)
+    ('raw', 0, 720),     # 以 5 秒取樣約 1 小時
+    ('1m', 60, 1440),    # 24 小時
+    ('15m', 900, 2016)   # 21 天
+)
+GPU_HISTORY_DEFAULT_WINDOW = 3600  # 未指定 since 時回傳最近多少秒
+DISK_POLL_INTERVAL = 10  # 磁碟資訊發佈間隔（秒）
+DISK_MOUNT_REFRESH_INTERVAL = 30  # 每個掛載點重新 statvfs 的間隔（秒）
+DISK_STATVFS_TIMEOUT = 2  # 單次收集等待 statvfs 的最長時間（秒）
+DISK_MIN_SIZE_BYTES = 1024 ** 3  # 小於 1 GiB 的檔案系統不顯示
+DISK_PSEUDO_FILESYSTEMS = {
+    'tmpfs', 'devtmpfs', 'udev', 'devpts', 'sysfs', 'proc', 'cgroup', 'cgroup2', 'securityfs', 'pstore',
+    'bpf', 'debugfs', 'tracefs', 'configfs', 'fusectl', 'mqueue', 'hugetlbfs', 'autofs', 'binfmt_misc',
+    'rpc_pipefs', 'nsfs', 'squashfs', 'ramfs', 'efivarfs', 'selinuxfs', 'fuse.lxcfs', 'fuse.portal'
+}
+METRICS_PREFIX = "gpu_monitor_"  # /metrics 指標名稱前綴
+
+# 多節點設定：agent 為一般的單機模式；aggregator 不直接管理 GPU，而是聚合 CLUSTER_AGENTS 並派送任務
+CLUSTER_ROLE = os.environ.get("CLUSTER_ROLE", "agent")
+CLUSTER_AGENTS = os.environ.get("CLUSTER_AGENTS", "")  # "name=http://host:port,..."
+CLUSTER_POLL_INTERVAL = 2  # 向 agent 取得狀態的間隔（秒）
+CLUSTER_TIMEOUT = float(os.environ.get("CLUSTER_TIMEOUT", "3"))  # 單次請求逾時，超過即視為節點失聯（秒）
+AGENT_TOKEN = os.environ.get("AGENT_TOKEN", "")  # 設定後 /api/agent/launch 需帶相同的 X-Agent-Token
+
+# 服務模式：dev 為單一開發伺服器；production 由一個 collector 行程負責收集與排程，
+# 並啟動 WEB_WORKERS 個只讀 worker 行程共用對外連接埠；collector / worker 可分開啟動（例如 worker 交給 gunicorn）
+SERVE_MODE = os.environ.get("SERVE_MODE", "dev")
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", "4"))
+COLLECTOR_ADDRESS = os.environ.get("COLLECTOR_ADDRESS", "127.0.0.1:5001")  # collector 內部服務位址，worker 將寫入請求轉送到此
+# 只採信這些來源位址送來的 X-Remote-User 與 X-Forwarded-For（反向代理；預設本機，包含轉送請求的 worker）
+TRUSTED_PROXIES = {address.strip() for address in os.environ.get("TRUSTED_PROXIES", "127.0.0.1,::1").split(',')
+                   if address.strip()}
+COLLECTOR_LOCK_FILE = "gpu_monitor.lock"  # 確保同一目錄只有一個行程在收集與排程
+SNAPSHOT_FILE = os.environ.get("SNAPSHOT_FILE", "gpu_monitor.snapshot")  # collector 發佈狀態的共享記憶體映射檔
+SNAPSHOT_SLOT_SIZE = 1024 * 1024  # 快照槽的初始大小，不足時加倍
+SNAPSHOT_INTERVAL = 1  # 狀態沒有變更時重新發佈快照的最長間隔（秒）
+SNAPSHOT_POLL_INTERVAL = 0.2  # worker 檢查快照序號以推送 SSE 的間隔（秒）
+
+# 確保執行記錄目錄存在
+os.makedirs(EXECUTION_LOG_DIR, exist_ok=True)
+
+class JsonLogFormatter(logging.Formatter):
+    """每筆記錄輸出成一行 JSON（time、ts、level、message，有例外時加上 exc）"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# 設置日誌配置：記錄檔依大小輪替；production 的 worker 不輪替，只在 collector 換檔後重新開啟
+if SERVE_MODE == 'worker':
+    log_file_handler = logging.handlers.WatchedFileHandler(LOG_FILE, encoding='utf-8')
+else:
+    log_file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+if LOG_FORMAT == 'json':
+    log_file_handler.setFormatter(JsonLogFormatter())
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        log_file_handler,
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+class StateBroadcaster:
+    """將 GPU、磁碟與佇列狀態的變更推送給所有 SSE 訂閱者
+
+    每個主題只保存最新一份已序列化的 JSON，內容真的改變時才遞增版本並喚醒訂閱者，
+    所以無論有多少分頁，同一份狀態只序列化一次。內容較大的主題可以只標記為已改變，
+    等第一個訂閱者讀取時才序列化（JSON 字串暫存為 None）。
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._cond = threading.Condition()
+        self._topics = {}    # topic -> (version, JSON 字串或 None)
+        self._builders = {}  # topic -> 延遲序列化時產生 JSON 字串的函數
+
+    def publish(self, topic, payload):
+        """發佈主題的新狀態，內容與上一次相同時不會通知訂閱者"""
+        return self.publish_data(topic, json.dumps(payload, ensure_ascii=False, separators=(',', ':')))
+
+    def publish_data(self, topic, data):
+        """發佈已序列化的 JSON 字串"""
+        with self._cond:
+            current = self._topics.get(topic)
+            if current is not None and current[1] == data:
+                return False
+            self.version += 1
+            self._topics[topic] = (self.version, data)
+            self._cond.notify_all()
+        return True
+
+    def invalidate(self, topic, build):
+        """標記主題已改變但不立即序列化，build 在有人讀取時才呼叫並回傳 JSON 字串"""
+        with self._cond:
+            self.version += 1
+            self._topics[topic] = (self.version, None)
+            self._builders[topic] = build
+            self._cond.notify_all()
+
+    def _materialize(self, topic, version, data):
+        """在鎖外產生延遲序列化的內容，期間主題沒有再改變時保留結果給其他訂閱者"""
+        if data is not None:
+            return data
+        data = self._builders[topic]()
+        with self._cond:
+            if self._topics[topic][0] == version:
+                self._topics[topic] = (version, data)
+        return data
+
+    def changes_since(self, since, timeout=None):
+        """等待版本大於 since 的變更，回傳依版本排序的 [(topic, version, data)]"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version > since, timeout)
+            changes = [(topic, version, data) for topic, (version, data) in self._topics.items()
+                       if version > since]
+        changes.sort(key=lambda change: change[1])
+        return [(topic, version, self._materialize(topic, version, data)) for topic, version, data in changes]
+
+    def topics(self):
+        """各主題目前的 JSON 字串"""
+        with self._cond:
+            current = list(self._topics.items())
+        return {topic: self._materialize(topic, version, data) for topic, (version, data) in current}
+
+    def topic_version(self, topic):
+        """主題最後一次改變時的版本，尚未發佈過為 0"""
+        return self._topics.get(topic, (0, None))[0]
+
+
+broadcaster = StateBroadcaster()
+
+# ========== 回應快取 ==========
+
+def json_bytes(payload):
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class CachedBody:
+    """一份已序列化的 JSON 回應；ETag 取內容雜湊，壓縮結果在第一次需要時產生並保留"""
+
+    def __init__(self, token, body):
+        self.token = token
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self._encoded = {'identity': body}
+
+    def encoded(self, encoding):
+        data = self._encoded.get(encoding)
+        if data is None:
+            if encoding == 'br':
+                data = brotli.compress(self.body)
+            else:
+                data = gzip.compress(self.body, mtime=0)
+            self._encoded[encoding] = data
+        return data
+
+
+class ResponseCache:
+    """依狀態版本快取熱門端點的回應，狀態沒變的請求不必重新序列化或壓縮
+
+    token 為呼叫端提供的狀態版本，與快取中的不同時才呼叫 build 重新產生；
+    token 為 None 表示內容無法以版本判斷，每次都重新產生（仍可用 ETag 回 304）。
+    同時重建只會多做一次序列化，字典的讀寫本身不需要另外加鎖。
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def entry(self, key, token, build):
+        entry = self._entries.get(key)
+        if entry is None or token is None or entry.token != token:
+            entry = CachedBody(token, build())
+            self._entries[key] = entry
+        return entry
+
+
+response_cache = ResponseCache()
+
+def cached_json_response(entry):
+    """以快取內容回應：If-None-Match 相符時回 304，否則依 Accept-Encoding 選擇壓縮"""
+    if request.if_none_match.contains_weak(entry.etag):
+        response = app.response_class(status=304)
+    else:
+        encoding = 'identity'
+        if len(entry.body) >= RESPONSE_COMPRESS_MIN_BYTES:
+            if brotli is not None and request.accept_encodings['br']:
+                encoding = 'br'
+            elif request.accept_encodings['gzip']:
+                encoding = 'gzip'
+        response = app.response_class(entry.encoded(encoding), mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    # 同一份內容的各種壓縮共用 ETag，因此標為 weak
+    response.set_etag(entry.etag, weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# ========== 共享快照 ==========
+
+SNAPSHOT_HEADER = struct.Struct('<4sIQQ')  # magic, flags, 槽大小, 序號
+SNAPSHOT_MAGIC = b'GMSS'
+SNAPSHOT_REPLACED = 1  # 檔案已被更大的新檔取代，讀取端應重新開啟
+SNAPSHOT_LENGTH = struct.Struct('<Q')
+SNAPSHOT_SEQ_OFFSET = 16
+
+
+class SharedSnapshotWriter:
+    """collector 將各主題的 JSON 發佈到記憶體映射檔，供其他行程讀取
+
+    檔案為標頭加兩個槽，序號 n 的內容寫在第 n % 2 個槽，寫完才更新標頭的序號，
+    所以正在寫入的永遠不是最新序號所在的槽（seqlock）。內容超過槽大小時
+    以兩倍大小建立新檔並原子性地取代，再標記舊檔讓讀取端重新開啟。
+    """
+
+    def __init__(self, path, slot_size=SNAPSHOT_SLOT_SIZE):
+        self.path = path
+        self.seq = 0
+        self.slot_size = slot_size
+        self._mm = None
+        self._create(slot_size, 0, b'')
+
+    @staticmethod
+    def encode(topics):
+        """目錄 (主題 -> [偏移, 長度]) 的 JSON 加上依序串接的內容"""
+        directory = {}
+        offset = 0
+        for name, data in topics.items():
+            directory[name] = [offset, len(data)]
+            offset += len(data)
+        header = json.dumps(directory, separators=(',', ':')).encode('utf-8')
+        return struct.pack('<I', len(header)) + header + b''.join(topics.values())
+
+    def _create(self, slot_size, seq, payload):
+        """建立新的映射檔並寫入序號 seq 的內容，再以 os.replace 取代現有檔案"""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w+b') as f:
+            f.truncate(SNAPSHOT_HEADER.size + 2 * slot_size)
+            mm = mmap.mmap(f.fileno(), 0)
+        offset = SNAPSHOT_HEADER.size + (seq % 2) * slot_size
+        mm[offset:offset + SNAPSHOT_LENGTH.size] = SNAPSHOT_LENGTH.pack(len(payload))
+        mm[offset + SNAPSHOT_LENGTH.size:offset + SNAPSHOT_LENGTH.size + len(payload)] = payload
+        mm[:SNAPSHOT_HEADER.size] = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 0, slot_size, seq)
+        os.replace(tmp, self.path)
+
+        old = self._mm
+        self._mm = mm
+        self.slot_size = slot_size
+        self.seq = seq
+        if old is not None:
+            old[4:8] = struct.pack('<I', SNAPSHOT_REPLACED)
+            old.close()
+
+    def publish(self, topics):
+        """寫入 {主題: JSON 位元組}，回傳新的序號"""
+        payload = self.encode(topics)
+        seq = self.seq + 1
+        if SNAPSHOT_LENGTH.size + len(payload) > self.slot_size:
+            slot_size = self.slot_size
+            while SNAPSHOT_LENGTH.size + len(payload) > slot_size:
+                slot_size *= 2
+            self._create(slot_size, seq, payload)
+            logger.info(f"Shared snapshot grown to {slot_size} bytes per slot")
+            return seq
+
+        offset = SNAPSHOT_HEADER.size + (seq % 2) * self.slot_size
+        mm = self._mm
+        mm[offset:offset + SNAPSHOT_LENGTH.size] = SNAPSHOT_LENGTH.pack(len(payload))
+        mm[offset + SNAPSHOT_LENGTH.size:offset + SNAPSHOT_LENGTH.size + len(payload)] = payload
+        mm[SNAPSHOT_SEQ_OFFSET:SNAPSHOT_SEQ_OFFSET + 8] = struct.pack('<Q', seq)
+        self.seq = seq
+        return seq
+
+
+class SharedSnapshotReader:
+    """worker 端讀取 collector 發佈的快照
+
+    每次請求只比對標頭中的序號；序號改變時才把對應槽複製出來並切出各主題，
+    之後的請求直接回傳同一份位元組，不加鎖也不重新序列化。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mm = None
+        self._seq = None
+        self._topics = {}
+
+    def _open(self):
+        # 舊的映射可能仍有其他執行緒在讀，不主動關閉，交由參考計數回收
+        with open(self.path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._seq = None
+
+    def _read(self):
+        """讀取目前序號的內容；讀取途中被覆寫時回傳 None"""
+        mm = self._mm
+        magic, flags, slot_size, seq = SNAPSHOT_HEADER.unpack_from(mm, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{self.path} is not a snapshot file")
+        if flags & SNAPSHOT_REPLACED:
+            self._open()
+            return self._read()
+        if seq == self._seq:
+            return seq, self._topics
+
+        offset = SNAPSHOT_HEADER.size + (seq % 2) * slot_size
+        length, = SNAPSHOT_LENGTH.unpack_from(mm, offset)
+        if length > slot_size:
+            return None
+        payload = mm[offset + SNAPSHOT_LENGTH.size:offset + SNAPSHOT_LENGTH.size + length]
+        # 序號沒變才代表寫入端沒有在這段期間覆寫同一個槽
+        if struct.unpack_from('<Q', mm, SNAPSHOT_SEQ_OFFSET)[0] != seq:
+            return None
+
+        topics = {}
+        if payload:
+            header_length, = struct.unpack_from('<I', payload, 0)
+            directory = json.loads(payload[4:4 + header_length])
+            base = 4 + header_length
+            topics = {name: payload[base + start:base + start + size]
+                      for name, (start, size) in directory.items()}
+        return seq, topics
+
+    def refresh(self):
+        """回傳 (序號, {主題: JSON 位元組})；快照尚未建立時序號為 None"""
+        if self._mm is None:
+            try:
+                self._open()
+            except OSError:
+                return None, {}
+        for _ in range(10):
+            result = self._read()
+            if result is not None:
+                seq, topics = result
+                # 先更新內容再更新序號，同時讀取的其他執行緒不會拿到不一致的組合
+                self._topics = topics
+                self._seq = seq
+                return seq, topics
+        return self._seq, self._topics
+
+    def get(self, topic):
+        return self.refresh()[1].get(topic)
+
+# ========== 監控指標 ==========
+
+def format_metric_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labelnames, escaped)) + '}'
+
+
+class MetricCounter:
+    """只增不減的計數器；計數器都在低頻路徑上（啟動、失敗），直接在鎖內累加"""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._counts = {}  # 標籤值 -> 已遞增次數
+        self._lock = threading.Lock()
+        if not labelnames:
+            self._counts[()] = 0  # 沒有標籤的計數器從 0 開始輸出
+
+    def inc(self, *values):
+        with self._lock:
+            self._counts[values] = self._counts.get(values, 0) + 1
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            counts = list(self._counts.items())
+        for values, total in counts:
+            lines.append(f"{self.name}{format_metric_labels(self.labelnames, values)} {total}")
+        return lines
+
+
+class MetricHistogram:
+    """固定桶界線的直方圖，每個執行緒各自累加到自己的計數陣列，observe 不需要加鎖
+
+    抓取時才把各執行緒的陣列加總；已結束執行緒的陣列會併入 _retired，
+    所以每個請求一個執行緒的伺服器也不會讓陣列數量無限增加。
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._cells = {}    # 執行緒 -> {標籤值: [各桶計數 array, 總和]}
+        self._retired = {}  # 已結束執行緒累積的 {標籤值: [各桶計數 array, 總和]}
+        self._lock = threading.Lock()  # 只在執行緒第一次記錄與抓取時使用
+        if not labelnames:
+            self._retired[()] = self._new_child()
+
+    def _new_child(self):
+        return [array('Q', bytes(8 * (len(self.buckets) + 1))), 0.0]
+
+    def _cell(self):
+        cell = getattr(self._local, 'cell', None)
+        if cell is None:
+            cell = self._local.cell = {}
+            with self._lock:
+                self._retire_finished()
+                self._cells[threading.current_thread()] = cell
+        return cell
+
+    def _retire_finished(self):
+        """把已結束執行緒的計數併入 _retired（呼叫端須持有 _lock）"""
+        for thread, cell in list(self._cells.items()):
+            if thread.is_alive():
+                continue
+            del self._cells[thread]
+            self._merge(self._retired, cell)
+
+    def _merge(self, target, cell):
+        for values, (counts, total) in list(cell.items()):
+            merged = target.get(values)
+            if merged is None:
+                merged = target[values] = self._new_child()
+            for index, count in enumerate(counts):
+                merged[0][index] += count
+            merged[1] += total
+
+    def observe(self, value, *values):
+        cell = self._cell()
+        child = cell.get(values)
+        if child is None:
+            child = cell[values] = self._new_child()
+        child[0][bisect.bisect_left(self.buckets, value)] += 1
+        child[1] += value
+
+    def time(self, *values):
+        return MetricTimer(self, values)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        totals = {}
+        with self._lock:
+            self._retire_finished()
+            self._merge(totals, self._retired)
+            for cell in self._cells.values():
+                self._merge(totals, cell)
+        for values, (counts, total) in totals.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = format_metric_labels(self.labelnames + ('le',), values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_metric_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricTimer:
+    """with metric.time(): ... 量測區塊耗時"""
+
+    def __init__(self, histogram, values):
+        self.histogram = histogram
+        self.values = values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.values)
+        return False
+
+
+class MetricGauge:
+    """在抓取時才透過 callback 取值的量表，熱路徑上沒有任何成本
+
+    callback 回傳單一數值，或 [(標籤值 tuple, 數值), ...]。
+    """
+
+    def __init__(self, name, help_text, callback, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.labelnames = labelnames
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        value = self.callback()
+        samples = value if self.labelnames else [((), value)]
+        for values, sample in samples:
+            if sample is None:
+                continue
+            lines.append(f"{self.name}{format_metric_labels(self.labelnames, values)} {sample}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._metrics = []
+
+    def register(self, metric):
+        metric.name = self.prefix + metric.name
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(MetricCounter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=MetricHistogram.DEFAULT_BUCKETS):
+        return self.register(MetricHistogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name, help_text, callback, labelnames=()):
+        return self.register(MetricGauge(name, help_text, callback, labelnames))
+
+    def render(self):
+        """Prometheus 文字格式（0.0.4）"""
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.collect())
+            except Exception as e:
+                logger.error(f"Error collecting metric {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry(METRICS_PREFIX)
+nvidia_smi_collect_seconds = metrics.histogram(
+    'nvidia_smi_collect_seconds', 'Time to collect one nvidia-smi sample (table: command runtime, stream: batch assembly)', ('mode',))
+nvidia_smi_parse_seconds = metrics.histogram(
+    'nvidia_smi_parse_seconds', 'Time to parse nvidia-smi output (one table or one CSV row)', ('format',),
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+nvidia_smi_parse_errors = metrics.counter(
+    'nvidia_smi_parse_errors_total', 'nvidia-smi outputs or rows that failed to parse', ('format',))
+scheduler_tick_seconds = metrics.histogram(
+    'scheduler_tick_seconds', 'Duration of one scheduling pass over the queue')
+http_request_seconds = metrics.histogram(
+    'http_request_duration_seconds', 'Flask request latency until the response is returned', ('method', 'route'))
+task_launches = metrics.counter('task_launches_total', 'Tasks launched successfully')
+collector_failures = metrics.counter(
+    'collector_failures_total', 'Collector probes that failed or hit their timeout', ('collector', 'reason'))
+task_launch_failures = metrics.counter('task_launch_failures_total', 'Tasks that failed to launch')
+
+def command_sort_key(cmd):
+    """佇列排序鍵（越小越先）：優先權加上等待時間換算的老化分數，同分時先入列者優先
+
+    所有任務老化的速度相同，「priority + 等待小時數 × 速率」的大小關係
+    等同於「priority - 入列時間 × 速率」，所以排序鍵不隨時間改變，可以直接放進 heap。
+    手動調整過位置的指令以 sort_key 記錄自己的 [分數, 同分順序]，priority 保持不變。
+    """
+    if cmd.get('sort_key'):
+        score, tie = cmd['sort_key']
+        return (score, tie, cmd['uid'])
+    queued_at = cmd.get('queued_at', 0)
+    return (QUEUE_AGING_PER_HOUR * queued_at / 3600 - cmd.get('priority', 0), queued_at, cmd['uid'])
+
+def ensure_queue_fields(commands):
+    """補上舊資料缺少的 priority、owner、queued_at；依清單順序遞增 queued_at，保持原本的先後"""
+    previous = None
+    for cmd in commands:
+        cmd.setdefault('priority', 0)
+        cmd.setdefault('owner', DEFAULT_COMMAND_OWNER)
+        if 'queued_at' not in cmd:
+            try:
+                queued_at = datetime.fromisoformat(cmd.get('created_at')).timestamp()
+            except (TypeError, ValueError):
+                queued_at = time.time()
+            if previous is not None:
+                queued_at = max(queued_at, previous + 0.001)
+            cmd['queued_at'] = queued_at
+        previous = cmd['queued_at']
+    return commands
+
+
+class SortedKeyList:
+    """分塊的有序串列（順序統計結構）：新增、刪除只動到一個小區塊，依名次查詢只需走過區塊長度
+
+    每個區塊最多 2 × LOAD 個鍵，以各區塊的最大鍵二分搜尋所在區塊。
+    """
+
+    LOAD = 256
+
+    def __init__(self):
+        self._blocks = []  # 各區塊內依序排列的鍵
+        self._maxes = []   # 各區塊的最大鍵
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for block in self._blocks:
+            yield from block
+
+    def add(self, key):
+        self._len += 1
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            return
+        i = min(bisect.bisect_left(self._maxes, key), len(self._blocks) - 1)
+        block = self._blocks[i]
+        bisect.insort(block, key)
+        self._maxes[i] = block[-1]
+        if len(block) > 2 * self.LOAD:
+            self._blocks[i:i + 1] = [block[:self.LOAD], block[self.LOAD:]]
+            self._maxes[i:i + 1] = [block[self.LOAD - 1], block[-1]]
+
+    def remove(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        block = self._blocks[i]
+        del block[bisect.bisect_left(block, key)]
+        self._len -= 1
+        if block:
+            self._maxes[i] = block[-1]
+        else:
+            del self._blocks[i]
+            del self._maxes[i]
+
+    def index(self, key):
+        """鍵的名次（從 0 起算）"""
+        i = bisect.bisect_left(self._maxes, key)
+        return sum(len(block) for block in self._blocks[:i]) + bisect.bisect_left(self._blocks[i], key)
+
+    def __getitem__(self, index):
+        for block in self._blocks:
+            if index < len(block):
+                return block[index]
+            index -= len(block)
+        raise IndexError(index)
+
+
+class CommandStore:
+    """記憶體中的指令佇列，每個擁有者一個 heap，並透過追加式日誌持久化
+
+    排序由每筆指令的 command_sort_key 決定，新增、刪除、調整優先權或位置都只動到該筆指令
+    （heap 中的舊項目延遲清除），不需要重新編號。宣告 depends_on 的指令在上游結束前只記在
+    就緒索引（waiting_on 與反向的 dependents），不放進 heap，排程器只會看到已就緒的指令。
+    快照仍使用原本的 gpu_commands.json 格式；
+    每次變更只追加一行 JSON 到日誌，日誌過長時再以「寫入暫存檔 + os.replace」原子性地壓縮為新快照。
+    """
+
+    def __init__(self, snapshot_file, journal_file, compact_threshold=COMMANDS_COMPACT_THRESHOLD):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.compact_threshold = compact_threshold
+        self.version = 0  # 每次變更遞增，供其他模組判斷佇列是否改變
+        self._lock = threading.RLock()
+        self._by_uid = {}      # uid -> 指令資料
+        self._keys = {}        # uid -> 目前的排序鍵
+        self._heaps = {}       # 擁有者 -> [(排序鍵, uid)]，可能含已失效的項目
+        self._live = {}        # 擁有者 -> 有效的指令數
+        self._ordered = SortedKeyList()  # 所有指令的排序鍵，提供顯示順序與名次
+        self._waiting = {}     # uid -> 尚未結束的上游 uid（入度）
+        self._dependents = {}  # 上游 uid -> 等待它的指令 uid
+        self._cancelled = []   # 最近一次操作因上游失敗而取消的 (uid, 上游 uid)
+        self._journal = None
+        self._journal_entries = 0
+        self._listeners = []   # 佇列變更時呼叫的函數
+        self._load_failed = False
+        self._load()
+
+    # ---------- 載入與持久化 ----------
+
+    def _load(self):
+        commands = []
+        migrated = False
+        try:
+            if os.path.exists(self.snapshot_file):
+                with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                    commands = json.load(f)
+
+                # 數據遷移：將舊的 id 字段轉換為 uid
+                for cmd in commands:
+                    if 'id' in cmd and 'uid' not in cmd:
+                        cmd['uid'] = str(uuid.uuid4())
+                        del cmd['id']  # 移除舊的 id 字段
+                        migrated = True
+                        logger.info(f"Migrated command to UID: {cmd['uid']}")
+        except Exception as e:
+            logger.error(f"❌ Error loading commands: {e}")
+            commands = []
+            # 快照無法解析時先移到一旁保留，避免接下來的壓縮以只剩日誌的狀態覆蓋它
+            corrupt_file = f"{self.snapshot_file}.corrupt-{int(time.time())}"
+            try:
+                os.replace(self.snapshot_file, corrupt_file)
+                logger.error(f"Moved unreadable command snapshot to {corrupt_file}")
+            except OSError as move_error:
+                logger.error(f"Error setting aside unreadable command snapshot: {move_error}")
+                self._load_failed = True
+
+        for cmd in ensure_queue_fields(sorted(commands, key=lambda x: x.get('order', 0))):
+            if cmd.get('uid') and cmd['uid'] not in self._by_uid:
+                self._insert(cmd)
+
+        replayed = self._replay_journal()
+        self._cancelled = []
+
+        # 有遷移或日誌重播時，立即壓縮成新的快照（無法保留損壞的快照時不覆蓋它）
+        if (migrated or replayed) and not self._load_failed:
+            self.compact()
+            if migrated:
+                logger.info("Command data migration completed")
+
+    def _replay_journal(self):
+        """重播快照之後的日誌操作，回傳重播筆數"""
+        if not os.path.exists(self.journal_file):
+            return 0
+
+        replayed = 0
+        try:
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                for line_no, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 最後一行可能因當機而只寫了一半
+                        logger.warning(f"Skipping corrupt journal entry at line {line_no}")
+                        continue
+                    self._apply(entry)
+                    replayed += 1
+        except Exception as e:
+            logger.error(f"Error replaying command journal: {e}")
+
+        if replayed:
+            logger.info(f"Replayed {replayed} command journal entries")
+        return replayed
+
+    def _insert(self, cmd):
+        uid = cmd['uid']
+        owner = cmd['owner']
+        key = command_sort_key(cmd)
+        self._by_uid[uid] = cmd
+        self._keys[uid] = key
+        self._ordered.add(key)
+        heap = self._heaps.setdefault(owner, [])
+        self._live[owner] = self._live.get(owner, 0) + 1
+        waiting_on = cmd.get('waiting_on')
+        if waiting_on:
+            # 還有上游任務未結束：記入就緒索引，暫不放進 heap
+            self._waiting[uid] = set(waiting_on)
+            for upstream in waiting_on:
+                self._dependents.setdefault(upstream, set()).add(uid)
+        else:
+            heapq.heappush(heap, (key, uid))
+
+    def _remove(self, uid):
+        cmd = self._by_uid.pop(uid)
+        self._ordered.remove(self._keys.pop(uid))
+        for upstream in self._waiting.pop(uid, ()):
+            dependents = self._dependents.get(upstream)
+            if dependents is not None:
+                dependents.discard(uid)
+                if not dependents:
+                    del self._dependents[upstream]
+        owner = cmd['owner']
+        self._live[owner] -= 1
+        heap = self._heaps[owner]
+        if not self._live[owner]:
+            del self._live[owner]
+            del self._heaps[owner]
+        elif len(heap) > 2 * self._live[owner] + 16:
+            # 失效項目過多時重建，讓 heap 大小維持在有效指令數的常數倍
+            self._heaps[owner] = [(k, u) for k, u in heap if self._keys.get(u) == k]
+            heapq.heapify(self._heaps[owner])
+        return cmd
+
+    def _resolve(self, upstream, succeeded):
+        """上游結束：放行等待它的指令；要求成功但上游失敗（或被取消）時取消，並沿依賴鏈往下傳遞"""
+        pending = [(upstream, succeeded)]
+        while pending:
+            upstream, succeeded = pending.pop()
+            for uid in self._dependents.pop(upstream, ()):
+                cmd = self._by_uid[uid]
+                if not succeeded and cmd.get('depends_condition', 'success') == 'success':
+                    self._remove(uid)
+                    self._cancelled.append((uid, upstream))
+                    pending.append((uid, False))
+                    continue
+                self._waiting[uid].discard(upstream)
+                cmd['waiting_on'] = [u for u in cmd['waiting_on'] if u != upstream]
+                if not self._waiting[uid]:
+                    del self._waiting[uid]
+                    del cmd['waiting_on']
+                    heapq.heappush(self._heaps[cmd['owner']], (self._keys[uid], uid))
+
+    def _move_fields(self, uid, new_order):
+        """移到顯示順序第 new_order 位所需的欄位：只記錄該筆自己的 sort_key，落在前後兩筆的排序鍵之間
+
+        priority 與 queued_at 不變；只查詢前後兩筆的鍵，不需要重新排序整個佇列。
+        """
+        key = self._keys[uid]
+        self._ordered.remove(key)
+        try:
+            index = max(0, min(new_order - 1, len(self._ordered)))
+            before = self._ordered[index - 1] if index > 0 else None
+            after = self._ordered[index] if index < len(self._ordered) else None
+        finally:
+            self._ordered.add(key)
+        if after is None and before is None:
+            return {}
+        if after is None:
+            return {'sort_key': [before[0] + 1, before[1]]}
+        if before is None:
+            return {'sort_key': [after[0] - 1, after[1]]}
+        if before[0] != after[0]:
+            return {'sort_key': [(before[0] + after[0]) / 2, key[1]]}
+        # 前後同分時以同分順序區分
+        return {'sort_key': [after[0], (before[1] + after[1]) / 2]}
+
+    def _apply(self, entry):
+        """將一筆日誌操作套用到記憶體狀態"""
+        op = entry.get('op')
+        if op == 'add':
+            for cmd in ensure_queue_fields(entry.get('commands', [])):
+                if cmd.get('uid') and cmd['uid'] not in self._by_uid:
+                    self._insert(cmd)
+        elif op == 'delete':
+            uid = entry.get('uid')
+            if uid in self._by_uid:
+                self._remove(uid)
+                if entry.get('cancel'):
+                    # 被使用者取消的指令不會再執行，視同失敗
+                    self._resolve(uid, False)
+        elif op == 'finish':
+            self._resolve(entry.get('uid'), entry.get('succeeded', False))
+        elif op in ('update', 'move'):
+            uid = entry.get('uid')
+            if uid in self._by_uid:
+                # 舊版日誌的 move 以位置記錄，重播時換算成對應的欄位
+                fields = entry.get('fields', {}) if op == 'update' else self._move_fields(uid, entry.get('order', 1))
+                cmd = self._remove(uid)
+                if 'priority' in fields and 'sort_key' not in fields:
+                    # 重新設定優先權時取消先前手動調整的位置
+                    cmd.pop('sort_key', None)
+                cmd.update(fields)
+                self._insert(cmd)
+        elif op == 'replace':
+            self._by_uid = {}
+            self._keys = {}
+            self._heaps = {}
+            self._live = {}
+            self._ordered = SortedKeyList()
+            self._waiting = {}
+            self._dependents = {}
+            for cmd in ensure_queue_fields(entry.get('commands', [])):
+                if cmd.get('uid') and cmd['uid'] not in self._by_uid:
+                    self._insert(cmd)
+        else:
+            logger.warning(f"Unknown command journal op: {op}")
+            return
+        self.version += 1
+
+    def _append(self, entry):
+        """追加一筆操作到日誌並 fsync；寫入失敗時截回原本的長度，不留下半行記錄"""
+        if self._journal is None:
+            self._journal = open(self.journal_file, 'a', encoding='utf-8')
+        start = self._journal.tell()
+        try:
+            self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        except Exception:
+            journal, self._journal = self._journal, None
+            try:
+                journal.close()
+                os.truncate(self.journal_file, start)
+            except OSError as e:
+                logger.error(f"Error rolling back command journal: {e}")
+            raise
+        self._journal_entries += 1
+
+    def _commit(self, entry):
+        """先寫入並 fsync 日誌再套用到記憶體；日誌寫入失敗時記憶體狀態維持不變"""
+        with self._lock:
+            try:
+                self._append(entry)
+            except Exception as e:
+                logger.error(f"Error writing command journal: {e}")
+                return False
+            self._apply(entry)
+            if self._journal_entries >= self.compact_threshold:
+                self.compact()
+
+        for listener in self._listeners:
+            try:
+                listener(self, entry)
+            except Exception as e:
+                logger.error(f"Error notifying command queue listener: {e}")
+        return True
+
+    def add_listener(self, callback):
+        """註冊佇列變更時的回呼函數，參數為 store 本身與該筆日誌操作"""
+        self._listeners.append(callback)
+
+    def compact(self):
+        """將目前狀態寫成快照（原子性替換），並清空日誌"""
+        with self._lock:
+            try:
+                snapshot = self.list()
+                tmp_file = self.snapshot_file + ".tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(snapshot, f, ensure_ascii=False, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.snapshot_file)
+
+                # 快照已落盤，日誌可以安全截斷
+                if self._journal is not None:
+                    self._journal.close()
+                    self._journal = None
+                if os.path.exists(self.journal_file):
+                    os.remove(self.journal_file)
+                self._journal_entries = 0
+
+                logger.info(f"Commands compacted successfully. Total: {len(snapshot)}")
+                return True
+            except Exception as e:
+                logger.error(f"Error compacting commands: {e}")
+                return False
+
+    # ---------- 查詢 ----------
+
+    def _position(self, uid):
+        key = self._keys.get(uid)
+        return None if key is None else self._ordered.index(key)
+
+    def _with_order(self, uid, position):
+        cmd = dict(self._by_uid[uid])
+        cmd['order'] = position + 1
+        return cmd
+
+    def __len__(self):
+        return len(self._by_uid)
+
+    def __contains__(self, uid):
+        return uid in self._by_uid
+
+    def get(self, uid):
+        """以 uid 取得指令（含目前順序），不存在則回傳 None"""
+        with self._lock:
+            position = self._position(uid)
+            if position is None:
+                return None
+            return self._with_order(uid, position)
+
+    def list(self):
+        """依順序回傳所有指令的副本"""
+        with self._lock:
+            return [self._with_order(key[-1], i) for i, key in enumerate(self._ordered)]
+
+    def uids(self):
+        """依順序回傳所有 uid"""
+        with self._lock:
+            return [key[-1] for key in self._ordered]
+
+    def owner_queues(self):
+        """各擁有者 heap 的副本 {owner: [(排序鍵, uid)]}，其中可能有失效項目，取用前以 current() 確認"""
+        with self._lock:
+            return {owner: list(heap) for owner, heap in self._heaps.items()}
+
+    def awaited(self):
+        """仍有指令在等待的上游 uid"""
+        with self._lock:
+            return list(self._dependents)
+
+    def waiting_count(self):
+        """等待上游任務的指令數"""
+        return len(self._waiting)
+
+    def current(self, uid, key):
+        """heap 項目仍有效（指令存在且排序鍵未變）時回傳指令副本，否則回傳 None"""
+        with self._lock:
+            if self._keys.get(uid) != key:
+                return None
+            return dict(self._by_uid[uid])
+
+    # ---------- 變更 ----------
+
+    def add(self, command):
+        return self.add_many([command])
+
+    def add_many(self, commands):
+        """一次新增多筆指令（寫入同一筆日誌記錄）"""
+        stored = []
+        for cmd in commands:
+            cmd = {k: v for k, v in cmd.items() if k != 'order'}
+            stored.append(cmd)
+        return self._commit({'op': 'add', 'commands': ensure_queue_fields(stored)})
+
+    def delete(self, uid):
+        with self._lock:
+            if uid not in self._by_uid:
+                return False
+            return self._commit({'op': 'delete', 'uid': uid})
+
+    def cancel(self, uid):
+        """刪除指令並處理等待它的指令，回傳連帶取消的 [(uid, 上游 uid)]；指令不存在時回傳 None"""
+        with self._lock:
+            if uid not in self._by_uid:
+                return None
+            self._cancelled = []
+            self._commit({'op': 'delete', 'uid': uid, 'cancel': True})
+            cancelled, self._cancelled = self._cancelled, []
+            return cancelled
+
+    def finish(self, uid, succeeded):
+        """上游任務結束，回傳因此取消的 [(uid, 上游 uid)]；沒有指令在等待它時不寫日誌"""
+        with self._lock:
+            if uid not in self._dependents:
+                return []
+            self._cancelled = []
+            self._commit({'op': 'finish', 'uid': uid, 'succeeded': succeeded})
+            cancelled, self._cancelled = self._cancelled, []
+            return cancelled
+
+    def update(self, uid, fields):
+        """更新指令欄位（例如 priority），排序鍵隨之重新計算"""
+        with self._lock:
+            if uid not in self._by_uid:
+                return False
+            return self._commit({'op': 'update', 'uid': uid, 'fields': fields})
+
+    def move(self, uid, new_order):
+        """移到顯示順序的第 new_order 位（只調整該筆的 sort_key，其他指令與 priority 不變）"""
+        with self._lock:
+            if uid not in self._by_uid:
+                return False
+            return self.update(uid, self._move_fields(uid, new_order))
+
+    def replace(self, commands):
+        """以整份清單取代佇列內容"""
+        ordered = sorted(commands, key=lambda x: x.get('order', 0))
+        stored = [{k: v for k, v in cmd.items() if k != 'order'} for cmd in ordered]
+        return self._commit({'op': 'replace', 'commands': ensure_queue_fields(stored)})
+
+
+# worker 行程的佇列內容來自共享快照，不載入也不改寫日誌
+command_store = CommandStore(COMMANDS_FILE, COMMANDS_JOURNAL_FILE) if SERVE_MODE != 'worker' else None
+if command_store is not None:
+    # 變更時只標記主題，SSE 與共享快照讀取時才序列化，並沿用 GET /commands 依版本快取的內容
+    def publish_commands(store=None, entry=None):
+        broadcaster.invalidate('commands', lambda: commands_entry().body.decode('utf-8'))
+
+    command_store.add_listener(publish_commands)
+    publish_commands()
+
+def load_commands():
+    """從記憶體佇列讀取指令表格數據"""
+    return command_store.list()
+
+def save_commands(commands):
+    """以整份清單覆寫指令表格數據"""
+    if command_store.replace(commands):
+        logger.info(f"Commands saved successfully. Total: {len(commands)}")
+        return True
+    logger.error("Error saving commands")
+    return False
+
+def build_command(command_text, required_gpu, required_memory=None, max_util=None, priority=0, owner=None,
+                  depends_on=None, depends_condition='success', waiting_on=None, queued_at=None, created_at=None):
+    """組成一筆佇列指令（生成新的 UUID 作為唯一ID）
+
+    depends_on 為上游任務 uid，waiting_on 為其中尚未結束的部分，由呼叫端依上游目前的狀態算出。
+    """
+    command = {
+        'uid': str(uuid.uuid4()),
+        'command': command_text,
+        'required_gpu': required_gpu,
+        'created_at': created_at or datetime.now().isoformat(),
+        'priority': priority,
+        'owner': owner or DEFAULT_COMMAND_OWNER,
+        'queued_at': queued_at if queued_at is not None else time.time()
+    }
+    if required_memory is not None:
+        command['required_memory'] = required_memory
+    if max_util is not None:
+        command['max_util'] = max_util
+    if depends_on:
+        command['depends_on'] = depends_on
+        command['depends_condition'] = depends_condition
+        if waiting_on:
+            command['waiting_on'] = waiting_on
+    return command
+
+def add_command(command_text, required_gpu, required_memory=None, max_util=None, priority=0, owner=None,
+                depends_on=None, depends_condition='success', waiting_on=None):
+    """新增指令到表格
+
+    required_memory（MiB）與 max_util（%）為選填的資源需求，設定後可與其他任務共用 GPU。
+    priority 越大越先執行；owner 用於公平分配，未指定時歸入 DEFAULT_COMMAND_OWNER。
+    depends_on 中的上游任務結束（depends_condition 為 success 時須成功）後才會排程。
+    """
+    new_command = build_command(command_text, required_gpu, required_memory, max_util, priority, owner,
+                                depends_on, depends_condition, waiting_on)
+    new_uid = new_command['uid']
+    
+    if command_store.add(new_command):
+        logger.info(f"Command added: UID={new_uid}, GPU={required_gpu}")
+        return command_store.get(new_uid)
+    else:
+        logger.error(f"Failed to add command: UID={new_uid}")
+        return None
+
+def add_commands(entries):
+    """以單一筆日誌記錄一次新增多筆指令，全部成功或全部失敗
+
+    entries 為 validate_command_fields 的結果；同一批的 queued_at 依序遞增，保持送出的先後。
+    回傳新指令的 uid 清單，失敗時回傳 None。
+    """
+    now = time.time()
+    created_at = datetime.now().isoformat()
+    commands = [build_command(queued_at=now + i * 1e-6, created_at=created_at, **fields)
+                for i, fields in enumerate(entries)]
+    
+    if command_store.add_many(commands):
+        logger.info(f"Added {len(commands)} commands in one batch")
+        return [cmd['uid'] for cmd in commands]
+    else:
+        logger.error(f"Failed to add batch of {len(commands)} commands")
+        return None
+
+def cancel_command(command_uid):
+    """刪除佇列中的指令，等待它成功的指令一併取消；回傳連帶取消的 uid，指令不存在時回傳 None"""
+    cancelled = command_store.cancel(command_uid)
+    if cancelled is None:
+        logger.warning(f"Command with UID {command_uid} not found")
+        return None
+    logger.info(f"Command deleted: UID={command_uid}")
+    for uid, upstream in cancelled:
+        logger.warning(f"Cancelled task {uid}: upstream task {upstream} did not succeed")
+    return [uid for uid, _ in cancelled]
+
+def get_commands():
+    """讀取所有指令（按順序排列）"""
+    return command_store.list()
+
+def delete_command(command_uid):
+    """刪除指定UID的指令"""
+    logger.info(f"Attempting to delete command with UID: {command_uid}")
+    
+    if command_uid not in command_store:
+        logger.warning(f"Command with UID {command_uid} not found")
+        return False
+    
+    if command_store.delete(command_uid):
+        logger.info(f"Command deleted: UID={command_uid}")
+        return True
+    
+    logger.error(f"Failed to delete command: UID={command_uid}")
+    return False
+
+# ========== 執行記錄索引 ==========
+
+# 每一次執行的狀態由 output.log 結尾的 "Exit code:" 與 error.log 決定
+EXECUTION_STATUSES = ('queued', 'running', 'completed', 'failed')
+EXECUTION_SORT_COLUMNS = ('created_time', 'output_size', 'directory')
+
+
+def read_execution_metadata(dir_name):
+    """從執行目錄讀取索引所需的資訊（只讀 command.txt 與 output.log 結尾）"""
+    dir_path = os.path.join(EXECUTION_LOG_DIR, dir_name)
+    row = {
+        'directory': dir_name,
+        'task_uid': '',
+        'command': '',
+        'required_gpu': '',
+        'gpu_ids': '',
+        'created_time': 0,
+        'status': 'queued',
+        'exit_code': None,
+        'completed_time': None,
+        'output_size': 0,
+        'has_error_log': False,
+        'archived': False
+    }
+
+    try:
+        row['created_time'] = os.path.getctime(dir_path)
+    except OSError:
+        pass
+
+    # command.txt 為 "Key: Value" 格式，指令位於 "=== Command to Execute ===" 下一行
+    command_file_path = os.path.join(dir_path, 'command.txt')
+    try:
+        with open(command_file_path, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        for i, line in enumerate(lines):
+            if line.startswith('Task UID: '):
+                row['task_uid'] = line[len('Task UID: '):].strip()
+            elif line.startswith('Required GPU: '):
+                row['required_gpu'] = line[len('Required GPU: '):].strip()
+            elif line.startswith('Actual GPU IDs: '):
+                gpu_ids = re.findall(r"\d+", line[len('Actual GPU IDs: '):])
+                row['gpu_ids'] = ',' + ','.join(gpu_ids) + ',' if gpu_ids else ''
+            elif line.startswith('=== Command to Execute ===') and i + 1 < len(lines):
+                row['command'] = lines[i + 1].strip()
+    except OSError:
+        pass
+
+    row['has_error_log'] = log_exists(os.path.join(dir_path, 'error.log'))
+
+    output_file_path = os.path.join(dir_path, 'output.log')
+    # 只有壓縮檔確實存在才算已壓縮；兩者都不存在（例如剛建立的目錄）時不能視為已完成
+    row['archived'] = (not os.path.exists(output_file_path)
+                       and os.path.exists(output_file_path + LOG_ARCHIVE_SUFFIX))
+    try:
+        with open_log(output_file_path) as f:
+            row['output_size'] = f.size
+            f.seek(max(0, f.size - 500))
+            tail = f.read().decode('utf-8', errors='replace')
+            exit_match = re.search(r"Exit code: (\d+)", tail)
+            if 'Task completed at: ' in tail:
+                row['exit_code'] = int(exit_match.group(1)) if exit_match else None
+                row['completed_time'] = f.mtime
+    except (OSError, ValueError, zlib.error):
+        pass
+
+    # 腳本未寫出結尾（例如被訊號終止）時，以監管器記錄的結束資訊為準；結束碼未知（程序遺失）視為失敗
+    if row['completed_time'] is None:
+        try:
+            with open(os.path.join(dir_path, 'status.json'), 'r', encoding='utf-8') as f:
+                status_data = json.load(f)
+            if status_data.get('state') == 'exited':
+                row['exit_code'] = status_data.get('exit_code')
+                row['completed_time'] = datetime.fromisoformat(status_data['end_time']).timestamp()
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    # 與前端原本的判斷規則一致
+    if row['has_error_log']:
+        row['status'] = 'failed'
+    elif row['completed_time'] is not None:
+        row['status'] = 'completed' if row['exit_code'] == 0 else 'failed'
+    elif row['output_size'] > 0:
+        row['status'] = 'running'
+
+    return row
+
+
+class ExecutionIndex:
+    """task_executions 的 SQLite 索引，讓列表 API 不必每次掃描所有執行目錄"""
+
+    COLUMNS = ('directory', 'task_uid', 'command', 'required_gpu', 'gpu_ids', 'created_time',
+               'status', 'exit_code', 'completed_time', 'output_size', 'has_error_log', 'archived')
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS executions (
+                    directory TEXT PRIMARY KEY,
+                    task_uid TEXT,
+                    command TEXT,
+                    required_gpu TEXT,
+                    gpu_ids TEXT,
+                    created_time REAL,
+                    status TEXT,
+                    exit_code INTEGER,
+                    completed_time REAL,
+                    output_size INTEGER,
+                    has_error_log INTEGER,
+                    archived INTEGER DEFAULT 0,
+                    disk_bytes INTEGER
+                )
+            """)
+            # 舊版索引沒有 archived / disk_bytes 欄位
+            existing = {r['name'] for r in self._conn.execute("PRAGMA table_info(executions)")}
+            if 'archived' not in existing:
+                self._conn.execute("ALTER TABLE executions ADD COLUMN archived INTEGER DEFAULT 0")
+            if 'disk_bytes' not in existing:
+                self._conn.execute("ALTER TABLE executions ADD COLUMN disk_bytes INTEGER")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_executions_created ON executions (created_time, directory)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_executions_size ON executions (output_size, directory)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_executions_status ON executions (status)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_executions_task ON executions (task_uid, created_time)")
+        self._known = set(
+            r['directory'] for r in self._conn.execute("SELECT directory FROM executions")
+        )
+
+    def update(self, dir_name):
+        """重新讀取單一執行目錄並寫入索引（快取的目錄大小會一併失效）"""
+        row = read_execution_metadata(dir_name)
+        placeholders = ', '.join('?' for _ in self.COLUMNS)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO executions ({', '.join(self.COLUMNS)}) VALUES ({placeholders})",
+                [row[c] for c in self.COLUMNS]
+            )
+            self._known.add(dir_name)
+        return row
+
+    def reconcile(self):
+        """同步新出現/已刪除的目錄，並更新尚未結束的執行狀態"""
+        try:
+            on_disk = set(
+                entry.name for entry in os.scandir(EXECUTION_LOG_DIR) if entry.is_dir()
+            )
+        except OSError as e:
+            logger.error(f"Error scanning execution directory: {e}")
+            return
+
+        removed = self._known - on_disk
+        if removed:
+            self.remove(removed)
+
+        added = on_disk - self._known
+        for dir_name in added:
+            self.update(dir_name)
+
+        with self._lock:
+            pending = [r['directory'] for r in self._conn.execute(
+                "SELECT directory FROM executions WHERE status IN ('queued', 'running')"
+            )]
+        for dir_name in pending:
+            if dir_name not in added:
+                self.update(dir_name)
+
+        if added or removed:
+            logger.info(f"Execution index reconciled: +{len(added)} -{len(removed)}, {len(pending)} pending")
+
+    @staticmethod
+    def _encode_cursor(values):
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+
+    def query(self, limit=50, cursor=None, sort='created_time', order='desc',
+              status=None, gpu=None, command=None, date_from=None, date_to=None):
+        """依條件查詢一頁執行記錄，回傳 (rows, next_cursor, total)"""
+        if sort not in EXECUTION_SORT_COLUMNS:
+            raise ValueError(f"Unsupported sort column: {sort}")
+        descending = order != 'asc'
+
+        where = []
+        params = []
+        if status:
+            statuses = [s for s in status.split(',') if s in EXECUTION_STATUSES]
+            where.append(f"status IN ({', '.join('?' for _ in statuses)})")
+            params.extend(statuses)
+        if gpu not in (None, ''):
+            where.append("gpu_ids LIKE ?")
+            params.append(f"%,{int(gpu)},%")
+        if command:
+            escaped = command.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            where.append("command LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+        if date_from is not None:
+            where.append("created_time >= ?")
+            params.append(date_from)
+        if date_to is not None:
+            where.append("created_time < ?")
+            params.append(date_to)
+
+        filter_sql = f"WHERE {' AND '.join(where)}" if where else ""
+        page_where = list(where)
+        page_params = list(params)
+        if cursor:
+            # keyset 分頁：(排序欄位, directory) 作為唯一且穩定的位置
+            last_value, last_directory = self._decode_cursor(cursor)
+            page_where.append(f"({sort}, directory) {'<' if descending else '>'} (?, ?)")
+            page_params.extend([last_value, last_directory])
+        page_sql = f"WHERE {' AND '.join(page_where)}" if page_where else ""
+        direction = 'DESC' if descending else 'ASC'
+
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) FROM executions {filter_sql}", params).fetchone()[0]
+            rows = [dict(r) for r in self._conn.execute(
+                f"SELECT * FROM executions {page_sql} ORDER BY {sort} {direction}, directory {direction} LIMIT ?",
+                page_params + [limit + 1]
+            )]
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self._encode_cursor([rows[-1][sort], rows[-1]['directory']])
+
+        for row in rows:
+            row['has_error_log'] = bool(row['has_error_log'])
+            row['archived'] = bool(row['archived'])
+            row['gpu_ids'] = [int(g) for g in row['gpu_ids'].strip(',').split(',') if g]
+        return rows, next_cursor, total
+
+    def archive_candidates(self, finished_before, limit=100):
+        """已在 finished_before 之前結束、記錄尚未壓縮的執行目錄"""
+        with self._lock:
+            return [r['directory'] for r in self._conn.execute(
+                "SELECT directory FROM executions WHERE status IN ('completed', 'failed') AND NOT archived "
+                "AND COALESCE(completed_time, created_time) < ? ORDER BY created_time LIMIT ?",
+                (finished_before, limit)
+            )]
+
+    def task_status(self, task_uid):
+        """任務最近一次執行的 directory、status 與 exit_code（重新執行時取最新的一筆），找不到時回傳 None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT directory, status, exit_code FROM executions WHERE task_uid = ? "
+                "ORDER BY created_time DESC LIMIT 1",
+                (task_uid,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def runtime_samples(self, limit):
+        """最近成功結束的執行 [(directory, command, completed_time)]，新的在前"""
+        with self._lock:
+            return [tuple(r) for r in self._conn.execute(
+                "SELECT directory, command, completed_time FROM executions "
+                "WHERE status = 'completed' AND completed_time IS NOT NULL "
+                "ORDER BY completed_time DESC LIMIT ?",
+                (limit,)
+            )]
+
+    def unsized(self, limit):
+        """已結束但尚未計算目錄大小的執行"""
+        with self._lock:
+            return [r['directory'] for r in self._conn.execute(
+                "SELECT directory FROM executions WHERE completed_time IS NOT NULL AND disk_bytes IS NULL "
+                "ORDER BY created_time LIMIT ?", (limit,)
+            )]
+
+    def set_disk_bytes(self, sizes):
+        """寫入 {directory: 位元組} 的目錄大小快取"""
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE executions SET disk_bytes = ? WHERE directory = ?",
+                                   [(size, d) for d, size in sizes.items()])
+
+    def retention_rows(self):
+        """保留策略需要的欄位；尚未計算大小的以 output_size 估計"""
+        with self._lock:
+            return [dict(r) for r in self._conn.execute(
+                "SELECT directory, status, created_time, completed_time, "
+                "COALESCE(disk_bytes, output_size, 0) AS bytes, disk_bytes IS NOT NULL AS sized "
+                "FROM executions"
+            )]
+
+    def remove(self, dir_names):
+        """自索引移除已刪除的執行目錄"""
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM executions WHERE directory = ?",
+                                   [(d,) for d in dir_names])
+            self._known -= set(dir_names)
+
+    def stats(self):
+        """整體統計與可篩選的 GPU 清單"""
+        with self._lock:
+            total, finished, output_size = self._conn.execute("""
+                SELECT COUNT(*),
+                       COALESCE(SUM(status IN ('completed', 'failed')), 0),
+                       COALESCE(SUM(output_size), 0)
+                FROM executions
+            """).fetchone()
+            gpu_sets = [r[0] for r in self._conn.execute(
+                "SELECT DISTINCT gpu_ids FROM executions WHERE gpu_ids != ''"
+            )]
+        gpus = sorted(set(int(g) for s in gpu_sets for g in s.strip(',').split(',') if g))
+        return {
+            'total_executions': total,
+            'finished_executions': finished,
+            'total_output_size': output_size,
+            'gpus': gpus
+        }
+
+
+execution_index = ExecutionIndex(EXECUTION_INDEX_FILE)
+
+def reconcile_execution_index():
+    """背景同步執行記錄索引，並補上漏接的上游任務結束事件"""
+    logger.info("Starting execution index reconciler thread")
+    while True:
+        try:
+            execution_index.reconcile()
+        except Exception as e:
+            logger.error(f"Error reconciling execution index: {e}")
+        try:
+            reconcile_dependencies()
+        except Exception as e:
+            logger.error(f"Error reconciling task dependencies: {e}")
+        if cluster is not None:
+            try:
+                cluster.reconcile_running()
+            except Exception as e:
+                logger.error(f"Error reconciling remote tasks: {e}")
+        time.sleep(EXECUTION_INDEX_INTERVAL)
+
+# ========== 輸出記錄分段讀取 ==========
+
+LOG_INDEX_SUFFIX = ".lineidx"
+LOG_INDEX_STRIDE = 1000  # 每隔多少行記錄一次位元組偏移
+LOG_INDEX_HEADER = struct.Struct('<QQQ')  # stride, indexed_bytes, lines
+OUTPUT_CHUNK_LIMIT = 1024 * 1024  # 單次回傳的最大位元組數
+_log_index_locks = weakref.WeakValueDictionary()  # 記錄檔路徑 -> 該檔行索引的鎖
+_log_index_locks_guard = threading.Lock()
+
+
+def log_index_lock(log_path):
+    """取得單一記錄檔行索引的鎖，首次掃描大型記錄時不會擋住其他記錄檔的讀取"""
+    with _log_index_locks_guard:
+        lock = _log_index_locks.get(log_path)
+        if lock is None:
+            lock = _log_index_locks[log_path] = threading.Lock()
+        return lock
+
+
+class LogLineIndex:
+    """輸出記錄的稀疏行偏移索引，存放在記錄檔旁的 <log>.lineidx
+
+    每 LOG_INDEX_STRIDE 行記錄一次該行起始的位元組偏移，因此跳到任意行只需
+    一次 seek 加上最多 LOG_INDEX_STRIDE 行的掃描。索引只涵蓋已完整寫入的行，
+    每次使用前只掃描上次之後新增的位元組。
+    """
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.index_path = log_path + LOG_INDEX_SUFFIX
+        self.stride = LOG_INDEX_STRIDE
+        self.indexed_bytes = 0
+        self.lines = 0
+        self.offsets = array('Q', [0])
+        self._persisted = 1
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            stride, indexed_bytes, lines = LOG_INDEX_HEADER.unpack_from(data)
+            offsets = array('Q')
+            offsets.frombytes(data[LOG_INDEX_HEADER.size:])
+            # 寫入中斷或參數不同時重建索引
+            if stride != self.stride or len(offsets) != lines // stride + 1:
+                raise ValueError("inconsistent line index")
+        except (OSError, ValueError, struct.error):
+            return
+        self.indexed_bytes = indexed_bytes
+        self.lines = lines
+        self.offsets = offsets
+        self._persisted = len(offsets)
+
+    def _reset(self):
+        self.indexed_bytes = 0
+        self.lines = 0
+        self.offsets = array('Q', [0])
+        self._persisted = 0
+
+    def refresh(self):
+        """掃描新增的內容並更新索引，回傳目前檔案大小（壓縮記錄為未壓縮大小）"""
+        with open_log(self.log_path) as f:
+            size = f.size
+            if size < self.indexed_bytes:
+                # 記錄檔被覆寫或截斷
+                self._reset()
+            if size == self.indexed_bytes:
+                return size
+
+            f.seek(self.indexed_bytes)
+            position = self.indexed_bytes
+            while True:
+                block = f.read(OUTPUT_CHUNK_LIMIT)
+                if not block:
+                    break
+                newline_ends = [m.end() for m in re.finditer(b'\n', block)]
+                if newline_ends:
+                    # 第 need 個換行讓行數達到下一個 stride 的倍數
+                    need = self.stride - self.lines % self.stride
+                    for end in newline_ends[need - 1::self.stride]:
+                        self.offsets.append(position + end)
+                    self.lines += len(newline_ends)
+                    self.indexed_bytes = position + newline_ends[-1]
+                position += len(block)
+
+        self._save()
+        return size
+
+    def _save(self):
+        try:
+            mode = 'r+b' if self._persisted and os.path.exists(self.index_path) else 'wb'
+            with open(self.index_path, mode) as f:
+                if mode == 'wb':
+                    f.write(LOG_INDEX_HEADER.pack(self.stride, 0, 0))
+                    self._persisted = 0
+                # 先追加偏移量再更新表頭，中斷時表頭與偏移數量不一致即會重建
+                f.seek(LOG_INDEX_HEADER.size + self._persisted * self.offsets.itemsize)
+                f.truncate()
+                self.offsets[self._persisted:].tofile(f)
+                f.seek(0)
+                f.write(LOG_INDEX_HEADER.pack(self.stride, self.indexed_bytes, self.lines))
+            self._persisted = len(self.offsets)
+        except OSError as e:
+            logger.warning(f"Unable to persist line index for {self.log_path}: {e}")
+
+    def total_lines(self, size):
+        """總行數（最後一行尚未換行也算一行）"""
+        return self.lines + (1 if size > self.indexed_bytes else 0)
+
+    def offset_of_line(self, line):
+        """回傳第 line 行（從 0 起算）起始的位元組偏移"""
+        if line <= 0:
+            return 0
+        if line >= self.lines:
+            if line == self.lines:
+                return self.indexed_bytes
+            with open_log(self.log_path) as f:
+                return f.size
+
+        checkpoint = line // self.stride
+        position = self.offsets[checkpoint]
+        remaining = line - checkpoint * self.stride
+        with open_log(self.log_path) as f:
+            f.seek(position)
+            while remaining > 0:
+                block = f.read(64 * 1024)
+                if not block:
+                    break
+                start = 0
+                while remaining > 0:
+                    found = block.find(b'\n', start)
+                    if found < 0:
+                        break
+                    start = found + 1
+                    remaining -= 1
+                position += start if remaining == 0 else len(block)
+        return position
+
+
+def trim_partial_utf8(data):
+    """去掉結尾不完整的 UTF-8 字元，避免分段讀取時切斷多位元組字元"""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte & 0xC0 == 0x80:
+            continue  # 後續位元組，繼續往前找起始位元組
+        if byte & 0x80 == 0:
+            return data
+        expected = 2 if byte & 0xE0 == 0xC0 else 3 if byte & 0xF0 == 0xE0 else 4
+        return data if back >= expected else data[:-back]
+    return data
+
+
+def read_output_chunk(log_path, offset=None, length=None, from_line=None, tail_lines=None, lines=None):
+    """依位元組範圍或行號讀取輸出記錄的一段，回傳 (內容, 中繼資訊)"""
+    length = OUTPUT_CHUNK_LIMIT if length is None else max(0, min(length, OUTPUT_CHUNK_LIMIT))
+    start_line = None
+
+    with log_index_lock(log_path):
+        line_index = LogLineIndex(log_path)
+        size = line_index.refresh()
+        total_lines = line_index.total_lines(size)
+        if tail_lines is not None:
+            start_line = max(0, total_lines - tail_lines)
+            offset = line_index.offset_of_line(start_line)
+            if size - offset > length:
+                # 超過單次上限時只回傳最後 length 位元組，並對齊到下一行開頭
+                offset = size - length
+                start_line = None
+        elif from_line is not None:
+            start_line = from_line
+            offset = line_index.offset_of_line(from_line)
+
+    offset = min(max(0, offset or 0), size)
+    with open_log(log_path) as f:
+        f.seek(offset)
+        data = f.read(length)
+
+    if tail_lines is not None and start_line is None and offset > 0:
+        newline = data.find(b'\n')
+        if newline >= 0:
+            offset += newline + 1
+            data = data[newline + 1:]
+
+    if lines is not None:
+        # 最多回傳 lines 行
+        end = -1
+        for _ in range(max(0, lines)):
+            end = data.find(b'\n', end + 1)
+            if end < 0:
+                break
+        else:
+            data = data[:end + 1]
+
+    data = trim_partial_utf8(data)
+    return data, {
+        'offset': offset,
+        'next_offset': offset + len(data),
+        'size': size,
+        'total_lines': total_lines,
+        'start_line': start_line
+    }
+
+# ========== 應用程式記錄讀取 ==========
+
+LOG_TAIL_BLOCK = 64 * 1024  # 由檔尾往前讀取的區塊大小
+LOG_TAIL_SCAN_LIMIT = 64 * 1024 * 1024  # /logs 單次最多往回掃描的位元組數
+LOG_TAIL_MAX_LINES = 5000
+LOG_LINE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(\d{3}) - ([A-Z]+) - (.*)$', re.S)
+
+
+def reverse_lines(path, block_size=LOG_TAIL_BLOCK):
+    """由檔尾往前逐塊讀取，依新到舊產生每一行（bytes，不含換行）"""
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        remainder = b''
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + remainder).split(b'\n')
+            # 第一段可能是上一個區塊中某行的後半，留到下一輪拼接
+            remainder = lines.pop(0)
+            yield from reversed(lines)
+        yield remainder
+
+
+def parse_log_line(line):
+    """解析一行文字或 JSON 格式的記錄；traceback 等延續行回傳 None"""
+    if line.startswith('{'):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+        if isinstance(entry, dict) and 'level' in entry and 'ts' in entry:
+            return entry
+        return None
+    match = LOG_LINE_PATTERN.match(line)
+    if not match:
+        return None
+    timestamp, millis, level, message = match.groups()
+    return {
+        'time': f"{timestamp},{millis}",
+        'ts': datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').timestamp() + int(millis) / 1000,
+        'level': level,
+        'message': message
+    }
+
+
+def tail_log(path, limit=100, min_level=None, since=None, until=None, scan_limit=LOG_TAIL_SCAN_LIMIT):
+    """從最新的記錄往回找出最多 limit 筆符合條件的記錄，包含已輪替的備份檔
+
+    回傳 (由舊到新的記錄, 是否因達到 scan_limit 而提早停止)。記錄依時間順序寫入，
+    遇到早於 since 的記錄即停止，所以成本只與回傳範圍有關，與檔案大小無關。
+    """
+    matched = []
+    continuation = []  # 往回讀時先遇到的延續行，屬於之後遇到的那一筆記錄
+    scanned = 0
+    paths = [path] + [f"{path}.{i}" for i in range(1, LOG_BACKUP_COUNT + 1)]
+    for log_path in paths:
+        if not os.path.exists(log_path):
+            continue
+        for raw in reverse_lines(log_path):
+            scanned += len(raw) + 1
+            if scanned > scan_limit:
+                return matched[::-1], True
+            line = raw.decode('utf-8', errors='replace').rstrip('\r')
+            if not line:
+                continue
+            entry = parse_log_line(line)
+            if entry is None:
+                continuation.append(line)
+                continue
+            entry['raw'] = line
+            if continuation:
+                extra = '\n'.join(reversed(continuation))
+                entry['raw'] += '\n' + extra
+                entry['message'] += '\n' + extra
+                continuation = []
+
+            if until is not None and entry['ts'] > until:
+                continue
+            if since is not None and entry['ts'] < since:
+                return matched[::-1], False
+            if min_level is not None and logging.getLevelName(entry['level']) < min_level:
+                continue
+            matched.append(entry)
+            if len(matched) >= limit:
+                return matched[::-1], False
+    return matched[::-1], False
+
+# ========== 記錄壓縮 ==========
+
+LOG_ARCHIVE_SUFFIX = ".gz"  # 壓縮後的記錄：<log>.gz，由多個獨立的 gzip member 串接而成
+LOG_ARCHIVE_INDEX_SUFFIX = ".gz.idx"  # 每個 member 的 (未壓縮偏移, 壓縮偏移)
+LOG_ARCHIVE_INDEX_HEADER = struct.Struct('<4sQ')  # magic, member 數量
+LOG_ARCHIVE_MAGIC = b'BGZI'
+LOG_ARCHIVE_BLOCK = 1024 * 1024  # 每個 member 的未壓縮大小
+LOG_ARCHIVE_FILES = ('output.log', 'nohup.out', 'error.log')  # 執行結束後壓縮的記錄檔
+
+
+class PlainLogReader:
+    """未壓縮的記錄檔，介面與 BlockGzipReader 相同"""
+
+    compressed = False
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self.size = stat.st_size
+        self.stored_size = stat.st_size
+        self.mtime = stat.st_mtime
+
+    def seek(self, position):
+        self._file.seek(position)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class BlockGzipReader:
+    """以未壓縮座標隨機讀取分塊 gzip 記錄，只解壓需要的 member
+
+    索引遺失或損毀時會逐塊掃描檔案重建並寫回索引，因此一般以 gzip 壓縮的單一 member 檔也能讀取。
+    """
+
+    compressed = True
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self._file = open(archive_path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self.stored_size = stat.st_size
+        self.mtime = stat.st_mtime
+        self._position = 0
+        self._cached_block = (None, b'')
+        self.index_path = archive_path[:-len(LOG_ARCHIVE_SUFFIX)] + LOG_ARCHIVE_INDEX_SUFFIX
+        try:
+            self.raw_offsets, self.archive_offsets = self._load_index()
+        except (OSError, ValueError, struct.error):
+            self.raw_offsets, self.archive_offsets = self._scan_members()
+            try:
+                write_log_archive_index(self.index_path, self.raw_offsets, self.archive_offsets)
+            except OSError as e:
+                logger.warning(f"Could not save rebuilt index {self.index_path}: {e}")
+        self.size = self.raw_offsets[-1]
+
+    def _load_index(self):
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        magic, members = LOG_ARCHIVE_INDEX_HEADER.unpack_from(data)
+        offsets = array('Q')
+        offsets.frombytes(data[LOG_ARCHIVE_INDEX_HEADER.size:])
+        if magic != LOG_ARCHIVE_MAGIC or len(offsets) != 2 * (members + 1):
+            raise ValueError("inconsistent archive index")
+        raw_offsets, archive_offsets = offsets[:members + 1], offsets[members + 1:]
+        if archive_offsets[-1] != self.stored_size:
+            raise ValueError("archive index does not match archive size")
+        return raw_offsets, archive_offsets
+
+    def _scan_members(self):
+        """逐塊讀取並解壓以找出各 member 的邊界，只保留長度；記憶體用量與檔案大小無關"""
+        raw_offsets = array('Q', [0])
+        archive_offsets = array('Q', [0])
+        self._file.seek(0)
+        decompressor = zlib.decompressobj(31)
+        raw_size = 0
+        consumed = 0  # 已交給解壓器的壓縮位元組
+        while True:
+            data = self._file.read(LOG_ARCHIVE_BLOCK)
+            if not data:
+                break
+            while data:
+                # 限制每次輸出的大小，高壓縮比的 member 也不會一次展開
+                raw_size += len(decompressor.decompress(data, LOG_ARCHIVE_BLOCK))
+                if decompressor.eof:
+                    rest = decompressor.unused_data
+                    consumed += len(data) - len(rest)
+                    raw_offsets.append(raw_offsets[-1] + raw_size)
+                    archive_offsets.append(consumed)
+                    decompressor = zlib.decompressobj(31)
+                    raw_size = 0
+                else:
+                    rest = decompressor.unconsumed_tail
+                    consumed += len(data) - len(rest)
+                data = rest
+        if consumed > archive_offsets[-1]:
+            # 最後一個 member 不完整（例如壓縮到一半），讀得到的部分照樣提供
+            raw_offsets.append(raw_offsets[-1] + raw_size)
+            archive_offsets.append(consumed)
+        return raw_offsets, archive_offsets
+
+    def _block(self, member):
+        if self._cached_block[0] != member:
+            start = self.archive_offsets[member]
+            self._file.seek(start)
+            compressed = self._file.read(self.archive_offsets[member + 1] - start)
+            self._cached_block = (member, zlib.decompress(compressed, 31))
+        return self._cached_block[1]
+
+    def seek(self, position):
+        self._position = max(0, position)
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.size, self._position + size)
+        chunks = []
+        while self._position < end:
+            member = bisect.bisect_right(self.raw_offsets, self._position) - 1
+            block = self._block(member)
+            start = self._position - self.raw_offsets[member]
+            chunk = block[start:start + end - self._position]
+            chunks.append(chunk)
+            self._position += len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def open_log(path):
+    """開啟記錄檔；已壓縮時透明地讀取 <path>.gz。兩者都不存在時拋出 FileNotFoundError"""
+    try:
+        return PlainLogReader(path)
+    except FileNotFoundError:
+        # 壓縮完成後原始檔才會刪除，找不到原始檔時壓縮檔一定已就緒
+        return BlockGzipReader(path + LOG_ARCHIVE_SUFFIX)
+
+def log_exists(path):
+    return os.path.isfile(path) or os.path.isfile(path + LOG_ARCHIVE_SUFFIX)
+
+def remove_log_archive(path):
+    """記錄檔被覆寫時移除舊的壓縮檔與索引"""
+    for suffix in (LOG_ARCHIVE_SUFFIX, LOG_ARCHIVE_INDEX_SUFFIX):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def write_log_archive_index(index_path, raw_offsets, archive_offsets):
+    """原子性地寫入分塊 gzip 的偏移索引；暫存檔名不重複，同時重建同一個索引的讀取者不會互相覆寫"""
+    tmp_path = f"{index_path}.tmp-{uuid.uuid4().hex}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(LOG_ARCHIVE_INDEX_HEADER.pack(LOG_ARCHIVE_MAGIC, len(raw_offsets) - 1))
+            raw_offsets.tofile(f)
+            archive_offsets.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, index_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def compress_log(path, block_size=LOG_ARCHIVE_BLOCK):
+    """把記錄檔壓縮成分塊 gzip 並寫入偏移索引，完成後刪除原始檔
+
+    壓縮期間檔案若有變動則放棄，回傳是否已壓縮。
+    """
+    archive_path = path + LOG_ARCHIVE_SUFFIX
+    index_path = path + LOG_ARCHIVE_INDEX_SUFFIX
+    before = os.stat(path)
+    raw_offsets = array('Q', [0])
+    archive_offsets = array('Q', [0])
+    try:
+        with open(path, 'rb') as src, open(archive_path + '.tmp', 'wb') as dst:
+            while True:
+                block = src.read(block_size)
+                if not block:
+                    break
+                dst.write(gzip.compress(block, mtime=0))
+                raw_offsets.append(raw_offsets[-1] + len(block))
+                archive_offsets.append(dst.tell())
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        after = os.stat(path)
+        if after.st_size != before.st_size or after.st_mtime != before.st_mtime or raw_offsets[-1] != after.st_size:
+            logger.info(f"{path} changed during compression, will retry later")
+            os.remove(archive_path + '.tmp')
+            return False
+
+        write_log_archive_index(index_path, raw_offsets, archive_offsets)
+        # 保留原始修改時間，執行完成時間由它推得
+        os.utime(archive_path + '.tmp', (before.st_atime, before.st_mtime))
+        os.replace(archive_path + '.tmp', archive_path)
+        os.remove(path)
+    except OSError:
+        if os.path.exists(archive_path + '.tmp'):
+            os.remove(archive_path + '.tmp')
+        raise
+    return True
+
+def archive_execution(dir_name):
+    """壓縮一次已結束執行的記錄檔，回傳 (原始位元組, 壓縮後位元組)"""
+    dir_path = os.path.join(EXECUTION_LOG_DIR, dir_name)
+    output_path = os.path.join(dir_path, 'output.log')
+    if os.path.exists(output_path):
+        # 壓縮前先補齊行索引，之後依行號讀取不必解壓整個檔案
+        with log_index_lock(output_path):
+            LogLineIndex(output_path).refresh()
+
+    raw_bytes = stored_bytes = 0
+    for name in LOG_ARCHIVE_FILES:
+        path = os.path.join(dir_path, name)
+        if not os.path.isfile(path):
+            continue
+        size = os.path.getsize(path)
+        if compress_log(path):
+            raw_bytes += size
+            stored_bytes += os.path.getsize(path + LOG_ARCHIVE_SUFFIX)
+    return raw_bytes, stored_bytes
+
+# 壓縮與保留清理都會改寫整個執行目錄，同一時間只允許其中一個動作
+execution_maintenance_lock = threading.Lock()
+
+def archive_finished_logs():
+    """背景壓縮已結束一段時間的執行記錄"""
+    logger.info("Starting execution log archiver thread")
+    while True:
+        try:
+            running = {task['execution_directory'] for task in task_supervisor.running()}
+            candidates = execution_index.archive_candidates(time.time() - LOG_ARCHIVE_DELAY)
+            for dir_name in candidates:
+                if dir_name in running:
+                    continue
+                with execution_maintenance_lock:
+                    if not os.path.isdir(os.path.join(EXECUTION_LOG_DIR, dir_name)):
+                        continue
+                    raw_bytes, stored_bytes = archive_execution(dir_name)
+                    execution_index.update(dir_name)
+                if raw_bytes:
+                    logger.info(f"Archived logs of {dir_name}: {raw_bytes} -> {stored_bytes} bytes")
+        except Exception as e:
+            logger.error(f"Error archiving execution logs: {e}")
+        time.sleep(LOG_ARCHIVE_INTERVAL)
+
+# ========== 執行記錄保留 ==========
+
+def directory_disk_usage(path):
+    """目錄實際佔用的磁碟空間（位元組，依配置的區塊計算）"""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_blocks * 512
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total
+
+
+class RetentionPolicy:
+    """task_executions 的保留規則：總容量、保留天數、保留筆數，失敗的執行保留較久
+
+    每一筆已結束的執行以 (結束時間 + 失敗寬限) 作為淘汰順序放入 heap，
+    由最舊的開始淘汰，直到三項規則都滿足為止。沒有結束標記
+    （output.log 結尾或 status.json 的 exit_code）或仍由監管器追蹤的執行不會被淘汰，
+    但仍計入總容量與筆數。
+    """
+
+    def __init__(self, max_bytes=0, max_age_days=0, max_count=0, failed_extra_days=0):
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.max_count = max_count
+        self.failed_extra_days = failed_extra_days
 
-# 數據文件路徑
-COMMANDS_FILE = "gpu_commands.json"
-LOG_FILE = "gpu_monitor.log"
-EXECUTION_LOG_DIR = "task_executions"  # 任務執行記錄目錄
+    @property
+    def enabled(self):
+        return bool(self.max_bytes or self.max_age_days or self.max_count)
 
-# 確保執行記錄目錄存在
-os.makedirs(EXECUTION_LOG_DIR, exist_ok=True)
+    def describe(self):
+        return {
+            'max_bytes': self.max_bytes,
+            'max_age_days': self.max_age_days,
+            'max_count': self.max_count,
+            'failed_extra_days': self.failed_extra_days,
+            'enabled': self.enabled
+        }
 
-# 設置日誌配置
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
+    def plan(self, rows, running, now):
+        """計算要淘汰的執行，回傳 (淘汰清單, 統計)"""
+        total_bytes = sum(r['bytes'] for r in rows)
+        remaining_count = len(rows)
+        remaining_bytes = total_bytes
 
-def load_commands():
-    """從文件讀取指令表格數據"""
+        heap = []
+        protected = 0
+        for r in rows:
+            if r['completed_time'] is None or r['directory'] in running:
+                protected += 1
+                continue
+            grace = self.failed_extra_days * 86400 if r['status'] == 'failed' else 0
+            heap.append((r['completed_time'] + grace, r['directory'], r))
+        heapq.heapify(heap)
+
+        age_cutoff = now - self.max_age_days * 86400 if self.max_age_days else None
+        evict = []
+        while heap:
+            key, _, r = heap[0]
+            if age_cutoff is not None and key < age_cutoff:
+                reason = 'age'
+            elif self.max_count and remaining_count > self.max_count:
+                reason = 'count'
+            elif self.max_bytes and remaining_bytes > self.max_bytes:
+                reason = 'bytes'
+            else:
+                break
+            heapq.heappop(heap)
+            remaining_count -= 1
+            remaining_bytes -= r['bytes']
+            evict.append({
+                'directory': r['directory'],
+                'status': r['status'],
+                'completed_time': r['completed_time'],
+                'bytes': r['bytes'],
+                'size_estimated': not r['sized'],
+                'reason': reason
+            })
+
+        summary = {
+            'executions': len(rows),
+            'bytes': total_bytes,
+            'unsized': sum(1 for r in rows if not r['sized']),
+            'protected': protected,
+            'evict_count': len(evict),
+            'evict_bytes': total_bytes - remaining_bytes,
+            'remaining_executions': remaining_count,
+            'remaining_bytes': remaining_bytes
+        }
+        return evict, summary
+
+
+retention_policy = RetentionPolicy(RETENTION_MAX_BYTES, RETENTION_MAX_AGE_DAYS,
+                                   RETENTION_MAX_COUNT, RETENTION_FAILED_EXTRA_DAYS)
+
+def measure_execution_sizes(limit=RETENTION_SIZE_BATCH):
+    """計算一批已結束執行的目錄大小並寫入索引快取"""
+    sizes = {}
+    for dir_name in execution_index.unsized(limit):
+        sizes[dir_name] = directory_disk_usage(os.path.join(EXECUTION_LOG_DIR, dir_name))
+    if sizes:
+        execution_index.set_disk_bytes(sizes)
+    return len(sizes)
+
+def plan_retention(policy=None):
+    """依目前索引計算保留策略的淘汰清單（不刪除任何檔案）"""
+    policy = policy or retention_policy
+    running = {task['execution_directory'] for task in task_supervisor.running()}
+    return policy.plan(execution_index.retention_rows(), running, time.time())
+
+def enforce_retention(limit=RETENTION_DELETE_BATCH):
+    """刪除一批超出保留策略的執行目錄，回傳 (刪除數, 釋放位元組)"""
+    evict, _ = plan_retention()
+    deleted = []
+    freed = 0
+    for entry in evict[:limit]:
+        dir_name = entry['directory']
+        with execution_maintenance_lock:
+            # 計畫與刪除之間任務可能被重新執行，刪除前再確認一次
+            if dir_name in {t['execution_directory'] for t in task_supervisor.running()}:
+                continue
+            try:
+                shutil.rmtree(os.path.join(EXECUTION_LOG_DIR, dir_name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error removing execution {dir_name}: {e}")
+                continue
+        deleted.append(dir_name)
+        freed += entry['bytes']
+        logger.info(f"Retention removed {dir_name} ({entry['reason']}, {entry['bytes']} bytes)")
+    if deleted:
+        execution_index.remove(deleted)
+    return len(deleted), freed
+
+def run_retention():
+    """背景分批計算目錄大小並套用保留策略"""
+    logger.info(f"Starting execution retention thread: {retention_policy.describe()}")
+    while True:
+        try:
+            measured = measure_execution_sizes()
+            deleted = 0
+            if retention_policy.enabled:
+                deleted, freed = enforce_retention()
+                if deleted:
+                    logger.info(f"Retention pass removed {deleted} executions, freed {freed} bytes")
+            # 還有未處理完的批次就不等待完整間隔
+            if deleted >= RETENTION_DELETE_BATCH or measured >= RETENTION_SIZE_BATCH:
+                time.sleep(1)
+                continue
+        except Exception as e:
+            logger.error(f"Error applying retention policy: {e}")
+        time.sleep(RETENTION_INTERVAL)
+
+# ========== 任務監管 ==========
+
+def write_status_file(status_file, updates):
+    """合併更新 status.json（寫入暫存檔後原子替換）"""
+    status_data = {}
     try:
-        if os.path.exists(COMMANDS_FILE):
-            with open(COMMANDS_FILE, 'r', encoding='utf-8') as f:
-                commands = json.load(f)
-            
-            # 數據遷移：將舊的 id 字段轉換為 uid
-            migrated = False
-            for cmd in commands:
-                if 'id' in cmd and 'uid' not in cmd:
-                    cmd['uid'] = str(uuid.uuid4())
-                    del cmd['id']  # 移除舊的 id 字段
-                    migrated = True
-                    logger.info(f"Migrated command to UID: {cmd['uid']}")
-            
-            # 如果有遷移，保存更新後的數據
-            if migrated:
-                save_commands(commands)
-                logger.info("Command data migration completed")
-            
-            return commands
+        with open(status_file, 'r', encoding='utf-8') as f:
+            status_data = json.load(f)
+    except (OSError, ValueError):
+        pass
+    status_data.update(updates)
+    tmp_file = status_file + ".tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(status_data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, status_file)
+    return status_data
+
+
+class TaskSupervisor:
+    """持有所有已啟動任務的程序，在結束時記錄結束碼與資源使用量
+
+    使用 pidfd（Linux 5.3+）讓單一收割線程等待所有任務；不支援 pidfd 時
+    退回每個任務一個 os.wait4 線程。只會 wait 自己啟動的 pid，不影響其他子程序。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks = {}  # pid -> 任務記錄
+        self._use_pidfd = hasattr(os, 'pidfd_open')
+        self._selector = None
+        self._pending = []  # 等待收割線程註冊的 (pidfd, pid)
+        self._wake_r = self._wake_w = None
+        self._thread = None
+
+    def _ensure_reaper(self):
+        if self._thread is not None:
+            return
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._reap_loop, daemon=True)
+        self._thread.start()
+
+    def launch(self, task_uid, argv, cwd, env, output_path, status_file, status_data, gpu_ids=None):
+        """啟動任務（新的 session，脫離主程序）並寫入 status.json，回傳任務記錄"""
+        with open(output_path, 'ab') as output:
+            process = subprocess.Popen(
+                argv,
+                cwd=cwd,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+                start_new_session=True  # 創建新的程序群組，完全脫離父程序
+            )
+        record = {
+            'task_uid': task_uid,
+            'pid': process.pid,
+            'pgid': process.pid,  # start_new_session 讓任務成為自己的 session/群組領導者
+            'gpu_ids': gpu_ids,
+            'execution_directory': cwd,
+            'status_file': status_file,
+            'start_time': datetime.now().isoformat(),
+            'started': time.monotonic(),
+            'process': process,
+            'adopted': False
+        }
+        # 先寫入狀態再開始收割，結束資訊一定寫在啟動資訊之後
+        status_data.update({
+            'state': 'running',
+            'pid': record['pid'],
+            'pgid': record['pgid'],
+            'start_time': record['start_time']
+        })
+        write_status_file(status_file, status_data)
+        self._watch(record)
+        return record
+
+    def adopt(self, task_uid, pid, status_file, start_time=None, gpu_ids=None):
+        """重新追蹤主程序重啟前啟動、仍在執行的任務（無法取得資源使用量）"""
+        if not self._use_pidfd:
+            return None
+        record = {
+            'task_uid': task_uid,
+            'pid': pid,
+            'pgid': pid,
+            'gpu_ids': gpu_ids,
+            'execution_directory': os.path.dirname(status_file),
+            'status_file': status_file,
+            'start_time': start_time,
+            'started': time.monotonic(),
+            'process': None,
+            'adopted': True
+        }
+        try:
+            self._watch(record)
+        except ProcessLookupError:
+            return None
+        logger.info(f"Adopted running task {task_uid} (pid {pid})")
+        return record
+
+    def _watch(self, record):
+        pid = record['pid']
+        with self._lock:
+            self._tasks[pid] = record
+        if self._use_pidfd:
+            try:
+                pidfd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                with self._lock:
+                    self._tasks.pop(pid, None)
+                raise
+            with self._lock:
+                self._ensure_reaper()
+                self._pending.append((pidfd, pid))
+            os.write(self._wake_w, b'\0')
         else:
-            return []
-    except Exception as e:
-        logger.error(f"❌ Error loading commands: {e}")
-        return []
+            threading.Thread(target=self._wait_one, args=(pid,), daemon=True).start()
 
-def save_commands(commands):
-    """保存指令表格數據到文件"""
-    try:
-        with open(COMMANDS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(commands, f, ensure_ascii=False, indent=2)
-        logger.info(f"Commands saved successfully. Total: {len(commands)}")
-        return True
-    except Exception as e:
-        logger.error(f"Error saving commands: {e}")
-        return False
+    def _reap_loop(self):
+        logger.info("Starting task reaper thread")
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    # 喚醒：註冊新的 pidfd
+                    try:
+                        while os.read(self._wake_r, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    with self._lock:
+                        pending, self._pending = self._pending, []
+                    for pidfd, pid in pending:
+                        self._selector.register(pidfd, selectors.EVENT_READ, pid)
+                    continue
 
-def add_command(command_text, required_gpu):
-    """新增指令到表格"""
-    commands = load_commands()
-    
-    # 生成新的UUID作為唯一ID
-    new_uid = str(uuid.uuid4())
-    
-    new_command = {
-        'uid': new_uid,
-        'command': command_text,
-        'required_gpu': required_gpu,
-        'created_at': datetime.now().isoformat(),
-        'order': len(commands) + 1
-    }
-    
-    commands.append(new_command)
-    
-    if save_commands(commands):
-        logger.info(f"Command added: UID={new_uid}, GPU={required_gpu}")
-        return new_command
-    else:
-        logger.error(f"Failed to add command: UID={new_uid}")
-        return None
+                pid = key.data
+                self._selector.unregister(key.fd)
+                os.close(key.fd)
+                self._reap_logged(pid, blocking=False)
 
-def get_commands():
-    """讀取所有指令（按順序排列）"""
-    commands = load_commands()
-    # 按order字段排序
-    return sorted(commands, key=lambda x: x.get('order', 0))
+    def _wait_one(self, pid):
+        self._reap_logged(pid, blocking=True)
 
-def delete_command(command_uid):
-    """刪除指定UID的指令"""
-    commands = load_commands()
-    original_count = len(commands)
-    
-    logger.info(f"Attempting to delete command with UID: {command_uid}")
-    logger.info(f"Total commands before deletion: {original_count}")
-    
-    # 檢查是否存在該 UID
-    found_command = None
-    for cmd in commands:
-        if cmd.get('uid') == command_uid:
-            found_command = cmd
-            break
-    
-    if not found_command:
-        logger.warning(f"Command with UID {command_uid} not found")
-        logger.info(f"Available UIDs: {[cmd.get('uid') for cmd in commands]}")
-        return False
-    
-    # 過濾掉要刪除的指令
-    commands = [cmd for cmd in commands if cmd.get('uid') != command_uid]
-    
-    if len(commands) < original_count:
-        # 重新排序order字段
-        for i, cmd in enumerate(commands):
-            cmd['order'] = i + 1
-        
-        if save_commands(commands):
-            logger.info(f"Command deleted: UID={command_uid}")
-            return True
+    def _reap_logged(self, pid, blocking):
+        """單一任務收尾失敗只記錄錯誤，收割執行緒要繼續處理其他任務"""
+        try:
+            self._reap(pid, blocking)
+        except Exception as e:
+            logger.error(f"Error reaping task process {pid}: {e}")
+
+    def _reap(self, pid, blocking):
+        with self._lock:
+            record = self._tasks.get(pid)
+        if record is None:
+            return
+
+        exit_code = None
+        rusage = None
+        if record['adopted']:
+            # 不是自己的子程序，結束碼由 output.log 結尾取得
+            try:
+                exit_code = read_execution_metadata(os.path.basename(record['execution_directory']))['exit_code']
+            except Exception as e:
+                logger.error(f"Error reading exit code of adopted task {record['task_uid']}: {e}")
         else:
-            logger.error(f"Failed to delete command: UID={command_uid}")
-    
-    return False
+            try:
+                _, wait_status, rusage = os.wait4(pid, 0 if blocking else os.WNOHANG)
+                exit_code = os.waitstatus_to_exitcode(wait_status)
+            except ChildProcessError:
+                pass
+            if record['process'] is not None and exit_code is not None:
+                # 告知 Popen 程序已被收割，避免它之後再 waitpid
+                record['process'].returncode = exit_code
+
+        with self._lock:
+            self._tasks.pop(pid, None)
+
+        wall_time = round(time.monotonic() - record['started'], 3)
+        updates = {
+            'state': 'exited',
+            'end_time': datetime.now().isoformat(),
+            'exit_code': exit_code,
+            'signal': -exit_code if exit_code is not None and exit_code < 0 else None
+        }
+        if not record['adopted']:
+            updates['wall_time_seconds'] = wall_time
+        if rusage is not None:
+            updates.update({
+                'cpu_user_seconds': round(rusage.ru_utime, 3),
+                'cpu_system_seconds': round(rusage.ru_stime, 3),
+                'peak_rss_kb': rusage.ru_maxrss
+            })
+        try:
+            write_status_file(record['status_file'], updates)
+        except Exception as e:
+            logger.error(f"Error updating status for task {record['task_uid']}: {e}")
+
+        logger.info(f"Task {record['task_uid']} (pid {pid}) exited with code {exit_code}")
+        on_task_exit(record['task_uid'], os.path.basename(record['execution_directory']))
+
+    def running_count(self):
+        return len(self._tasks)
+
+    def sessions(self):
+        """session id -> 任務 uid，用來辨認 nvidia-smi 回報的程序屬於哪個任務"""
+        with self._lock:
+            return {r['pgid']: r['task_uid'] for r in self._tasks.values()}
+
+    def running(self):
+        """目前仍在執行的任務"""
+        now = time.monotonic()
+        with self._lock:
+            records = list(self._tasks.values())
+        return [{
+            'task_uid': r['task_uid'],
+            'pid': r['pid'],
+            'pgid': r['pgid'],
+            'gpu_ids': r['gpu_ids'],
+            'execution_directory': os.path.basename(r['execution_directory']),
+            'start_time': r['start_time'],
+            'elapsed_seconds': None if r['adopted'] else round(now - r['started'], 1),
+            'adopted': r['adopted']
+        } for r in records]
+
+
+task_supervisor = TaskSupervisor()
+
+def mark_task_lost(task_uid, dir_name, status_file, reason):
+    """主程序重啟後找不到任務的程序：寫入結束碼未知的結束狀態，讓索引視為失敗並放行（或取消）等待它的指令"""
+    logger.warning(f"Task {task_uid} is no longer running ({reason}), marking it as lost")
+    try:
+        write_status_file(status_file, {
+            'state': 'exited',
+            'end_time': datetime.now().isoformat(),
+            'exit_code': None,
+            'signal': None,
+            'lost': True
+        })
+    except OSError as e:
+        logger.error(f"Error updating status for task {task_uid}: {e}")
+        return
+    on_task_exit(task_uid, dir_name)
+
+def adopt_running_tasks():
+    """啟動時重新追蹤上一次執行留下、仍在執行的任務；程序已不存在的任務記為遺失"""
+    execution_index.reconcile()
+    # 以 keyset 游標取完所有頁再處理，標記遺失會改變 status，不影響已取得的頁
+    rows = []
+    cursor = None
+    while True:
+        page, cursor, _ = execution_index.query(limit=1000, cursor=cursor, status='queued,running')
+        rows.extend(page)
+        if cursor is None:
+            break
+    for row in rows:
+        status_file = os.path.join(os.path.abspath(EXECUTION_LOG_DIR), row['directory'], 'status.json')
+        try:
+            with open(status_file, 'r', encoding='utf-8') as f:
+                status_data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if status_data.get('state') == 'exited':
+            continue
+        pid = status_data.get('pid')
+        if not pid:
+            # 啟動到一半主程序就結束，任務從未開始執行
+            mark_task_lost(row['task_uid'], row['directory'], status_file, "never started")
+            continue
+        try:
+            # 確認 pid 沒有被重用：仍是該任務 session 的領導者，且在執行同一份腳本
+            with open(f"/proc/{pid}/cmdline", 'rb') as f:
+                cmdline = f.read().decode('utf-8', errors='replace')
+            if os.getsid(pid) != pid or status_data.get('script_file', '') not in cmdline:
+                mark_task_lost(row['task_uid'], row['directory'], status_file, f"pid {pid} was reused")
+                continue
+        except OSError:
+            mark_task_lost(row['task_uid'], row['directory'], status_file, f"pid {pid} is gone")
+            continue
+        record = task_supervisor.adopt(row['task_uid'], pid, status_file,
+                                       status_data.get('start_time'), status_data.get('actual_gpu_ids'))
+        if record is None and task_supervisor._use_pidfd:
+            # pidfd_open 找不到程序：檢查之後才剛結束
+            mark_task_lost(row['task_uid'], row['directory'], status_file, f"pid {pid} exited during adoption")
+        elif record is not None:
+            gpu_ids = status_data.get('actual_gpu_ids') or []
+            gpu_reservations.reserve(row['task_uid'], gpu_ids, status_data.get('required_memory'))
+            fair_share.start(row['task_uid'], status_data.get('owner', DEFAULT_COMMAND_OWNER), len(gpu_ids))
+            try:
+                started = datetime.fromisoformat(status_data.get('start_time')).timestamp()
+            except (TypeError, ValueError):
+                started = None
+            runtime_predictor.start(row['task_uid'], status_data.get('command', ''), gpu_ids, started)
+
+def execute_task(command_text, required_gpu, task_uid, actual_gpu_ids=None, task_info=None):
+    """執行任務並記錄結果
 
-def execute_task(command_text, required_gpu, task_uid, actual_gpu_ids=None):
-    """執行任務並記錄結果"""
+    task_info 預設從本機佇列取得；遠端派送的任務不在本機佇列中，由呼叫端提供。
+    """
     try:
         # 創建以時間命名的執行記錄資料夾 - 時間在前，UUID在後
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -149,12 +2637,7 @@ def execute_task(command_text, required_gpu, task_uid, actual_gpu_ids=None):
         os.makedirs(execution_dir, exist_ok=True)
         
         # 獲取完整的任務資訊
-        commands = load_commands()
-        task_info = None
-        for cmd in commands:
-            if cmd.get('uid') == task_uid:
-                task_info = cmd
-                break
+        task_info = task_info or command_store.get(task_uid)
         
         # 處理GPU IDs
         cuda_visible_devices = None
@@ -176,6 +2659,8 @@ def execute_task(command_text, required_gpu, task_uid, actual_gpu_ids=None):
             if task_info:
                 f.write(f"Task Created At: {task_info.get('created_at', 'Unknown')}\n")
                 f.write(f"Task Order: {task_info.get('order', 'Unknown')}\n")
+                f.write(f"Owner: {task_info.get('owner', DEFAULT_COMMAND_OWNER)}\n")
+                f.write(f"Priority: {task_info.get('priority', 0)}\n")
                 
                 # 計算任務等待時間
                 try:
@@ -229,6 +2714,8 @@ def execute_task(command_text, required_gpu, task_uid, actual_gpu_ids=None):
             
             # 設置環境變量
             if cuda_visible_devices is not None:
+                # nvidia-smi 與拓撲以 PCI bus 順序編號，CUDA 預設卻是最快的卡優先
+                f.write("export CUDA_DEVICE_ORDER=PCI_BUS_ID\n")
                 f.write(f"export CUDA_VISIBLE_DEVICES={cuda_visible_devices}\n")
             
             f.write("# 設置工作目錄\n")
@@ -282,37 +2769,24 @@ def execute_task(command_text, required_gpu, task_uid, actual_gpu_ids=None):
         # 準備環境變量
         env = os.environ.copy()
         if cuda_visible_devices is not None:
+            env['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
             env['CUDA_VISIBLE_DEVICES'] = cuda_visible_devices
             logger.info(f"Setting CUDA_VISIBLE_DEVICES={cuda_visible_devices} for task {task_uid}")
         
-        # 使用絕對路徑執行腳本，並等待一小段時間確保啟動
+        # 使用絕對路徑執行腳本
         abs_script_path = os.path.abspath(script_file)
-        nohup_cmd = f"nohup bash {abs_script_path} &"
+        status_file = os.path.join(execution_dir, "status.json")
         
-        logger.info(f"Executing command: {nohup_cmd}")
+        logger.info(f"Executing script: {abs_script_path}")
         logger.info(f"Working directory: {execution_dir}")
         
-        process = subprocess.Popen(
-            nohup_cmd,
-            shell=True,
-            executable="/bin/bash",
-            cwd=execution_dir,
-            env=env,
-            preexec_fn=os.setsid  # 創建新的程序群組，完全脫離父程序
-        )
-        
-        # 等待一小段時間確保腳本開始執行
-        time.sleep(0.1)
-        
-        # 創建一個任務狀態文件
-        status_file = os.path.join(execution_dir, "status.json")
+        # 創建一個任務狀態文件（pid 與啟動時間由監管器填入，結束時再補上結束資訊）
         status_data = {
             "task_uid": task_uid,
             "required_gpu": required_gpu,
             "actual_gpu_ids": actual_gpu_ids,
             "cuda_visible_devices": cuda_visible_devices,
-            "start_time": datetime.now().isoformat(),
-            "execution_method": "nohup_independent",
+            "execution_method": "supervised",
             "script_file": script_file,
             "execution_directory": execution_dir,
             "command": command_text
@@ -321,18 +2795,38 @@ def execute_task(command_text, required_gpu, task_uid, actual_gpu_ids=None):
         if task_info:
             status_data.update({
                 "created_at": task_info.get('created_at'),
-                "order": task_info.get('order')
+                "order": task_info.get('order'),
+                "required_memory": task_info.get('required_memory'),
+                "max_util": task_info.get('max_util'),
+                "owner": task_info.get('owner', DEFAULT_COMMAND_OWNER),
+                "priority": task_info.get('priority', 0)
             })
         
-        with open(status_file, 'w', encoding='utf-8') as f:
-            json.dump(status_data, f, ensure_ascii=False, indent=2)
+        # 由監管器直接啟動腳本並持有程序，結束時記錄結束碼與資源使用量
+        task_record = task_supervisor.launch(
+            task_uid,
+            ["/bin/bash", abs_script_path],
+            cwd=execution_dir,
+            env=env,
+            output_path=os.path.join(execution_dir, "nohup.out"),
+            status_file=status_file,
+            status_data=status_data,
+            gpu_ids=actual_gpu_ids
+        )
         
-        logger.info(f"Task {task_uid} started independently using nohup")
+        logger.info(f"Task {task_uid} started under supervision (pid {task_record['pid']})")
         logger.info(f"Script file: {script_file}")
+
+        # 啟動後立即寫入執行索引
+        execution_index.update(os.path.basename(execution_dir))
+        fair_share.start(task_uid, status_data.get('owner', DEFAULT_COMMAND_OWNER), len(actual_gpu_ids or []))
+        runtime_predictor.start(task_uid, command_text, actual_gpu_ids)
+        task_launches.inc()
         return True
         
     except Exception as e:
         logger.error(f"Error executing task {task_uid}: {e}")
+        task_launch_failures.inc()
         
         # 如果執行失敗，記錄錯誤
         try:
@@ -344,54 +2838,607 @@ def execute_task(command_text, required_gpu, task_uid, actual_gpu_ids=None):
                 f.write(f"Error Message: {str(e)}\n")
                 f.write(f"Required GPU: {required_gpu}\n")
                 f.write(f"Command: {command_text}\n")
+            execution_index.update(os.path.basename(execution_dir))
         except:
             pass
         
         return False
 
-def check_gpu_availability(required_gpu):
-    """檢查指定的GPU是否可用"""
+# ========== GPU 預約帳本 ==========
+
+class GpuReservationLedger:
+    """記錄剛分配給任務、但 nvidia-smi 還看不到其程序的 GPU
+
+    任務啟動到程序出現在 nvidia-smi 之間會有延遲，這段期間 GPU 仍顯示為閒置。
+    預約會保留到之後的 GPU 快照在這些 GPU 上看到該任務自己的程序（processes 中
+    task 欄位相符），或超過寬限時間為止；其他程序佔用同一張卡不會讓預約提早釋放。
+    共用預約的任務剛建立 CUDA context 時只用了幾百 MiB，所以只扣掉已觀察到的用量，
+    剩下的部分保留到用量達到宣告的 required_memory 為止。
+    """
+
+    def __init__(self, grace_period):
+        self.grace_period = grace_period
+        self.version = 0  # 每次預約或釋放遞增
+        self._lock = threading.Lock()
+        self._reservations = {}  # task uid -> {'gpu_ids', 'memory', 'used', 'reserved_at', 'snapshot_seq'}
+
+    def reserve(self, task_uid, gpu_ids, memory=None):
+        """預約 GPU；memory 為 None 表示獨佔，否則為每張卡預留的 MiB 數"""
+        with self._lock:
+            self._reservations[task_uid] = {
+                'gpu_ids': list(gpu_ids),
+                'memory': memory,
+                'used': {},  # gpu id -> 最近一次快照中該任務的程序在這張卡上使用的 MiB
+                'reserved_at': time.monotonic(),
+                'snapshot_seq': gpu_snapshot_seq
+            }
+            self.version += 1
+        if memory is None:
+            logger.info(f"Reserved GPU {list(gpu_ids)} for task {task_uid}")
+        else:
+            logger.info(f"Reserved {memory}MiB on GPU {list(gpu_ids)} for task {task_uid}")
+
+    def release(self, task_uid):
+        with self._lock:
+            reservation = self._reservations.pop(task_uid, None)
+            if reservation:
+                self.version += 1
+        if reservation:
+            logger.info(f"Released GPU reservation {reservation['gpu_ids']} for task {task_uid}")
+        return reservation
+
+    def __len__(self):
+        return len(self._reservations)
+
+    def reserved_gpus(self):
+        """回傳 gpu id -> 預約的任務 uid 列表"""
+        with self._lock:
+            reserved = {}
+            for task_uid, reservation in self._reservations.items():
+                for gpu_id in reservation['gpu_ids']:
+                    reserved.setdefault(gpu_id, []).append(task_uid)
+            return reserved
+
+    def is_reserved(self, gpu_id):
+        with self._lock:
+            return any(gpu_id in r['gpu_ids'] for r in self._reservations.values())
+
+    def has_exclusive(self, gpu_id):
+        """GPU 是否被獨佔預約（不能再與其他任務共用）"""
+        with self._lock:
+            return any(gpu_id in r['gpu_ids'] and r['memory'] is None
+                       for r in self._reservations.values())
+
+    def reserved_memory(self, gpu_id):
+        """GPU 上共用預約但尚未反映在 mem_used 的記憶體（MiB）：宣告的量扣掉任務已經用掉的部分"""
+        with self._lock:
+            return sum(max(0, r['memory'] - r['used'].get(gpu_id, 0)) for r in self._reservations.values()
+                       if gpu_id in r['gpu_ids'] and r['memory'] is not None)
+
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                task_uid: {
+                    'gpu_ids': r['gpu_ids'],
+                    'memory': r['memory'],
+                    'used': r['used'],
+                    'age_seconds': round(now - r['reserved_at'], 1)
+                }
+                for task_uid, r in self._reservations.items()
+            }
+
+    def reconcile(self, current_processes, snapshot_seq):
+        """新的 GPU 快照到達時，釋放任務程序已出現或已逾時的預約"""
+        now = time.monotonic()
+        expired = []
+        task_gpus = {}  # gpu id -> {任務 uid: 該任務程序在這張卡上使用的 MiB}
+        for proc in current_processes:
+            if proc.get('task') is not None:
+                usage = task_gpus.setdefault(proc.get('gpu'), {})
+                usage[proc['task']] = usage.get(proc['task'], 0) + process_memory_mib(proc)
+        with self._lock:
+            for task_uid, reservation in self._reservations.items():
+                # 預約當下正在處理的快照可能早於任務啟動，至少要隔一個快照；
+                # 共用預約扣掉的是記憶體，要等任務的程序用到宣告的量（都反映在 mem_used）才釋放
+                if reservation['memory'] is None:
+                    appeared = all(task_uid in task_gpus.get(gpu_id, {}) for gpu_id in reservation['gpu_ids'])
+                else:
+                    reservation['used'] = {gpu_id: task_gpus.get(gpu_id, {}).get(task_uid, 0)
+                                           for gpu_id in reservation['gpu_ids']}
+                    appeared = all(used >= reservation['memory'] for used in reservation['used'].values())
+                seen = snapshot_seq > reservation['snapshot_seq'] + 1 and appeared
+                if seen or now - reservation['reserved_at'] > self.grace_period:
+                    expired.append(task_uid)
+        for task_uid in expired:
+            self.release(task_uid)
+
+
+def parse_fair_share_weights(spec):
+    """解析 "alice=2,bob=0.5" 形式的擁有者權重；格式錯誤或不大於 0 的項目記錄後略過"""
+    weights = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        owner, _, weight = item.partition('=')
+        owner = owner.strip()
+        try:
+            value = float(weight)
+        except ValueError:
+            value = None
+        if not owner or value is None or not math.isfinite(value) or value <= 0:
+            logger.error(f"Ignoring invalid FAIR_SHARE_WEIGHTS entry {item!r}: expected owner=<number > 0>")
+            continue
+        weights[owner] = value
+    return weights
+
+
+class FairShareLedger:
+    """各擁有者近期用掉的 GPU 秒數（指數衰減）與目前佔用的 GPU，換算成排程時的優先權扣分
+
+    扣分 = FAIR_SHARE_PENALTY_PER_GPU ×（近期平均使用的 GPU 數 + 目前佔用的 GPU 數）/ 權重。
+    衰減後的 GPU 秒數乘上 ln2 / 半衰期即為近期平均使用的 GPU 數。
+    """
+
+    def __init__(self, half_life, penalty_per_gpu, weights=None):
+        self.half_life = half_life
+        self.penalty_per_gpu = penalty_per_gpu
+        self.weights = weights or {}
+        self._lock = threading.Lock()
+        self._usage = {}    # 擁有者 -> (衰減後的 GPU 秒數, 更新時間)
+        self._running = {}  # 任務 uid -> (擁有者, GPU 數, 開始時間)
+
+    def weight(self, owner):
+        return self.weights.get(owner, 1.0)
+
+    def _decayed(self, owner, now):
+        value, updated = self._usage.get(owner, (0.0, now))
+        return value * 0.5 ** ((now - updated) / self.half_life)
+
+    def start(self, task_uid, owner, gpu_count):
+        with self._lock:
+            self._running[task_uid] = (owner, gpu_count, time.time())
+
+    def finish(self, task_uid):
+        """任務結束時把佔用的 GPU 秒數記到擁有者名下"""
+        now = time.time()
+        with self._lock:
+            running = self._running.pop(task_uid, None)
+            if running is None:
+                return
+            owner, gpu_count, started = running
+            self._usage[owner] = (self._decayed(owner, now) + gpu_count * (now - started), now)
+
+    def penalty(self, owner):
+        now = time.time()
+        with self._lock:
+            recent_gpus = self._decayed(owner, now) * math.log(2) / self.half_life
+            running_gpus = sum(count for o, count, _ in self._running.values() if o == owner)
+        return self.penalty_per_gpu * (recent_gpus + running_gpus) / self.weight(owner)
+
+    def describe(self):
+        now = time.time()
+        with self._lock:
+            owners = set(self._usage) | {o for o, _, _ in self._running.values()}
+            running = {}
+            for o, count, _ in self._running.values():
+                running[o] = running.get(o, 0) + count
+            usage = {o: self._decayed(o, now) for o in owners}
+        return {
+            owner: {
+                'recent_gpu_seconds': round(usage[owner], 1),
+                'running_gpus': running.get(owner, 0),
+                'weight': self.weight(owner),
+                'penalty': round(self.penalty(owner), 3)
+            }
+            for owner in sorted(owners)
+        }
+
+
+def command_signatures(command_text):
+    """由精確到粗略的指令特徵：第一行原文、數字換成 # 的範本、前兩個詞（程式與腳本）"""
+    line = next((l.strip() for l in command_text.splitlines() if l.strip()), '')
+    template = re.sub(r'\d+(?:\.\d+)?(?:[eE]-?\d+)?', '#', line)
+    head = ' '.join(line.split()[:2])
+    return ('=' + line, '~' + template, '^' + head)
+
+def execution_start_time(dir_name):
+    """執行目錄名稱開頭的啟動時間（YYYYmmdd_HHMMSS），無法解析時回傳 None"""
+    try:
+        return datetime.strptime(dir_name[:15], "%Y%m%d_%H%M%S").timestamp()
+    except ValueError:
+        return None
+
+
+class RuntimePredictor:
+    """依相似指令過去成功執行的時間預測執行時間，並記錄本機執行中任務預計結束的時間
+
+    相似度依 command_signatures 由精確到粗略比對，取第一個有記錄的特徵，
+    以最近 RUNTIME_SAMPLES 次執行時間的 RUNTIME_PERCENTILE 百分位作為預測值。
+    歷史記錄在第一次預測時從執行索引載入，之後由任務結束事件逐筆加入。
+    """
+
+    def __init__(self, samples, percentile):
+        self.samples = samples
+        self.percentile = percentile
+        self._lock = threading.Lock()
+        self._history = {}   # 指令特徵 -> 最近的執行秒數
+        self._running = {}   # 任務 uid -> (GPU 列表, 開始時間, 預測秒數)
+        self._loaded = False
+
+    def _record(self, command_text, seconds):
+        for signature in command_signatures(command_text):
+            self._history.setdefault(signature, collections.deque(maxlen=self.samples)).append(seconds)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            rows = execution_index.runtime_samples(RUNTIME_HISTORY_LIMIT)
+        except Exception as e:
+            logger.error(f"Error loading runtime history: {e}")
+            return
+        for directory, command_text, completed_time in reversed(rows):
+            started = execution_start_time(directory)
+            if started is not None and completed_time >= started:
+                self._record(command_text, completed_time - started)
+        logger.info(f"Loaded runtime history from {len(rows)} executions")
+
+    def observe(self, directory, command_text, completed_time):
+        """加入一筆剛成功結束的執行"""
+        started = execution_start_time(directory)
+        if started is None or completed_time < started:
+            return
+        with self._lock:
+            if self._loaded:
+                self._record(command_text, completed_time - started)
+
+    def predict(self, command_text):
+        """預測執行秒數，沒有相似的記錄時回傳 None"""
+        with self._lock:
+            self._ensure_loaded()
+            for signature in command_signatures(command_text):
+                history = self._history.get(signature)
+                if history:
+                    ordered = sorted(history)
+                    return ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+        return None
+
+    def start(self, task_uid, command_text, gpu_ids, started=None, predicted=None):
+        """記錄執行中任務；predicted 為其他來源（例如執行該任務的 agent）提供的預測秒數"""
+        if predicted is None:
+            predicted = self.predict(command_text)
+        with self._lock:
+            self._running[task_uid] = (list(gpu_ids or []), started or time.time(), predicted)
+
+    def finish(self, task_uid):
+        with self._lock:
+            self._running.pop(task_uid, None)
+
+    def expected_end(self, task_uid, now=None):
+        """執行中任務預計結束的時間；已超過預測時間的視為再過 BACKFILL_OVERRUN_GRACE 秒，無法預測時回傳 None"""
+        now = now or time.time()
+        with self._lock:
+            running = self._running.get(task_uid)
+        if running is None or running[2] is None:
+            return None
+        end = running[1] + running[2]
+        return end if end > now else now + BACKFILL_OVERRUN_GRACE
+
+    def gpu_free_at(self, now=None):
+        """{GPU: 其上本機任務預計全部結束的時間}；任一任務無法預測時該 GPU 為 None，沒有本機任務的 GPU 不列出"""
+        now = now or time.time()
+        with self._lock:
+            running = list(self._running.items())
+        free_at = {}
+        for task_uid, (gpu_ids, _, _) in running:
+            end = self.expected_end(task_uid, now)
+            for gpu_id in gpu_ids:
+                if gpu_id not in free_at:
+                    free_at[gpu_id] = end
+                elif free_at[gpu_id] is not None:
+                    free_at[gpu_id] = max(free_at[gpu_id], end) if end is not None else None
+        return free_at
+
+ANSI_ESCAPE_PATTERN = re.compile(r'\x1b\[[0-9;]*m')
+TOPOLOGY_GPU_LABEL = re.compile(r'GPU(\d+)')
+
+def parse_nvidia_smi_topo(output):
+    """解析 nvidia-smi topo -m 的矩陣，回傳 {GPU 編號: {GPU 編號: 連線類型}}
+
+    只取 GPU 之間的欄位，NIC 的欄與列、CPU/NUMA Affinity 與圖例都略過。
+    欄位以 tab 分隔，舊版驅動則以多個空白對齊。
+    範例：
+        \tGPU0\tGPU1\tGPU2\tGPU3\tCPU Affinity\tNUMA Affinity
+        GPU0\t X \tNV4\tNODE\tSYS\t0-15\t0
+        ...
+    """
+    columns = None
+    links = {}
+    for line in ANSI_ESCAPE_PATTERN.sub('', output).splitlines():
+        cells = [cell.strip() for cell in re.split(r'\t|\s{2,}', line.strip())]
+        if columns is None:
+            # 標題列：開頭連續的 GPU 欄位
+            if cells[0] == 'GPU0':
+                columns = [int(cell[3:]) for cell in itertools.takewhile(TOPOLOGY_GPU_LABEL.fullmatch, cells)]
+            continue
+        match = TOPOLOGY_GPU_LABEL.fullmatch(cells[0])
+        if match is None:
+            continue
+        gpu_id = int(match.group(1))
+        links[gpu_id] = {column: label for column, label in zip(columns, cells[1:]) if column != gpu_id}
+    return links
+
+def topology_link_score(label):
+    """連線類型的分數：NVLink > 同一個 PCIe switch > 同一個 NUMA 節點 > 跨 CPU socket"""
+    match = re.fullmatch(r'NV(\d+)', label or '')
+    if match:
+        return 100 + int(match.group(1))
+    return GPU_TOPOLOGY_LINK_SCORES.get(label, 0)
+
+class GpuTopology:
+    """GPU 之間的連線類型，第一次需要時執行 nvidia-smi topo -m 並快取
+
+    拓撲在開機後不會改變，所以成功讀取一次後就不再執行；失敗時隔 retry_interval 才重試。
+    collector 行程由收集引擎在背景讀取（background），查詢時不會自己執行 nvidia-smi 而卡住排程器。
+    """
+
+    def __init__(self, nvidia_smi_bin, timeout, retry_interval):
+        self.nvidia_smi_bin = nvidia_smi_bin
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.background = False
+        self._lock = threading.Lock()
+        self._links = None
+        self._failed_at = None
+        self.error = None
+
+    def load(self, output):
+        """解析並快取 nvidia-smi topo -m 的輸出"""
+        links = parse_nvidia_smi_topo(output)
+        if not links:
+            raise ValueError("no GPU rows in nvidia-smi topo -m output")
+        self._links = links
+        self.error = None
+        logger.info(f"Loaded GPU topology for {len(links)} GPUs")
+
+    def links(self):
+        """{GPU 編號: {GPU 編號: 連線類型}}，無法取得時回傳空 dict"""
+        if self._links is not None or self.background:
+            return self._links or {}
+        with self._lock:
+            if self._links is not None:
+                return self._links
+            if self._failed_at is not None and time.time() - self._failed_at < self.retry_interval:
+                return {}
+            try:
+                result = subprocess.run([self.nvidia_smi_bin, 'topo', '-m'], capture_output=True, text=True,
+                                        timeout=self.timeout)
+                if result.returncode != 0:
+                    raise RuntimeError(result.stderr.strip() or f"exit code {result.returncode}")
+                self.load(result.stdout)
+            except Exception as e:
+                self._failed_at = time.time()
+                self.error = str(e)
+                logger.warning(f"Could not read GPU topology: {e}")
+                return {}
+            return self._links
+
+    def affinity(self, a, b):
+        return topology_link_score(self.links().get(a, {}).get(b))
+
+
+gpu_snapshot_seq = 0  # 每發佈一次 GPU 快照遞增
+gpu_topology = GpuTopology(NVIDIA_SMI_BIN, GPU_TOPOLOGY_TIMEOUT, GPU_TOPOLOGY_RETRY_INTERVAL)
+gpu_reservations = GpuReservationLedger(GPU_RESERVATION_GRACE)
+runtime_predictor = RuntimePredictor(RUNTIME_SAMPLES, RUNTIME_PERCENTILE)
+fair_share = FairShareLedger(FAIR_SHARE_HALF_LIFE, FAIR_SHARE_PENALTY_PER_GPU,
+                             parse_fair_share_weights(FAIR_SHARE_WEIGHTS))
+scheduler_lock = threading.Lock()  # 確保同一時間只有一個排程迴圈在分配 GPU
+
+def process_memory_mib(proc):
+    """程序使用的顯示記憶體（MiB），nvidia-smi 無法取得（例如 N/A）時為 0"""
+    match = re.match(r'\d+', str(proc.get('mem', '')))
+    return int(match.group()) if match else 0
+
+def gpu_process_count(gpu_id):
+    """目前快照中在該 GPU 上的程序數"""
+    return sum(1 for proc in processes if proc.get('gpu') == gpu_id)
+
+def gpu_is_free(gpu_id, gpu_data):
+    """GPU 閒置且未被預約"""
+    return not gpu_data.get('in_use', True) and not gpu_reservations.is_reserved(gpu_id)
+
+def gpu_free_memory(gpu_id, gpu_data):
+    """可分配的記憶體（MiB），已扣除尚未反映在 nvidia-smi 的共用預約"""
+    free = gpu_data.get('mem_total', 0) - gpu_data.get('mem_used', 0)
+    return free - gpu_reservations.reserved_memory(gpu_id)
+
+def gpu_fits(gpu_id, gpu_data, required_memory=None, max_util=None):
+    """GPU 是否放得下任務
+
+    沒有宣告記憶體需求的任務維持原本的獨佔語意；有宣告的任務可以與其他程序共用 GPU，
+    只要剩餘記憶體足夠且使用率不超過 max_util。
+    """
+    if gpu_data.get('stale'):
+        # 收集器卡住，GPU 的實際狀態不明
+        return False
+    if required_memory is None:
+        if not gpu_is_free(gpu_id, gpu_data):
+            return False
+    else:
+        if gpu_reservations.has_exclusive(gpu_id):
+            return False
+        if gpu_free_memory(gpu_id, gpu_data) < required_memory:
+            return False
+    if max_util is not None and gpu_data.get('util', 100) > max_util:
+        return False
+    return True
+
+def pick_best_fit(candidates, required_memory=None, max_util=None):
+    """從候選 GPU 中挑出最適合的一張
+
+    有記憶體需求時選放入後剩餘記憶體最少的卡（best fit），讓大卡留給大任務；
+    獨佔任務則選總記憶體最小的閒置卡。
+    """
+    best_id = None
+    best_key = None
+    for gpu_id, gpu_data in candidates:
+        if not gpu_fits(gpu_id, gpu_data, required_memory, max_util):
+            continue
+        if required_memory is None:
+            key = (gpu_data.get('mem_total', 0), gpu_id)
+        else:
+            key = (gpu_free_memory(gpu_id, gpu_data) - required_memory, gpu_id)
+        if best_key is None or key < best_key:
+            best_id, best_key = gpu_id, key
+    if best_id is None:
+        return False, None
+    return True, [best_id]
+
+def parse_gpu_count(required_gpu):
+    """"count:N" 形式的 GPU 數量需求，其他格式回傳 None"""
+    match = re.fullmatch(r'count:(\d+)', required_gpu.strip().lower())
+    return int(match.group(1)) if match else None
+
+def gpu_node(gpu_id):
+    """GPU 所在的節點；單機模式下所有 GPU 都在同一個節點"""
+    return str(gpu_id).split('/', 1)[0] if isinstance(gpu_id, str) else ''
+
+def gpu_affinity(a, b):
+    """兩張 GPU 之間的連線分數，叢集模式下由 agent 回報的拓撲查詢"""
+    if cluster is not None:
+        return cluster.affinity(a, b)
+    return gpu_topology.affinity(a, b)
+
+def best_gpu_set(gpu_ids, count):
+    """在同一個節點的 gpu_ids 中挑出 count 張互連最好的組合，回傳 ((最差連線, 總分), 組合)
+
+    DDP 的 all-reduce 受最慢的那條連線限制，所以先比最差的一對，再比所有配對的總分；
+    同分時取編號較小的組合。組合數不多時窮舉，否則從每張卡出發貪婪地加入連線最好的卡。
+    """
+    pair = {}
+    for a, b in itertools.combinations(gpu_ids, 2):
+        pair[a, b] = pair[b, a] = gpu_affinity(a, b)
+    
+    def score(chosen):
+        scores = [pair[a, b] for a, b in itertools.combinations(chosen, 2)]
+        return min(scores), sum(scores)
+    
+    if math.comb(len(gpu_ids), count) <= GPU_PLACEMENT_SEARCH_LIMIT:
+        sets = itertools.combinations(gpu_ids, count)
+    else:
+        sets = []
+        for seed in gpu_ids:
+            chosen = [seed]
+            while len(chosen) < count:
+                chosen.append(max((gpu_id for gpu_id in gpu_ids if gpu_id not in chosen),
+                                  key=lambda gpu_id: (min(pair[gpu_id, c] for c in chosen),
+                                                      sum(pair[gpu_id, c] for c in chosen))))
+            sets.append(sorted(chosen, key=gpu_ids.index))
+    best_key = best_set = None
+    for chosen in sets:
+        key = score(chosen)
+        if best_key is None or key > best_key:
+            best_key, best_set = key, list(chosen)
+    return best_key, best_set
+
+def pick_gpu_set(candidates, count, required_memory=None, max_util=None):
+    """從候選 GPU 中挑出 count 張放得下且互連最好的組合（"count:N"）
+
+    叢集模式下只在同一個節點內挑選；多個節點都放得下時選互連最好的，
+    同分時選可用 GPU 最少的節點（best fit），把整台空的節點留給更大的任務。
+    """
+    if count < 1:
+        return False, None
+    if count == 1:
+        return pick_best_fit(candidates, required_memory, max_util)
+    nodes = {}
+    for gpu_id, gpu_data in candidates:
+        if gpu_fits(gpu_id, gpu_data, required_memory, max_util):
+            nodes.setdefault(gpu_node(gpu_id), []).append(gpu_id)
+    best_key = best_set = None
+    for gpu_ids in nodes.values():
+        if len(gpu_ids) < count:
+            continue
+        key, chosen = best_gpu_set(gpu_ids, count)
+        key += (-len(gpu_ids),)
+        if best_key is None or key > best_key:
+            best_key, best_set = key, chosen
+    if best_set is None:
+        return False, None
+    return True, best_set
+
+def check_gpu_availability(required_gpu, required_memory=None, max_util=None, exclude=()):
+    """檢查指定的GPU是否可用
+
+    required_memory（MiB）與 max_util（%）為選填，設定後任務可與其他程序共用 GPU。
+    exclude 中的 GPU（例如為排隊中的多 GPU 任務保留的卡）視為不可用。
+    """
     try:
         # 解析 required_gpu 字串，支援多種格式
         if required_gpu.lower() == 'any':
-            # 尋找任何可用的GPU
-            for gpu_id, gpu_data in gpu_info.items():
-                if not gpu_data.get('in_use', True):
-                    return True, [gpu_id]
-            return False, None
+            # 在所有GPU中挑選最適合的一張
+            return pick_best_fit([(gpu_id, gpu_data) for gpu_id, gpu_data in gpu_info.items()
+                                  if gpu_id not in exclude], required_memory, max_util)
+        
+        # 指定數量 (例如 "count:4")，依 GPU 互連挑選最好的組合
+        count = parse_gpu_count(required_gpu)
+        if count is not None:
+            return pick_gpu_set([(gpu_id, gpu_data) for gpu_id, gpu_data in gpu_info.items()
+                                 if gpu_id not in exclude], count, required_memory, max_util)
         
         # 檢查多GPU格式 (例如 "0,1,2" 或 "0,2")
         if ',' in required_gpu:
             gpu_ids = []
             try:
                 for gpu_str in required_gpu.split(','):
-                    gpu_id = int(gpu_str.strip())
+                    gpu_id = gpu_str.strip()
+                    if gpu_id not in gpu_info:
+                        gpu_id = int(gpu_id)
+                    if gpu_id in exclude:
+                        return False, None
                     if gpu_id in gpu_info:
                         gpu_data = gpu_info[gpu_id]
-                        if gpu_data.get('in_use', True):
-                            # 有任何一個GPU被佔用就不能執行
+                        if not gpu_fits(gpu_id, gpu_data, required_memory, max_util):
+                            # 有任何一個GPU放不下就不能執行
                             return False, None
                         gpu_ids.append(gpu_id)
                     else:
                         # GPU不存在
                         return False, None
+                # 叢集模式下多張 GPU 必須位於同一個節點
+                if len({str(gpu_id).split('/', 1)[0] for gpu_id in gpu_ids}) > 1:
+                    return False, None
                 # 所有GPU都可用
                 return len(gpu_ids) > 0, gpu_ids
             except ValueError:
                 # 解析失敗
                 return False, None
         
+        # 叢集模式的 GPU 鍵為 "節點/編號"
+        if required_gpu in exclude:
+            return False, None
+        if required_gpu in gpu_info:
+            return gpu_fits(required_gpu, gpu_info[required_gpu], required_memory, max_util), [required_gpu]
+        
         # 檢查特定GPU ID
         if required_gpu.isdigit():
             gpu_id = int(required_gpu)
-            if gpu_id in gpu_info:
+            if gpu_id in gpu_info and gpu_id not in exclude:
                 gpu_data = gpu_info[gpu_id]
-                return not gpu_data.get('in_use', True), [gpu_id]
+                return gpu_fits(gpu_id, gpu_data, required_memory, max_util), [gpu_id]
+            if cluster is not None:
+                # 叢集模式沒有單純編號的 GPU，不當作名稱比對（"0" 會比對到 "RTX 4070"）
+                return False, None
         
-        # 檢查GPU類型或名稱 (部分匹配)
-        for gpu_id, gpu_data in gpu_info.items():
-            if required_gpu.lower() in gpu_data.get('name', '').lower():
-                return not gpu_data.get('in_use', True), [gpu_id]
+        # 檢查GPU類型或名稱 (部分匹配)，在符合的GPU中挑選最適合的一張
+        matching = [(gpu_id, gpu_data) for gpu_id, gpu_data in gpu_info.items()
+                    if gpu_id not in exclude and required_gpu.lower() in gpu_data.get('name', '').lower()]
+        if matching:
+            return pick_best_fit(matching, required_memory, max_util)
         
         return False, None
         
@@ -399,72 +3446,280 @@ def check_gpu_availability(required_gpu):
         logger.error(f"Error checking GPU availability: {e}")
         return False, None
 
+# ========== 排程器 ==========
+
+scheduler_wakeup = threading.Event()
+scheduler_last_tick_time = 0.0  # 最後一次排程完成的 Unix 時間，供 /metrics 偵測排程停滯
+
+def request_schedule(reason):
+    """喚醒排程器；短時間內的多次喚醒會合併成一次排程"""
+    logger.debug(f"Scheduler wakeup: {reason}")
+    scheduler_wakeup.set()
+
+def on_task_exit(task_uid, execution_dir_name):
+    """任務結束：更新執行索引、釋放預約、放行（或取消）等待它的指令並喚醒排程器"""
+    row = None
+    try:
+        row = execution_index.update(execution_dir_name)
+    except Exception as e:
+        logger.error(f"Error updating execution index for task {task_uid}: {e}")
+    gpu_reservations.release(task_uid)
+    remote_launches.pop(task_uid, None)
+    fair_share.finish(task_uid)
+    runtime_predictor.finish(task_uid)
+    if row is not None:
+        if row['status'] == 'completed':
+            runtime_predictor.observe(row['directory'], row['command'], row['completed_time'])
+        finish_dependencies(task_uid, row['status'] == 'completed')
+    request_schedule(f"task {task_uid} exited")
+
+def task_state(task_uid):
+    """任務目前的狀態：queued、running、completed 或 failed，找不到時回傳 None"""
+    if command_store is not None and task_uid in command_store:
+        return 'queued'
+    if cluster is not None:
+        return cluster.task_state(task_uid)
+    row = execution_index.task_status(task_uid)
+    return row['status'] if row else None
+
+def finish_dependencies(task_uid, succeeded):
+    """上游任務結束：放行等待它的指令，要求成功但上游失敗時連帶取消"""
+    for uid, upstream in command_store.finish(task_uid, succeeded):
+        logger.warning(f"Cancelled task {uid}: upstream task {upstream} did not succeed")
+
+def reconcile_dependencies():
+    """補上漏接的結束事件：重新啟動期間結束、或剛好在新增指令時結束的上游任務"""
+    for upstream in command_store.awaited():
+        state = task_state(upstream)
+        if state in ('completed', 'failed'):
+            finish_dependencies(upstream, state == 'completed')
+        elif state is None:
+            logger.warning(f"Upstream task {upstream} not found, treating it as failed")
+            finish_dependencies(upstream, False)
+
+def run_scheduler():
+    """排程線程：佇列變更、任務結束或新的 GPU 快照時立即排程，定期排程僅作為備援"""
+    logger.info("Starting scheduler thread")
+    while True:
+        scheduler_wakeup.wait(timeout=SCHEDULER_FALLBACK_INTERVAL)
+        scheduler_wakeup.clear()
+        auto_execute_tasks()
+
+def on_command_queue_change(store, entry):
+    """佇列的任何變更都喚醒排程器
+
+    調整順序或優先權（update）會改變 backfill 保留給哪個任務；刪除 backfill 的對象會釋放保留的 GPU，
+    取消則可能放行 depends_condition='any' 的下游。
+    """
+    request_schedule(f"queue {entry.get('op')}")
+
+if command_store is not None:
+    command_store.add_listener(on_command_queue_change)
+
+def iter_heap_in_order(heap):
+    """不修改 heap，依序產生其中的項目；只走訪實際取用的部分，取出 k 個的成本為 O(k log k)"""
+    if not heap:
+        return
+    frontier = [(heap[0], 0)]
+    while frontier:
+        item, i = heapq.heappop(frontier)
+        yield item
+        for child in (2 * i + 1, 2 * i + 2):
+            if child < len(heap):
+                heapq.heappush(frontier, (heap[child], child))
+
+backfill_reservation = None  # 上一輪排程為其保留 GPU 的多 GPU 任務，供 /api/scheduler 顯示
+
+def requested_gpu_ids(required_gpu):
+    """明確列出的多張 GPU（例如 "0,1,2,3"）；其他格式或解析失敗時回傳 None"""
+    if ',' not in required_gpu:
+        return None
+    gpu_ids = []
+    for gpu_str in required_gpu.split(','):
+        gpu_id = gpu_str.strip()
+        if gpu_id not in gpu_info:
+            try:
+                gpu_id = int(gpu_id)
+            except ValueError:
+                return None
+        gpu_ids.append(gpu_id)
+    return gpu_ids
+
+def earliest_free_gpu_set(command, count, free_at, now):
+    """"count:N" 任務要保留的 GPU：同一個節點中最早能湊齊 count 張的時間，再從屆時空出的 GPU 中挑互連最好的組合
+
+    依序取現在就放得下的、可預測何時結束的、無法預測的 GPU；節點之間先比最早湊齊的時間，
+    再比組合的互連分數，與實際啟動時 pick_gpu_set 的挑法一致。
+    """
+    nodes = {}
+    for gpu_id, gpu_data in gpu_info.items():
+        if gpu_fits(gpu_id, gpu_data, command.get('required_memory'), command.get('max_util')):
+            rank = (0, now)
+        elif free_at.get(gpu_id) is not None:
+            rank = (1, free_at[gpu_id])
+        else:
+            rank = (2, 0)
+        nodes.setdefault(gpu_node(gpu_id), []).append((rank, gpu_id))
+    best_key = best_set = None
+    for ranked in nodes.values():
+        if len(ranked) < count:
+            continue
+        ready = sorted(rank for rank, _ in ranked)[count - 1]
+        eligible = [gpu_id for rank, gpu_id in ranked if rank <= ready]
+        if count > 1:
+            (worst, total), chosen = best_gpu_set(eligible, count)
+        else:
+            (worst, total), chosen = (0, 0), eligible[:1]
+        key = (ready, -worst, -total)
+        if best_key is None or key < best_key:
+            best_key, best_set = key, chosen
+    return best_set
+
+def plan_backfill_reservation(command, now):
+    """EASY backfill：為最前面放不下的多 GPU 任務保留它要的 GPU，並估計這些 GPU 全部空出的時間
+
+    明確列出 GPU 的任務保留那幾張；"count:N" 的任務保留最早全部空出的 N 張。
+
+    回傳 {'uid', 'gpu_ids', 'start'}；GPU 被無法預測的任務或外部程序佔用時 start 為 None，
+    這時保留的 GPU 不讓給任何任務。單張 GPU 的任務不做保留。
+    """
+    free_at = runtime_predictor.gpu_free_at(now)
+    gpu_ids = requested_gpu_ids(command['required_gpu'])
+    count = parse_gpu_count(command['required_gpu'])
+    if gpu_ids is None and count is not None:
+        gpu_ids = earliest_free_gpu_set(command, count, free_at, now)
+    if not gpu_ids or len(gpu_ids) < 2:
+        return None
+    start = now
+    for gpu_id in gpu_ids:
+        gpu_data = gpu_info.get(gpu_id)
+        if gpu_data is not None and gpu_fits(gpu_id, gpu_data, command.get('required_memory'), command.get('max_util')):
+            continue
+        if free_at.get(gpu_id) is None:
+            start = None
+            break
+        start = max(start, free_at[gpu_id])
+    return {'uid': command['uid'], 'gpu_ids': gpu_ids, 'start': start}
+
+def finishes_before(command, start, now):
+    """任務是否預計在 start 之前結束（沒有預測時視為不會）"""
+    if start is None:
+        return False
+    predicted = runtime_predictor.predict(command['command'])
+    return predicted is not None and now + predicted <= start
+
 def auto_execute_tasks():
-    """自動檢查並執行可用的任務"""
+    """自動檢查並執行可用的任務，一次排程盡可能啟動所有放得下的任務
+
+    最前面放不下的多 GPU 任務會保留它要的 GPU（EASY backfill），之後的任務只能使用其他 GPU，
+    或預計在保留開始前結束時才能使用保留的 GPU，避免單 GPU 任務不斷佔走而讓大任務餓死。
+    """
+    global scheduler_last_tick_time, backfill_reservation
+    if not scheduler_lock.acquire(blocking=False):
+        # 已有排程在進行，它會看到最新的佇列
+        return
+    tick_started = time.perf_counter()
+    reservation = None
     try:
-        commands = get_commands()
-        if not commands:
+        queues = command_store.owner_queues()
+        if not queues:
             return
         
-        for command in commands:
+        # 叢集模式下任務派送到 agent 執行
+        launch = cluster.launch if cluster is not None else execute_task
+        
+        # 每個擁有者依自己的 heap 順序提供下一個候選任務，再以「排序鍵 + 公平分配扣分」合併，
+        # 近期用得少的擁有者先挑；擁有者啟動任務後扣分立即增加
+        penalties = {owner: fair_share.penalty(owner) for owner in queues}
+        cursors = {owner: iter_heap_in_order(heap) for owner, heap in queues.items()}
+        candidates = []
+        
+        def advance(owner):
+            for key, uid in cursors[owner]:
+                command = command_store.current(uid, key)
+                if command is not None:
+                    heapq.heappush(candidates, ((key[0] + penalties[owner],) + key[1:], owner, command))
+                    return
+        
+        for owner in queues:
+            advance(owner)
+        
+        # 本輪已確認放不下的資源需求；啟動任務只會讓可用資源變少，不必再檢查同樣的需求
+        unavailable = set()
+        unavailable_outside = set()  # 避開保留的 GPU 時放不下的需求
+        now = time.time()
+        
+        while candidates:
+            _, owner, command = heapq.heappop(candidates)
             command_uid = command.get('uid')
             command_text = command.get('command')
             required_gpu = command.get('required_gpu')
+            requirement = (required_gpu, command.get('required_memory'), command.get('max_util'))
+            is_available = False
             
-            if not all([command_uid, command_text, required_gpu]):
-                continue
-            
-            # 檢查GPU是否可用
-            is_available, available_gpu_ids = check_gpu_availability(required_gpu)
-            
-            if is_available:
-                logger.info(f"GPU {available_gpu_ids} is available for task {command_uid}")
+            if all([command_uid, command_text, required_gpu]) and requirement not in unavailable:
+                # 檢查GPU是否可用（已預約的GPU視為使用中）
+                if reservation is None:
+                    is_available, available_gpu_ids = check_gpu_availability(*requirement)
+                    if not is_available:
+                        unavailable.add(requirement)
+                        if SCHEDULER_BACKFILL == 'easy':
+                            reservation = plan_backfill_reservation(command, now)
+                elif requirement not in unavailable_outside:
+                    is_available, available_gpu_ids = check_gpu_availability(*requirement, exclude=reservation['gpu_ids'])
+                    if not is_available:
+                        unavailable_outside.add(requirement)
                 
-                # 執行任務，傳遞實際使用的GPU ID列表
-                if execute_task(command_text, required_gpu, command_uid, available_gpu_ids):
-                    # 執行成功，移除任務
-                    if delete_command(command_uid):
-                        logger.info(f"Task {command_uid} executed and removed from queue")
+                # 只有保留的 GPU 放得下：預計在保留開始前結束才能插隊
+                if (not is_available and reservation is not None and requirement not in unavailable
+                        and finishes_before(command, reservation['start'], now)):
+                    is_available, available_gpu_ids = check_gpu_availability(*requirement)
+                    if not is_available:
+                        unavailable.add(requirement)
                     else:
-                        logger.error(f"Task {command_uid} executed but failed to remove from queue")
+                        logger.info(f"Backfilling task {command_uid} on reserved GPU {available_gpu_ids}")
+                
+                if is_available:
+                    logger.info(f"GPU {available_gpu_ids} is available for task {command_uid} (owner {owner})")
                     
-                    # 只執行一個任務，避免同時執行太多任務
-                    break
-                else:
-                    logger.error(f"Failed to execute task {command_uid}")
+                    # 先預約再啟動，同一輪後面的任務就不會分到同一張卡（或同一份記憶體）
+                    gpu_reservations.reserve(command_uid, available_gpu_ids, requirement[1])
+                    
+                    # 執行任務，傳遞實際使用的GPU ID列表
+                    if launch(command_text, required_gpu, command_uid, available_gpu_ids, task_info=command):
+                        penalties[owner] += fair_share.penalty_per_gpu * len(available_gpu_ids) / fair_share.weight(owner)
+                        # 執行成功，移除任務
+                        if delete_command(command_uid):
+                            logger.info(f"Task {command_uid} executed and removed from queue")
+                        else:
+                            logger.error(f"Task {command_uid} executed but failed to remove from queue")
+                    else:
+                        gpu_reservations.release(command_uid)
+                        logger.error(f"Failed to execute task {command_uid}")
+            
+            advance(owner)
     
     except Exception as e:
         logger.error(f"Error in auto_execute_tasks: {e}")
+    finally:
+        if reservation is not None and reservation['uid'] != (backfill_reservation or {}).get('uid'):
+            starts = 'unknown' if reservation['start'] is None else f"in {reservation['start'] - time.time():.0f}s"
+            logger.info(f"Reserving GPU {reservation['gpu_ids']} for task {reservation['uid']} (expected start {starts})")
+        backfill_reservation = reservation
+        scheduler_tick_seconds.observe(time.perf_counter() - tick_started)
+        scheduler_last_tick_time = time.time()
+        scheduler_lock.release()
 
 def update_command_order(command_uid, new_order):
     """更新指令的順序"""
-    commands = load_commands()
-    
-    # 找到要移動的指令
-    target_cmd = None
-    for cmd in commands:
-        if cmd.get('uid') == command_uid:
-            target_cmd = cmd
-            break
-    
-    if not target_cmd:
+    if command_uid not in command_store:
         logger.warning(f"Command not found for order update: UID={command_uid}")
         return False
     
-    # 移除目標指令
-    commands = [cmd for cmd in commands if cmd.get('uid') != command_uid]
-    
     # 確保new_order在有效範圍內
-    new_order = max(1, min(new_order, len(commands) + 1))
-    
-    # 在新位置插入指令
-    commands.insert(new_order - 1, target_cmd)
-    
-    # 重新排序所有指令的order字段
-    for i, cmd in enumerate(commands):
-        cmd['order'] = i + 1
+    new_order = max(1, min(new_order, len(command_store)))
     
-    success = save_commands(commands)
+    success = command_store.move(command_uid, new_order)
     if success:
         logger.info(f"Command order updated: UID={command_uid}, new_order={new_order}")
     else:
@@ -472,83 +3727,437 @@ def update_command_order(command_uid, new_order):
     
     return success
 
-def parse_disk_usage():
-    global disk_info
-    logger.info("Starting disk usage monitoring thread")
-    while True:
+# ========== 多節點叢集 ==========
+
+def parse_cluster_agents(spec):
+    """解析 CLUSTER_AGENTS（"name=http://host:port,..."，省略 name 時以 host:port 命名）"""
+    agents = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, url = item.partition('=')
+        if not sep:
+            name, url = '', item
+        parsed = urllib.parse.urlsplit(url if '://' in url else f"http://{url}")
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise ValueError(f"Invalid agent URL: {item}")
+        name = name.strip() or parsed.netloc
+        if '/' in name:
+            raise ValueError(f"Agent name must not contain '/': {name}")
+        agents.append((name, parsed))
+    return agents
+
+
+class AgentClient:
+    """對單一 agent 的 HTTP 客戶端，保留 keep-alive 連線重複使用"""
+
+    def __init__(self, name, url, timeout, token=None):
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+        self.token = token
+        self._idle = []  # 閒置的連線
+        self._lock = threading.Lock()
+
+        # 節點狀態
+        self.status = 'unknown'
+        self.last_seen = None
+        self.last_error = None
+        self.failures = 0
+        self.latency_ms = None
+        self.gpus = {}
+        self.processes = []
+        self.reservations = {}
+        self.topology = None  # agent 回報的 GPU 連線類型 {"0": {"1": "NV12"}}，取得一次即可
+
+    def _connect(self):
+        connection_class = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+        return connection_class(self.url.hostname, self.url.port, timeout=self.timeout)
+
+    def request(self, method, path, payload=None):
+        """送出請求並回傳 (status, JSON)；閒置連線可能已被伺服器關閉，失敗時以新連線重試一次"""
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        headers = {'Accept': 'application/json'}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        if self.token:
+            headers['X-Agent-Token'] = self.token
+
+        for attempt in range(2):
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            reused = connection is not None
+            if connection is None:
+                connection = self._connect()
+            try:
+                connection.request(method, self.url.path.rstrip('/') + path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, ConnectionError) as e:
+                connection.close()
+                if reused and attempt == 0 and not isinstance(e, http.client.ResponseNotReady):
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                with self._lock:
+                    self._idle.append(connection)
+            return response.status, json.loads(data) if data else None
+
+    def poll(self):
+        """取得 agent 的 GPU 狀態並更新節點狀態"""
+        started = time.perf_counter()
         try:
-            result = subprocess.run(["df", "-h"], capture_output=True, text=True)
-            output = result.stdout
-            
-            lines = output.strip().split('\n')
-            disk_info = []
-            
-            # 跳過標題行
-            for line in lines[1:]:
-                parts = line.split()
-                if len(parts) >= 6:
-                    filesystem = parts[0]
-                    size = parts[1]
-                    used = parts[2]
-                    available = parts[3]
-                    use_percent = parts[4].rstrip('%')
-                    mounted_on = parts[5]
-                    
-                    # 過濾掉一些系統檔案系統，只顯示主要磁碟
-                    if not filesystem.startswith(('tmpfs', 'udev', 'devpts', 'sysfs', 'proc', 'cgroup')):
-                        # 解析容量大小並過濾小於1GB的磁碟
-                        def parse_size_to_gb(size_str):
-                            """將容量字符串轉換為GB數值"""
-                            try:
-                                if size_str.endswith('G'):
-                                    return float(size_str[:-1])
-                                elif size_str.endswith('T'):
-                                    return float(size_str[:-1]) * 1024
-                                elif size_str.endswith('M'):
-                                    return float(size_str[:-1]) / 1024
-                                elif size_str.endswith('K'):
-                                    return float(size_str[:-1]) / (1024 * 1024)
-                                else:
-                                    # 如果沒有單位，假設是字節
-                                    return float(size_str) / (1024 * 1024 * 1024)
-                            except:
-                                return 0
-                        
-                        size_gb = parse_size_to_gb(size)
-                        
-                        # 只保留容量大於等於1GB的磁碟
-                        if size_gb >= 1.0:
-                            try:
-                                use_percent_int = int(use_percent)
-                            except ValueError:
-                                use_percent_int = 0
-                            
-                            disk_info.append({
-                                'filesystem': filesystem,
-                                'size': size,
-                                'used': used,
-                                'available': available,
-                                'use_percent': use_percent_int,
-                                'mounted_on': mounted_on
-                            })
-            
-            logger.debug(f"Disk usage updated: {len(disk_info)} disks")
-                        
+            status, data = self.request('GET', '/gpu_data')
+            if status != 200:
+                raise RuntimeError(f"HTTP {status}")
         except Exception as e:
-            logger.error(f"Error running df -h: {e}")
-            disk_info = []
-        
-        time.sleep(10)  # 磁碟資訊更新頻率較低
+            if self.status != 'down':
+                logger.warning(f"Cluster agent {self.name} is down: {e}")
+            self.status = 'down'
+            self.last_error = str(e)
+            self.failures += 1
+            return False
+        if self.status != 'up':
+            logger.info(f"Cluster agent {self.name} is up")
+        self.status = 'up'
+        self.last_error = None
+        self.failures = 0
+        self.last_seen = time.time()
+        self.latency_ms = round((time.perf_counter() - started) * 1000, 1)
+        self.gpus = data.get('gpus', {})
+        self.processes = data.get('processes', [])
+        self.reservations = data.get('reservations', {})
+        if self.topology is None:
+            self.poll_topology()
+        return True
 
-def parse_nvidia_smi():
-    global gpu_info, processes
-    logger.info("Starting NVIDIA SMI monitoring thread")
-    while True:
+    def poll_topology(self):
+        """取得 agent 的 GPU 拓撲；agent 也讀不到時留到下一次輪詢再試"""
+        try:
+            status, data = self.request('GET', '/api/topology')
+        except Exception as e:
+            logger.debug(f"Could not get topology from cluster agent {self.name}: {e}")
+            return
+        if status == 200 and data and data.get('success'):
+            self.topology = data.get('links', {})
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'url': urllib.parse.urlunsplit(self.url),
+            'status': self.status,
+            'last_seen': self.last_seen,
+            'last_error': self.last_error,
+            'failures': self.failures,
+            'latency_ms': self.latency_ms,
+            'gpu_count': len(self.gpus)
+        }
+
+
+class ClusterAggregator:
+    """聚合多個 agent 的 GPU 狀態，並把全域佇列的任務派送到放得下的節點
+
+    GPU 以 "節點/編號" 為鍵合併進 gpu_info，所以預約帳本、best fit 與儀表板都沿用原本的邏輯；
+    agent 回報的預約會視為該 GPU 已被佔用（或已用掉那份記憶體）。
+    """
+
+    def __init__(self, agents, poll_interval, timeout, token=None):
+        self.poll_interval = poll_interval
+        self.agents = {name: AgentClient(name, url, timeout, token) for name, url in agents}
+        self._pool = ThreadPoolExecutor(max_workers=max(1, len(self.agents)), thread_name_prefix='cluster')
+        self._inflight = {}  # 結果不明的派送：task uid -> 節點名稱，之後只重送到同一個節點
+        self._launched = {}  # 已派送且有指令依賴的任務：task uid -> 節點名稱
+        self._remote = {}    # 已派送、尚未確認結束的任務：task uid -> 節點名稱，結束後不再計入預測
+
+    def poll_all(self):
+        """同時向所有 agent 取得狀態並發佈合併後的叢集快照"""
+        futures = [self._pool.submit(agent.poll) for agent in self.agents.values()]
+        for future in futures:
+            future.result()
+
+        merged_gpus = {}
+        merged_processes = []
+        for name, agent in self.agents.items():
+            if agent.status != 'up':
+                continue
+            for gpu_id, gpu_data in agent.gpus.items():
+                merged_gpus[f"{name}/{gpu_id}"] = dict(gpu_data, node=name)
+            for proc in agent.processes:
+                merged_processes.append(dict(proc, gpu=f"{name}/{proc.get('gpu')}", node=name))
+            # agent 自己的預約（本機排程或其他來源的派送）還沒反映在 nvidia-smi 上
+            for reservation in agent.reservations.values():
+                for gpu_id in reservation.get('gpu_ids', []):
+                    gpu_data = merged_gpus.get(f"{name}/{gpu_id}")
+                    if gpu_data is None:
+                        continue
+                    if reservation.get('memory') is None:
+                        gpu_data['in_use'] = True
+                    else:
+                        # 任務已用掉的部分已經算在 mem_used 裡（JSON 的鍵是字串）
+                        used = reservation.get('used', {}).get(str(gpu_id), 0)
+                        gpu_data['mem_used'] = gpu_data.get('mem_used', 0) + max(0, reservation['memory'] - used)
+        publish_gpu_snapshot(merged_gpus, merged_processes)
+
+    def run(self):
+        logger.info(f"Starting cluster aggregator for {len(self.agents)} agents")
+        while True:
+            try:
+                self.poll_all()
+            except Exception as e:
+                logger.error(f"Error polling cluster agents: {e}")
+            time.sleep(self.poll_interval)
+
+    def affinity(self, a, b):
+        """同一個節點上兩張 GPU 的連線分數，不同節點或拓撲未知時為 0"""
+        node, _, a_index = a.partition('/')
+        b_node, _, b_index = b.partition('/')
+        agent = self.agents.get(node)
+        if node != b_node or agent is None or not agent.topology:
+            return 0
+        return topology_link_score(agent.topology.get(a_index, {}).get(b_index))
+
+    def launch(self, command_text, required_gpu, task_uid, actual_gpu_ids=None, task_info=None):
+        """把任務派送到 GPU 所在的 agent，與 execute_task 相同以布林值回報是否已啟動"""
+        nodes = {gpu_id.split('/', 1)[0] for gpu_id in actual_gpu_ids or []}
+        if len(nodes) != 1:
+            logger.error(f"Task {task_uid} must be placed on exactly one node, got {sorted(nodes)}")
+            return False
+        node = nodes.pop()
+        pinned = self._inflight.get(task_uid)
+        if pinned is not None and pinned != node:
+            # 上次派送結果不明，為避免重複執行只能送回同一個節點
+            logger.debug(f"Task {task_uid} is pinned to {pinned}, not launching on {node}")
+            return False
+
+        task_info = task_info or command_store.get(task_uid) or {}
+        payload = {
+            'uid': task_uid,
+            'command': command_text,
+            'required_gpu': required_gpu,
+            'gpu_ids': [int(gpu_id.split('/', 1)[1]) for gpu_id in actual_gpu_ids],
+            'required_memory': task_info.get('required_memory'),
+            'max_util': task_info.get('max_util'),
+            'created_at': task_info.get('created_at'),
+            'owner': task_info.get('owner', DEFAULT_COMMAND_OWNER),
+            'priority': task_info.get('priority', 0)
+        }
+        agent = self.agents[node]
+        try:
+            status, data = agent.request('POST', '/api/agent/launch', payload)
+        except Exception as e:
+            # 請求可能已送達，agent 以 uid 去重，之後重送到同一節點是安全的
+            self._inflight[task_uid] = node
+            agent.status = 'down'
+            agent.last_error = str(e)
+            logger.error(f"Launch of task {task_uid} on {node} failed: {e}")
+            task_launch_failures.inc()
+            return False
+
+        self._inflight.pop(task_uid, None)
+        if status == 200 and data and data.get('success'):
+            logger.info(f"Task {task_uid} launched on {node} GPUs {payload['gpu_ids']}")
+            if task_uid in command_store.awaited():
+                self._launched[task_uid] = node
+            # agent 以自己的執行歷史預測，backfill 保留才能算出開始時間
+            runtime_predictor.start(task_uid, command_text, actual_gpu_ids, predicted=data.get('predicted_runtime'))
+            fair_share.start(task_uid, payload['owner'], len(actual_gpu_ids))
+            self._remote[task_uid] = node
+            task_launches.inc()
+            return True
+        logger.warning(f"Agent {node} rejected task {task_uid}: {(data or {}).get('error', f'HTTP {status}')}")
+        task_launch_failures.inc()
+        return False
+
+    def task_state(self, task_uid):
+        """向執行該任務的 agent 查詢狀態；不知道節點時詢問所有 agent，有 agent 連不上就視為仍在執行"""
+        if task_uid in self._inflight:
+            return 'running'
+        node = self._launched.get(task_uid)
+        nodes = [node] if node is not None else list(self.agents)
+        unreachable = False
+        for name in nodes:
+            try:
+                status, data = self.agents[name].request('GET', f"/api/tasks/{urllib.parse.quote(task_uid)}")
+            except Exception as e:
+                logger.debug(f"Error querying task {task_uid} on {name}: {e}")
+                unreachable = True
+                continue
+            if status == 200 and data and data.get('success'):
+                state = data.get('state')
+                if state in ('completed', 'failed'):
+                    self._launched.pop(task_uid, None)
+                return state
+        return 'running' if unreachable else None
+
+    def reconcile_running(self):
+        """向有派送任務的 agent 取得執行中任務，已結束的任務不再計入預測的 GPU 釋放時間，並記入擁有者的公平分配用量"""
+        for name in set(self._remote.values()):
+            try:
+                status, data = self.agents[name].request('GET', '/api/tasks/running')
+            except Exception as e:
+                logger.debug(f"Error listing running tasks on {name}: {e}")
+                continue
+            if status != 200 or not data or not data.get('success'):
+                continue
+            running = {task.get('task_uid') for task in data.get('tasks', [])}
+            for task_uid, node in list(self._remote.items()):
+                if node == name and task_uid not in running:
+                    self._remote.pop(task_uid, None)
+                    runtime_predictor.finish(task_uid)
+                    fair_share.finish(task_uid)
+
+    def describe(self):
+        return [agent.describe() for agent in self.agents.values()]
+
+
+cluster = None
+if CLUSTER_ROLE == 'aggregator':
+    cluster = ClusterAggregator(parse_cluster_agents(CLUSTER_AGENTS), CLUSTER_POLL_INTERVAL,
+                                CLUSTER_TIMEOUT, AGENT_TOKEN or None)
+remote_launches = {}  # agent 已接受、仍在執行的遠端派送：task uid -> 分配的 GPU，用於去重
+
+def format_bytes(num_bytes):
+    """以 df -h 的格式顯示容量（1024 進位，小於 10 時保留一位小數）"""
+    value = float(num_bytes)
+    for unit in ('', 'K', 'M', 'G', 'T', 'P'):
+        if value < 1024 or unit == 'P':
+            break
+        value /= 1024
+    if unit == '':
+        return f"{int(value)}"
+    return f"{value:.1f}{unit}" if value < 10 else f"{value:.0f}{unit}"
+
+def read_mountinfo(path="/proc/self/mountinfo"):
+    """讀取掛載點清單，過濾虛擬檔案系統，同一裝置只保留最短的掛載路徑"""
+    mounts = {}
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            # 格式：id parent major:minor root mount_point options [optional...] - fstype source super_options
+            left, _, right = line.partition(' - ')
+            left_fields = left.split()
+            right_fields = right.split()
+            if len(left_fields) < 5 or len(right_fields) < 2:
+                continue
+            device = left_fields[2]
+            # 路徑中的空白等字元以八進位跳脫（例如 \040）
+            mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), left_fields[4])
+            fstype, source = right_fields[0], right_fields[1]
+            if fstype in DISK_PSEUDO_FILESYSTEMS:
+                continue
+            current = mounts.get(device)
+            if current is None or len(mount_point) < len(current['mounted_on']):
+                mounts[device] = {'filesystem': source, 'fstype': fstype, 'mounted_on': mount_point}
+    return list(mounts.values())
+
+
+class DiskCollector:
+    """以 os.statvfs 讀取各掛載點的容量
+
+    每個掛載點的 statvfs 在自己的 daemon 執行緒中執行並有逾時，上一次還沒回來就不會再送出，
+    所以卡住的網路掛載永遠只佔用一個執行緒，也不會讓其他掛載點排隊等待。
+    期間沿用該掛載點上一次的結果並標記為 stale，逾時後才回來的結果在下一次收集時採用。
+    """
+
+    def __init__(self, timeout, refresh_interval):
+        self.timeout = timeout
+        self.refresh_interval = refresh_interval
+        self._cache = {}  # mount_point -> {'data', 'refreshed_at', 'future'}
+
+    def _submit(self, mount):
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self._statvfs(mount))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name=f"statvfs {mount['mounted_on']}", daemon=True).start()
+        return future
+
+    @staticmethod
+    def _harvest(entry, mount_point, timeout=0):
+        """取得 statvfs 的結果，逾時仍未完成時保留 future 下次再取"""
         try:
-            result = subprocess.run(["nvidia-smi"], capture_output=True, text=True)
-            output = result.stdout
+            entry['data'] = entry['future'].result(timeout=timeout)
+        except FutureTimeoutError:
+            logger.warning(f"statvfs timed out on {mount_point}")
+            return
+        except OSError as e:
+            logger.debug(f"statvfs failed on {mount_point}: {e}")
+            entry['data'] = None
+        entry['refreshed_at'] = time.monotonic()
+        entry['future'] = None
+
+    @staticmethod
+    def _statvfs(mount):
+        st = os.statvfs(mount['mounted_on'])
+        size = st.f_blocks * st.f_frsize
+        available = st.f_bavail * st.f_frsize
+        used = (st.f_blocks - st.f_bfree) * st.f_frsize
+        # 與 df 相同：以使用者可用空間計算使用率並無條件進位
+        usable = used + available
+        use_percent = -(-used * 100 // usable) if usable else 0
+        return dict(mount, **{
+            'size_bytes': size,
+            'used_bytes': used,
+            'available_bytes': available,
+            'size': format_bytes(size),
+            'used': format_bytes(used),
+            'available': format_bytes(available),
+            'use_percent': use_percent,
+            'stale': False
+        })
+
+    def collect(self):
+        now = time.monotonic()
+        mounts = read_mountinfo()
+        pending = []
+        for mount in mounts:
+            mount_point = mount['mounted_on']
+            entry = self._cache.setdefault(mount_point, {'data': None, 'refreshed_at': None, 'future': None})
+            if entry['future'] is not None:
+                if not entry['future'].done():
+                    continue  # 上一次的 statvfs 還沒回來
+                # 上一次逾時後才完成，先採用它的結果
+                self._harvest(entry, mount_point)
+                now = time.monotonic()
+            if entry['refreshed_at'] is None or now - entry['refreshed_at'] >= self.refresh_interval:
+                entry['future'] = self._submit(mount)
+                pending.append(mount_point)
 
-#             output = """Sun Aug  3 15:39:03 2025
+        deadline = time.monotonic() + self.timeout
+        for mount_point in pending:
+            self._harvest(self._cache[mount_point], mount_point, max(0, deadline - time.monotonic()))
+
+        # 移除已卸載的掛載點
+        current = {mount['mounted_on'] for mount in mounts}
+        for mount_point in list(self._cache):
+            if mount_point not in current:
+                del self._cache[mount_point]
+
+        disks = []
+        for mount_point, entry in self._cache.items():
+            data = entry['data']
+            if data is None or data['size_bytes'] < DISK_MIN_SIZE_BYTES:
+                continue
+            stuck = entry['future'] is not None and not entry['future'].done()
+            disks.append(dict(data, stale=stuck))
+        disks.sort(key=lambda disk: disk['size_bytes'], reverse=True)
+        return disks
+
+
+disk_collector = DiskCollector(DISK_STATVFS_TIMEOUT, DISK_MOUNT_REFRESH_INTERVAL)
+
+def parse_nvidia_smi_table(output):
+    """解析 nvidia-smi 預設的文字表格輸出，回傳 (gpu_info, processes)"""
+#     output = """Sun Aug  3 15:39:03 2025
 # +-----------------------------------------------------------------------------------------+
 # | NVIDIA-SMI 570.133.07             Driver Version: 570.133.07     CUDA Version: 12.8     |
 # |-----------------------------------------+------------------------+----------------------+
@@ -606,96 +4215,784 @@ def parse_nvidia_smi():
 # +-----------------------------------------------------------------------------------------+
 # """
 
-            lines = output.strip().split('\n')
+    lines = output.strip().split('\n')
+
+    new_gpu_info = {}
+    new_processes = []
+
+    # ---------- Parse GPU summary ----------
+    for i, line in enumerate(lines):
+        if re.match(r"\|\s+\d+\s+", line):
+            try:
+                idx = int(line.split()[1])
+                next_line = lines[i + 1] if i + 1 < len(lines) else ""
+                mem_info_match = re.search(r"(\d+)MiB\s*/\s*(\d+)MiB", next_line)
+                # 第一個百分比是風扇轉速，GPU-Util 在 Memory-Usage 欄位之後
+                util_match = re.search(r"MiB\s*\|\s*(\d+)%", next_line)
+
+                if mem_info_match:
+                    mem_used = int(mem_info_match.group(1))
+                    mem_total = int(mem_info_match.group(2))
+                    mem_percent = round(mem_used / mem_total * 100, 1) if mem_total > 0 else 0.0
+                    util = int(util_match.group(1)) if util_match else 0
+
+                    new_gpu_info[idx] = {
+                        'name': f'GPU {idx}',
+                        'mem_total': mem_total,
+                        'mem_used': mem_used,
+                        'mem_percent': mem_percent,
+                        'util': util,
+                        'in_use': False
+                    }
+            except Exception as e:
+                logger.error(f"GPU summary parse error: {e}")
+                nvidia_smi_parse_errors.inc('table')
+
+    # ---------- Parse Processes block (new format) ----------
+    # 找到 Processes 區塊；沒有任何程序時部分驅動版本不會輸出此區塊
+    if "Processes:" not in output:
+        return new_gpu_info, new_processes
+    processes_block = output.split("Processes:", 1)[1].strip()
+
+    # 每行為一筆 process，跳過表頭與分隔線
+    lines = processes_block.splitlines()
+    process_lines = [
+        line for line in lines if re.match(r"\|\s+\d+", line)
+    ]
+
+    for line in process_lines:
+        # 用正則表達式擷取欄位資料；GI/CI 在 MIG 模式下為數字，否則為 N/A
+        match = re.match(
+            r"\|\s*(\d+)\s+(?:N/A|\d+)\s+(?:N/A|\d+)\s+(\d+)\s+(\w+)\s+(.+?)\s+(\d+MiB|N/A)\s*\|", line
+        )
+        if match:
+            gpu_id, pid, ptype, pname, mem_usage = match.groups()
+            new_processes.append({
+                'gpu': int(gpu_id),
+                'pid': int(pid),
+                'type': ptype,
+                'name': pname.strip(),
+                'mem': mem_usage
+            })
+
+            # 標記 GPU 使用狀態
+            if int(gpu_id) in new_gpu_info:
+                new_gpu_info[int(gpu_id)]['in_use'] = True
+
+    return new_gpu_info, new_processes
+
+def parse_gpu_query_row(row):
+    """解析一筆 --query-gpu CSV 資料，回傳 (uuid, gpu_id, gpu_data)"""
+    fields = [field.strip() for field in row.split(',')]
+    if len(fields) < len(NVIDIA_SMI_GPU_FIELDS):
+        raise ValueError(f"Unexpected --query-gpu row: {row!r}")
+    _, idx, gpu_uuid, name, mem_used, mem_total, util = fields[:len(NVIDIA_SMI_GPU_FIELDS)]
+
+    def to_int(value):
+        # 不支援的欄位會回報 [N/A] 或 [Not Supported]
+        try:
+            return int(float(value))
+        except ValueError:
+            return 0
+
+    mem_used = to_int(mem_used)
+    mem_total = to_int(mem_total)
+    return gpu_uuid, int(idx), {
+        'name': name,
+        'mem_total': mem_total,
+        'mem_used': mem_used,
+        'mem_percent': round(mem_used / mem_total * 100, 1) if mem_total > 0 else 0.0,
+        'util': to_int(util),
+        'in_use': False
+    }
+
+def parse_compute_app_row(row):
+    """解析一筆 --query-compute-apps CSV 資料，回傳 (gpu_uuid, process)"""
+    fields = [field.strip() for field in row.split(',')]
+    if len(fields) < len(NVIDIA_SMI_APP_FIELDS):
+        raise ValueError(f"Unexpected --query-compute-apps row: {row!r}")
+    # 程序名稱可能含有逗號，其餘欄位數固定
+    _, gpu_uuid, pid = fields[:3]
+    used_memory = fields[-1]
+    process_name = ','.join(fields[3:-1])
+    return gpu_uuid, {
+        'pid': int(pid),
+        'type': 'C',
+        'name': process_name,
+        'mem': f"{used_memory}MiB" if used_memory.isdigit() else used_memory
+    }
+
+# ========== GPU 遙測歷史 ==========
+
+class RingSeries:
+    """固定容量的環形時間序列，每個欄位各用一個 array 儲存，寫滿後覆蓋最舊的樣本"""
+
+    FIELDS = ('util', 'util_max', 'mem_used', 'procs')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.columns = {field: array('d', bytes(8 * capacity)) for field in self.FIELDS}
+        self.start = 0  # 最舊樣本的實體位置
+        self.count = 0
+
+    def append(self, timestamp, values):
+        if self.count < self.capacity:
+            pos = (self.start + self.count) % self.capacity
+            self.count += 1
+        else:
+            pos = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.timestamps[pos] = timestamp
+        for field in self.FIELDS:
+            self.columns[field][pos] = values[field]
+
+    def oldest(self):
+        return self.timestamps[self.start] if self.count else None
+
+    def _first_at_or_after(self, since):
+        """二分搜尋第一個時間戳 >= since 的邏輯位置"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[(self.start + mid) % self.capacity] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _slice(self, data, lo):
+        # 環形緩衝區最多分成兩段連續切片
+        begin = (self.start + lo) % self.capacity
+        end = begin + (self.count - lo)
+        if end <= self.capacity:
+            return data[begin:end]
+        return data[begin:] + data[:end - self.capacity]
+
+    def since(self, since):
+        lo = self._first_at_or_after(since)
+        series = {'timestamps': self._slice(self.timestamps, lo).tolist()}
+        for field in self.FIELDS:
+            series[field] = self._slice(self.columns[field], lo).tolist()
+        return series
+
+
+class GpuHistory:
+    """每張 GPU 的多解析度遙測歷史（原始樣本、1 分鐘、15 分鐘平均），記憶體用量固定"""
+
+    def __init__(self, tiers):
+        self.tiers = tiers  # ((名稱, 桶大小秒數, 容量), ...)，第一層為原始樣本
+        self._lock = threading.Lock()
+        self._series = {}  # gpu_id -> {tier 名稱: RingSeries}
+        self._buckets = {}  # gpu_id -> {tier 名稱: 尚未寫入的累積桶}
+        self._busy_at = {}  # gpu_id -> 最後一次有使用率或程序的時間
+
+    def record(self, gpu_snapshot, gpu_processes, timestamp=None):
+        timestamp = timestamp or time.time()
+        proc_counts = {}
+        for proc in gpu_processes:
+            proc_counts[proc.get('gpu')] = proc_counts.get(proc.get('gpu'), 0) + 1
+
+        with self._lock:
+            for gpu_id, gpu_data in gpu_snapshot.items():
+                if gpu_id not in self._series:
+                    self._series[gpu_id] = {name: RingSeries(capacity) for name, _, capacity in self.tiers}
+                    self._buckets[gpu_id] = {}
+                    self._busy_at[gpu_id] = timestamp
+                util = gpu_data.get('util', 0)
+                procs = proc_counts.get(gpu_id, 0)
+                sample = {'util': util, 'util_max': util, 'mem_used': gpu_data.get('mem_used', 0), 'procs': procs}
+                if util > 0 or procs > 0 or gpu_data.get('in_use'):
+                    self._busy_at[gpu_id] = timestamp
+
+                raw_name = self.tiers[0][0]
+                self._series[gpu_id][raw_name].append(timestamp, sample)
+                for name, bucket_seconds, _ in self.tiers[1:]:
+                    self._accumulate(gpu_id, name, bucket_seconds, timestamp, sample)
+
+    def _accumulate(self, gpu_id, name, bucket_seconds, timestamp, sample):
+        bucket_start = timestamp - timestamp % bucket_seconds
+        bucket = self._buckets[gpu_id].get(name)
+        if bucket is not None and bucket['start'] != bucket_start:
+            # 桶已結束，寫入平均值
+            n = bucket['n']
+            self._series[gpu_id][name].append(bucket['start'], {
+                'util': round(bucket['util'] / n, 1),
+                'util_max': bucket['util_max'],
+                'mem_used': round(bucket['mem_used'] / n, 1),
+                'procs': round(bucket['procs'] / n, 2)
+            })
+            bucket = None
+        if bucket is None:
+            bucket = {'start': bucket_start, 'n': 0, 'util': 0, 'util_max': 0, 'mem_used': 0, 'procs': 0}
+            self._buckets[gpu_id][name] = bucket
+        bucket['n'] += 1
+        bucket['util'] += sample['util']
+        bucket['util_max'] = max(bucket['util_max'], sample['util_max'])
+        bucket['mem_used'] += sample['mem_used']
+        bucket['procs'] += sample['procs']
+
+    def resolution_for(self, since):
+        """涵蓋 since 的最細解析度
+
+        沒有任何一層涵蓋 since 時（例如剛啟動、粗的層還沒有完成的桶），改用有樣本的最細一層；
+        較粗的層要在最舊的桶結束前就已經有資料，才代表它保留了更早的歷史。
+        """
+        fallback, fallback_oldest = self.tiers[0][0], None
+        with self._lock:
+            for name, bucket_seconds, _ in self.tiers:
+                oldest = [series[name].oldest() for series in self._series.values() if series[name].count]
+                if not oldest:
+                    continue
+                if min(oldest) <= since:
+                    return name
+                # 桶的時間戳記是起點，加上桶大小才是該桶確實涵蓋到的時間
+                if fallback_oldest is None or min(oldest) + bucket_seconds < fallback_oldest:
+                    fallback, fallback_oldest = name, min(oldest) + bucket_seconds
+        return fallback
+
+    def query(self, gpu_ids, since, resolution):
+        if resolution not in [name for name, _, _ in self.tiers]:
+            raise ValueError(f"Unknown resolution: {resolution}")
+        now = time.time()
+        result = {}
+        with self._lock:
+            for gpu_id in (gpu_ids if gpu_ids is not None else sorted(self._series)):
+                if gpu_id not in self._series:
+                    continue
+                series = self._series[gpu_id][resolution].since(since)
+                series['idle_seconds'] = round(now - self._busy_at[gpu_id], 1)
+                result[gpu_id] = series
+        return result
+
+
+gpu_history = GpuHistory(GPU_HISTORY_TIERS)
+
+def tag_task_processes(new_processes):
+    """依程序的 session 找出它屬於哪個本機任務，記在 task 欄位
+
+    聚合器收到的程序已由 agent 標記，本機沒有監督中的任務時不必查詢。
+    """
+    sessions = task_supervisor.sessions()
+    if not sessions:
+        return
+    for proc in new_processes:
+        if 'task' in proc:
+            continue
+        try:
+            task_uid = sessions.get(os.getsid(proc['pid']))
+        except (OSError, KeyError, TypeError):
+            continue
+        if task_uid is not None:
+            proc['task'] = task_uid
+
+def publish_gpu_snapshot(new_gpu_info, new_processes):
+    """發佈新的 GPU 狀態並觸發排程"""
+    global gpu_info, processes, gpu_snapshot_seq
+    tag_task_processes(new_processes)
+    gpu_info = new_gpu_info
+    processes = new_processes
+    gpu_snapshot_seq += 1
+    gpu_reservations.reconcile(processes, gpu_snapshot_seq)
+    gpu_history.record(gpu_info, processes)
+    logger.debug(f"GPU data updated: {len(gpu_info)} GPUs, {len(processes)} processes")
+    broadcaster.publish('gpu', {'gpus': gpu_info, 'processes': processes})
+
+    # 新的 GPU 狀態可能讓佇列中的任務變得可執行
+    request_schedule("gpu snapshot")
+
+def publish_gpu_error(e):
+    """nvidia-smi 失敗時發佈錯誤狀態"""
+    global gpu_info, processes
+    gpu_info = {
+        0: {
+            'name': f"GPU error - {str(e)}",
+            'mem_total': 0,
+            'mem_used': 0,
+            'mem_percent': 0,
+            'util': 0,
+            'in_use': False
+        }
+    }
+    processes = []
+    broadcaster.publish('gpu', {'gpus': gpu_info, 'processes': processes})
+
+
+# ========== 收集引擎 ==========
+
+class CollectorHealth:
+    """單一收集器的健康狀態：最後成功時間、連續失敗與逾時次數"""
+
+    def __init__(self, name, stale_after=None, on_stale=None):
+        self.name = name
+        self.stale_after = stale_after  # 超過這麼久沒有成功即為 stale（秒），None 表示不檢查
+        self.on_stale = on_stale
+        self.created = time.time()
+        self.last_success = None
+        self.last_failure = None
+        self.last_error = None
+        self.last_duration = None
+        self.consecutive_failures = 0
+        self.runs = 0
+        self.timeouts = 0
+        self.consecutive_timeouts = 0
+        self.stale = False
+        self.process = None  # 最近一次探針啟動的子程序，被強制結束後仍未退出時不再啟動新的探針
+
+    def success(self, duration=None):
+        self.runs += 1
+        self.last_success = time.time()
+        self.last_duration = duration
+        self.consecutive_failures = 0
+        self.consecutive_timeouts = 0
+        if self.stale:
+            logger.info(f"Collector {self.name} recovered")
+            self.stale = False
+
+    def failure(self, error, timed_out=False, duration=None):
+        self.runs += 1
+        self.last_failure = time.time()
+        self.last_error = error
+        self.last_duration = duration
+        self.consecutive_failures += 1
+        if timed_out:
+            self.timeouts += 1
+            self.consecutive_timeouts += 1
+        else:
+            self.consecutive_timeouts = 0
+        collector_failures.inc(self.name, 'timeout' if timed_out else 'error')
+
+    def check_stale(self, now):
+        """由 watchdog 定期呼叫；剛變成 stale 時觸發 on_stale"""
+        if self.stale_after is None or self.stale:
+            return
+        silent_for = now - (self.last_success or self.created)
+        if silent_for > self.stale_after:
+            self.stale = True
+            logger.warning(f"Collector {self.name} is stale: no data for {silent_for:.0f}s "
+                           f"({self.last_error or 'no error reported'})")
+            if self.on_stale is not None:
+                self.on_stale()
+
+    @property
+    def status(self):
+        if self.stale:
+            return 'stale'
+        if self.consecutive_failures:
+            return 'failing'
+        if self.last_success is None:
+            return 'starting'
+        return 'ok'
+
+    def describe(self):
+        return {
+            'status': self.status,
+            'last_success': self.last_success,
+            'last_failure': self.last_failure,
+            'last_error': self.last_error,
+            'last_duration_ms': round(self.last_duration * 1000, 1) if self.last_duration is not None else None,
+            'consecutive_failures': self.consecutive_failures,
+            'runs': self.runs,
+            'timeouts': self.timeouts,
+            'consecutive_timeouts': self.consecutive_timeouts,
+            'stale_after': self.stale_after
+        }
+
+
+class CollectorEngine:
+    """在單一 asyncio 事件迴圈上執行所有收集器（GPU、程序、磁碟、拓撲）
+
+    各收集器彼此獨立、同時執行。週期性探針以抖動的間隔重複，每次都有硬性逾時，
+    逾時即取消並強制結束它啟動的子程序；卡住的探針只會讓自己的資料變成 stale，
+    不會拖住其他探針或排程器。卡在驅動裡的程序連 SIGKILL 都可能無效，所以上一次的子程序
+    還沒退出前不會再啟動新的，連續逾時時間隔也會加倍，避免程序越積越多。
+    """
+
+    def __init__(self, jitter, watchdog_interval=1):
+        self.jitter = jitter
+        self.watchdog_interval = watchdog_interval
+        self.health = {}
+        self._runners = []
+
+    def periodic(self, name, collect, interval, timeout, on_stale=None, once=False):
+        """註冊週期性探針，collect 為 async 函式；once 的探針成功一次後就停止（例如拓撲）"""
+        stale_after = None if once else interval * COLLECTOR_STALE_INTERVALS + timeout
+        health = self.health[name] = CollectorHealth(name, stale_after, on_stale)
+        self._runners.append(lambda: self._run_periodic(health, collect, interval, timeout, once))
+        return health
+
+    def stream(self, name, run, stale_after=None, on_stale=None):
+        """註冊常駐型收集器，run(health) 為 async 函式，自行回報成功與失敗"""
+        health = self.health[name] = CollectorHealth(name, stale_after, on_stale)
+        self._runners.append(lambda: run(health))
+        return health
+
+    def jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def backoff(self, health, interval):
+        """連續逾時時探針間隔加倍，最多到 COLLECTOR_MAX_BACKOFF（間隔本身較長時以間隔為準）"""
+        if not health.consecutive_timeouts:
+            return self.jittered(interval)
+        return min(self.jittered(interval) * 2 ** health.consecutive_timeouts, max(interval, COLLECTOR_MAX_BACKOFF))
+
+    async def _run_periodic(self, health, collect, interval, timeout, once):
+        current_collector.set(health)
+        while True:
+            previous = health.process
+            if previous is not None and previous.returncode is None:
+                logger.warning(f"Collector {health.name} skipped: previous probe (pid {previous.pid}) has not exited")
+                health.failure(f"previous probe (pid {previous.pid}) has not exited", timed_out=True)
+                await asyncio.sleep(self.backoff(health, interval))
+                continue
+            health.process = None
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(collect(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Collector {health.name} timed out after {timeout}s")
+                health.failure(f"timed out after {timeout}s", timed_out=True, duration=time.perf_counter() - started)
+            except Exception as e:
+                logger.error(f"Collector {health.name} failed: {e}")
+                health.failure(str(e), duration=time.perf_counter() - started)
+            else:
+                health.success(time.perf_counter() - started)
+                if once:
+                    return
+            await asyncio.sleep(self.backoff(health, interval))
+
+    async def _watchdog(self):
+        while True:
+            await asyncio.sleep(self.watchdog_interval)
+            now = time.time()
+            for health in self.health.values():
+                try:
+                    health.check_stale(now)
+                except Exception as e:
+                    logger.error(f"Error marking collector {health.name} stale: {e}")
+
+    async def _main(self):
+        await asyncio.gather(self._watchdog(), *(runner() for runner in self._runners))
+
+    def start(self):
+        logger.info(f"Starting collector engine: {', '.join(self.health)}")
+        threading.Thread(target=asyncio.run, args=(self._main(),), name='collectors', daemon=True).start()
+
+    def describe(self):
+        return {name: health.describe() for name, health in self.health.items()}
+
+
+current_collector = contextvars.ContextVar('current_collector', default=None)  # 正在執行的週期性探針的 CollectorHealth
+subprocess_reapers = set()  # 等待被強制結束的子程序退出的 task，保留參照以免被回收
+
+async def reap_subprocess(process, grace=5):
+    """等待被強制結束的子程序退出並回收；超過 grace 秒仍未退出時記錄一次，之後繼續等待"""
+    try:
+        await asyncio.wait_for(asyncio.shield(process.wait()), grace)
+    except asyncio.TimeoutError:
+        logger.warning(f"Process {process.pid} did not exit {grace}s after SIGKILL, probably stuck in the driver")
+        await process.wait()
+        logger.info(f"Process {process.pid} exited after being killed")
+
+def kill_subprocess(process):
+    """強制結束子程序，並在背景等待它退出；卡在驅動裡的程序可能過一陣子才真正結束"""
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        reaper = asyncio.get_running_loop().create_task(reap_subprocess(process))
+        subprocess_reapers.add(reaper)
+        reaper.add_done_callback(subprocess_reapers.discard)
+
+async def run_subprocess(argv):
+    """以 create_subprocess_exec 執行並回傳 stdout；被取消（探針逾時）時強制結束子程序
+
+    在週期性探針中執行時，子程序會記錄在該探針的 CollectorHealth，讓下一次探針知道它是否已退出。
+    """
+    process = await asyncio.create_subprocess_exec(
+        *argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    health = current_collector.get()
+    if health is not None:
+        health.process = process
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        kill_subprocess(process)
+        raise
+    stdout = stdout.decode('utf-8', errors='replace')
+    if process.returncode != 0:
+        # nvidia-smi 連不上驅動時把錯誤訊息寫在 stdout
+        message = stderr.decode('utf-8', errors='replace').strip() or stdout.strip()
+        raise RuntimeError(message.splitlines()[0] if message else f"exit code {process.returncode}")
+    return stdout
+
+
+class NvidiaSmiStream:
+    """一個常駐的 nvidia-smi 查詢程序，逐行讀取 CSV，程序結束或停滯時強制結束並重啟
+
+    stall_timeout 秒內沒有任何輸出即視為驅動卡住；沒有程序時 compute apps 查詢本來就不會輸出，
+    所以該串流不設停滯逾時，程序啟動即視為正常。
+    """
+
+    def __init__(self, name, args, on_row, on_idle=None, stall_timeout=None):
+        self.name = name
+        self.args = args
+        self.on_row = on_row
+        self.on_idle = on_idle
+        self.stall_timeout = stall_timeout
+        self.process = None
+        self.restarts = 0
+
+    async def run(self, health):
+        backoff = 1
+        while True:
+            started = time.monotonic()
+            process = None
+            try:
+                process = self.process = await asyncio.create_subprocess_exec(
+                    NVIDIA_SMI_BIN, *self.args,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL
+                )
+                logger.info(f"nvidia-smi {self.name} stream started (pid {process.pid})")
+                if self.stall_timeout is None:
+                    health.success()
+
+                while True:
+                    line = await asyncio.wait_for(process.stdout.readline(), self.stall_timeout)
+                    if not line:
+                        break
+                    line = line.decode('utf-8', errors='replace').strip()
+                    if not line or line.startswith('No running'):
+                        continue
+                    try:
+                        with nvidia_smi_parse_seconds.time('csv_row'):
+                            self.on_row(line)
+                        health.success()
+                    except Exception as e:
+                        logger.error(f"nvidia-smi {self.name} row parse error: {e}")
+                        nvidia_smi_parse_errors.inc('csv_row')
+
+                returncode = await asyncio.wait_for(process.wait(), COLLECTOR_PROBE_TIMEOUT)
+                logger.warning(f"nvidia-smi {self.name} stream exited with code {returncode}")
+                reason = f"nvidia-smi exited with code {returncode}"
+                health.failure(reason)
+            except asyncio.TimeoutError:
+                logger.warning(f"nvidia-smi {self.name} stream stalled, killing pid {process.pid}")
+                reason = "nvidia-smi stalled"
+                health.failure("stalled", timed_out=True)
+            except Exception as e:
+                logger.error(f"Error running nvidia-smi {self.name} stream: {e}")
+                reason = e
+                health.failure(str(e))
+            finally:
+                if process is not None:
+                    kill_subprocess(process)
+
+            # 不論正常結束、停滯或啟動失敗，重啟前都通知目前沒有可用的資料
+            if self.on_idle:
+                self.on_idle(reason)
+
+            # 卡在驅動裡的程序 SIGKILL 後可能遲遲不退出，退出前不啟動新的程序，避免越積越多
+            if process is not None and process.returncode is None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(process.wait()), COLLECTOR_PROBE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.warning(f"nvidia-smi {self.name} stream pid {process.pid} has not exited, "
+                                   f"not restarting until it does")
+                    await process.wait()
+
+            # 程序正常運作一段時間後才重置退避時間，避免快速重啟迴圈
+            if time.monotonic() - started > 60:
+                backoff = 1
+            self.restarts += 1
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+
+class NvidiaSmiStreamCollector:
+    """以兩個常駐的 nvidia-smi 查詢程序（GPU 與 compute apps）持續收集狀態"""
+
+    def __init__(self, interval_ms):
+        self.interval = interval_ms / 1000
+        self._lock = threading.Lock()
+
+        # GPU 批次：同一個 timestamp 的所有列屬於同一次取樣
+        self._gpu_timestamp = None
+        self._gpu_batch = {}
+        self._gpu_published = 0
+        self._gpu_uuids = {}
+        self._expected_gpus = None
+        self._gpu_batch_started = None
+
+        # compute apps 批次：沒有程序時該次取樣不會輸出任何列
+        self._app_timestamp = None
+        self._app_batch = []
+        self._app_last_line = 0.0
+        self._apps = []
+
+        self.gpu_stream = NvidiaSmiStream(
+            'gpu',
+            [f"--query-gpu={','.join(NVIDIA_SMI_GPU_FIELDS)}",
+             '--format=csv,noheader,nounits', '-lms', str(interval_ms)],
+            self._on_gpu_row,
+            on_idle=publish_gpu_error,
+            stall_timeout=self.interval + COLLECTOR_PROBE_TIMEOUT
+        )
+        self.app_stream = NvidiaSmiStream(
+            'compute-apps',
+            [f"--query-compute-apps={','.join(NVIDIA_SMI_APP_FIELDS)}",
+             '--format=csv,noheader,nounits', '-lms', str(interval_ms)],
+            self._on_app_row
+        )
+
+    def register(self, engine):
+        """兩個串流都在收集引擎上執行；GPU 串流太久沒有輸出時快照標記為 stale"""
+        engine.stream('gpu', self.gpu_stream.run, on_stale=mark_gpu_snapshot_stale,
+                      stale_after=self.interval * COLLECTOR_STALE_INTERVALS + COLLECTOR_PROBE_TIMEOUT)
+        engine.stream('processes', self.app_stream.run)
+
+    def _on_app_row(self, row):
+        timestamp = row.split(',', 1)[0]
+        gpu_uuid, proc = parse_compute_app_row(row)
+        with self._lock:
+            if timestamp != self._app_timestamp:
+                if self._app_timestamp is not None:
+                    self._apps = self._app_batch
+                self._app_timestamp = timestamp
+                self._app_batch = []
+            self._app_batch.append((gpu_uuid, proc))
+            self._app_last_line = time.monotonic()
+
+    def _current_apps(self):
+        """取得最近一次完整的 compute apps 取樣"""
+        quiet_for = time.monotonic() - self._app_last_line
+        if quiet_for > self.interval * 1.5:
+            # 超過一個取樣週期沒有輸出，代表目前沒有程序
+            return []
+        if self._app_batch and quiet_for > 0.2:
+            # 同一次取樣的所有列會一起輸出，安靜一小段時間即可視為完整
+            return self._app_batch
+        return self._apps
+
+    def _on_gpu_row(self, row):
+        timestamp = row.split(',', 1)[0]
+        gpu_uuid, idx, gpu_data = parse_gpu_query_row(row)
+        ready = []
+        with self._lock:
+            if timestamp != self._gpu_timestamp:
+                # 取樣時間改變，上一批一定已完整
+                if self._gpu_batch:
+                    self._expected_gpus = len(self._gpu_batch)
+                    if self._gpu_published < len(self._gpu_batch):
+                        ready.append(self._build_snapshot())
+                self._gpu_timestamp = timestamp
+                self._gpu_batch = {}
+                self._gpu_published = 0
+                self._gpu_batch_started = time.perf_counter()
+            self._gpu_uuids[gpu_uuid] = idx
+            self._gpu_batch[idx] = gpu_data
+
+            # 已知 GPU 數量時，收齊即可發佈，不必等下一次取樣
+            if (self._expected_gpus is not None and not self._gpu_published
+                    and len(self._gpu_batch) >= self._expected_gpus):
+                ready.append(self._build_snapshot())
+
+        # 在鎖外發佈快照
+        for new_gpu_info, new_processes in ready:
+            publish_gpu_snapshot(new_gpu_info, new_processes)
+
+    def _build_snapshot(self):
+        nvidia_smi_collect_seconds.observe(time.perf_counter() - self._gpu_batch_started, 'stream')
+        self._gpu_published = len(self._gpu_batch)
+        new_gpu_info = {idx: dict(data) for idx, data in self._gpu_batch.items()}
+        new_processes = []
+        for gpu_uuid, proc in self._current_apps():
+            gpu_id = self._gpu_uuids.get(gpu_uuid)
+            if gpu_id is None:
+                continue
+            new_processes.append(dict(proc, gpu=gpu_id))
+            if gpu_id in new_gpu_info:
+                new_gpu_info[gpu_id]['in_use'] = True
+        return new_gpu_info, new_processes
+
+
+
+def mark_gpu_snapshot_stale():
+    """GPU 收集器卡住：保留最後一次的資料但標記為 stale，排程器不會把任務放到狀態不明的 GPU"""
+    global gpu_info
+    gpu_info = {gpu_id: dict(gpu_data, stale=True) for gpu_id, gpu_data in gpu_info.items()}
+    broadcaster.publish('gpu', {'gpus': gpu_info, 'processes': processes})
 
-            gpu_info = {}
-            processes = []
+def mark_disk_snapshot_stale():
+    global disk_info
+    disk_info = [dict(disk, stale=True) for disk in disk_info]
+    broadcaster.publish('disk', {'disks': disk_info})
 
-            # ---------- Parse GPU summary ----------
-            for i, line in enumerate(lines):
-                if re.match(r"\|\s+\d+\s+", line):
-                    try:
-                        idx = int(line.split()[1])
-                        next_line = lines[i + 1] if i + 1 < len(lines) else ""
-                        mem_info_match = re.search(r"(\d+)MiB\s*/\s*(\d+)MiB", next_line)
-                        util_match = re.search(r"(\d+)%", next_line)
-
-                        if mem_info_match:
-                            mem_used = int(mem_info_match.group(1))
-                            mem_total = int(mem_info_match.group(2))
-                            mem_percent = round(mem_used / mem_total * 100, 1) if mem_total > 0 else 0.0
-                            util = int(util_match.group(1)) if util_match else 0
-
-                            gpu_info[idx] = {
-                                'name': f'GPU {idx}',
-                                'mem_total': mem_total,
-                                'mem_used': mem_used,
-                                'mem_percent': mem_percent,
-                                'util': util,
-                                'in_use': False
-                            }
-                    except Exception as e:
-                        logger.error(f"GPU summary parse error: {e}")
-
-            # ---------- Parse Processes block (new format) ----------
-            # 找到 Processes 區塊
-            processes_block = output.split("Processes:")[1].strip()
-
-            # 每行為一筆 process，跳過表頭與分隔線
-            lines = processes_block.splitlines()
-            process_lines = [
-                line for line in lines if re.match(r"\|\s+\d+", line)
-            ]
-
-            parsed_processes = []
-            for line in process_lines:
-                # 用正則表達式擷取欄位資料
-                match = re.match(
-                    r"\|\s*(\d+)\s+N/A\s+N/A\s+(\d+)\s+(\w)\s+(.+?)\s+(\d+MiB)\s*\|", line
-                )
-                if match:
-                    gpu_id, pid, ptype, pname, mem_usage = match.groups()
-                    parsed_processes.append({
-                        "gpu_id": int(gpu_id),
-                        "pid": int(pid),
-                        "type": ptype,
-                        "process_name": pname.strip(),
-                        "gpu_memory": mem_usage
-                    })
-
-            # 將解析結果轉換為原有的格式並標記 GPU 使用狀態
-            for proc in parsed_processes:
-                processes.append({
-                    'gpu': proc['gpu_id'],
-                    'pid': proc['pid'],
-                    'type': proc['type'],
-                    'name': proc['process_name'],
-                    'mem': proc['gpu_memory']
-                })
-
-                if proc['gpu_id'] in gpu_info:
-                    gpu_info[proc['gpu_id']]['in_use'] = True
-
-            logger.debug(f"GPU data updated: {len(gpu_info)} GPUs, {len(processes)} processes")
-            
-            # 自動檢查並執行可用的任務
-            auto_execute_tasks()
+async def collect_gpu_table():
+    """執行 nvidia-smi 並解析文字表格（GPU_COLLECTOR_MODE=table）"""
+    try:
+        with nvidia_smi_collect_seconds.time('table'):
+            output = await run_subprocess([NVIDIA_SMI_BIN])
+        try:
+            with nvidia_smi_parse_seconds.time('table'):
+                new_gpu_info, new_processes = parse_nvidia_smi_table(output)
+        except Exception:
+            nvidia_smi_parse_errors.inc('table')
+            raise
+    except Exception as e:
+        publish_gpu_error(e)
+        raise
+    publish_gpu_snapshot(new_gpu_info, new_processes)
 
-        except Exception as e:
-            logger.error(f"Error running nvidia-smi: {e}")
-            gpu_info = {
-                0: {
-                    'name': f"GPU error - {str(e)}",
-                    'mem_total': 0,
-                    'mem_used': 0,
-                    'mem_percent': 0,
-                    'util': 0,
-                    'in_use': False
-                }
-            }
-            processes = []
+async def collect_disks():
+    """各掛載點的 statvfs 已在各自的 daemon 執行緒中執行並有逾時（見 DiskCollector），這裡只把整輪收集移出事件迴圈"""
+    global disk_info
+    try:
+        disk_info = await asyncio.get_running_loop().run_in_executor(None, disk_collector.collect)
+    except Exception:
+        disk_info = []
+        broadcaster.publish('disk', {'disks': disk_info})
+        raise
+    logger.debug(f"Disk usage updated: {len(disk_info)} disks")
+    broadcaster.publish('disk', {'disks': disk_info})
+
+async def collect_topology():
+    try:
+        gpu_topology.load(await run_subprocess([NVIDIA_SMI_BIN, 'topo', '-m']))
+    except Exception as e:
+        gpu_topology.error = str(e)
+        raise
 
-        time.sleep(5)
+collector_engine = CollectorEngine(COLLECTOR_JITTER)
+
+def start_collectors():
+    """註冊並啟動收集器；aggregator 的 GPU 狀態來自叢集輪詢，只收集本機磁碟"""
+    if cluster is None:
+        if GPU_COLLECTOR_MODE == 'stream':
+            NvidiaSmiStreamCollector(GPU_POLL_INTERVAL_MS).register(collector_engine)
+        else:
+            collector_engine.periodic('gpu', collect_gpu_table, GPU_POLL_INTERVAL_MS / 1000, COLLECTOR_PROBE_TIMEOUT,
+                                      on_stale=mark_gpu_snapshot_stale)
+        gpu_topology.background = True
+        collector_engine.periodic('topology', collect_topology, GPU_TOPOLOGY_RETRY_INTERVAL, GPU_TOPOLOGY_TIMEOUT,
+                                  once=True)
+    collector_engine.periodic('disk', collect_disks, DISK_POLL_INTERVAL, COLLECTOR_PROBE_TIMEOUT,
+                              on_stale=mark_disk_snapshot_stale)
+    collector_engine.start()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        http_request_seconds.observe(time.perf_counter() - started, request.method, route)
+    return response
 
 @app.route('/')
 def index():
@@ -708,65 +5005,43 @@ def executions_page():
 
 @app.route('/api/executions')
 def api_executions():
-    """API endpoint to get execution list"""
+    """API endpoint to get a page of the execution list
+
+    Query parameters: limit, cursor, sort (created_time|output_size|directory),
+    order (asc|desc), status (comma separated), gpu, command, date_from, date_to (YYYY-MM-DD)
+    """
     try:
-        executions = []
-        executions_dir = EXECUTION_LOG_DIR  # 使用正確的執行目錄
-        
-        if not os.path.exists(executions_dir):
-            return jsonify({'success': True, 'executions': []})
-        
-        for dir_name in os.listdir(executions_dir):
-            dir_path = os.path.join(executions_dir, dir_name)
-            if os.path.isdir(dir_path):
-                execution_info = {
-                    'directory': dir_name,
-                    'created_time': 0,
-                    'command_file': '',
-                    'output_size': 0,
-                    'output_preview': '',
-                    'has_error_log': False
-                }
-                
-                # Get creation time
-                try:
-                    execution_info['created_time'] = os.path.getctime(dir_path)
-                except:
-                    execution_info['created_time'] = 0
-                
-                # Read command file
-                command_file_path = os.path.join(dir_path, 'command.txt')
-                if os.path.exists(command_file_path):
-                    try:
-                        with open(command_file_path, 'r', encoding='utf-8') as f:
-                            execution_info['command_file'] = f.read()
-                    except Exception as e:
-                        execution_info['command_file'] = f'Error reading command file: {str(e)}'
-                
-                # Check for error log
-                error_file_path = os.path.join(dir_path, 'error.log')
-                if os.path.exists(error_file_path):
-                    execution_info['has_error_log'] = True
-
-                # Calculate output size and get preview
-                output_file_path = os.path.join(dir_path, 'output.log')
-                if os.path.exists(output_file_path):
-                    try:
-                        size = os.path.getsize(output_file_path)
-                        execution_info['output_size'] = size
-                        with open(output_file_path, 'r', encoding='utf-8') as f:
-                            # Read last 500 chars for status check
-                            f.seek(0, os.SEEK_END)
-                            end_pos = f.tell()
-                            f.seek(max(0, end_pos - 500))
-                            execution_info['output_preview'] = f.read()
-                    except:
-                        pass
-                
-                executions.append(execution_info)        # Sort by creation time (newest first)
-        executions.sort(key=lambda x: x['created_time'], reverse=True)
-        
-        return jsonify({'success': True, 'executions': executions})
+        try:
+            limit = max(1, min(int(request.args.get('limit', 50)), 500))
+            date_from = request.args.get('date_from')
+            date_to = request.args.get('date_to')
+            if date_from:
+                date_from = datetime.strptime(date_from, '%Y-%m-%d').timestamp()
+            if date_to:
+                # 包含結束日期當天
+                date_to = datetime.strptime(date_to, '%Y-%m-%d').timestamp() + 86400
+
+            rows, next_cursor, total = execution_index.query(
+                limit=limit,
+                cursor=request.args.get('cursor') or None,
+                sort=request.args.get('sort', 'created_time'),
+                order=request.args.get('order', 'desc'),
+                status=request.args.get('status') or None,
+                gpu=request.args.get('gpu') or None,
+                command=request.args.get('command') or None,
+                date_from=date_from or None,
+                date_to=date_to or None
+            )
+        except ValueError as e:
+            return jsonify({'success': False, 'error': f'Invalid query: {str(e)}'}), 400
+
+        return jsonify({
+            'success': True,
+            'executions': rows,
+            'next_cursor': next_cursor,
+            'total': total,
+            'stats': execution_index.stats()
+        })
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -790,9 +5065,11 @@ def api_execution_info(execution_dir):
             'directory': execution_dir,
             'created_time': 0,
             'command_file': '',
-            'output_log': '',
             'output_preview': '',
             'output_truncated': False,
+            'completed_at': None,
+            'status': 'queued',
+            'exit_code': None,
             'error_log': '',
             'script_file': '',
             'output_size': 0
@@ -813,30 +5090,37 @@ def api_execution_info(execution_dir):
             except Exception as e:
                 execution_info['command_file'] = f'Error reading command file: {str(e)}'
         
-        # Read output log (with preview option)
+        # 只讀取輸出記錄的開頭預覽與結尾狀態，完整內容由 /output 分段讀取
         output_file_path = os.path.join(dir_path, 'output.log')
-        if os.path.exists(output_file_path):
+        if log_exists(output_file_path):
             try:
-                execution_info['output_size'] = os.path.getsize(output_file_path)
-                with open(output_file_path, 'r', encoding='utf-8') as f:
-                    # 讀取前2000個字符作為預覽
+                with open_log(output_file_path) as f:
+                    execution_info['output_size'] = f.size
+                    execution_info['output_compressed'] = f.compressed
+                    execution_info['output_stored_size'] = f.stored_size
+                    # 讀取前2000個位元組作為預覽
                     preview = f.read(2000)
-                    execution_info['output_preview'] = preview
-                    execution_info['output_truncated'] = len(preview) == 2000;
+                    execution_info['output_preview'] = trim_partial_utf8(preview).decode('utf-8', errors='replace')
+                    execution_info['output_truncated'] = execution_info['output_size'] > len(preview)
                     
-                    # 如果檔案不大，也提供完整內容
-                    if execution_info['output_size'] <= 10000:  # 10KB以下提供完整內容
-                        f.seek(0)
-                        execution_info['output_log'] = f.read()
+                    f.seek(max(0, execution_info['output_size'] - 500))
+                    tail = f.read().decode('utf-8', errors='replace')
+                completed_match = re.search(r"Task completed at: (.+)", tail)
+                if completed_match:
+                    execution_info['completed_at'] = completed_match.group(1).strip()
             except Exception as e:
                 execution_info['output_preview'] = f'Error reading output file: {str(e)}'
         
+        metadata = read_execution_metadata(execution_dir)
+        execution_info['status'] = metadata['status']
+        execution_info['exit_code'] = metadata['exit_code']
+        
         # Read error log  
         error_file_path = os.path.join(dir_path, 'error.log')
-        if os.path.exists(error_file_path):
+        if log_exists(error_file_path):
             try:
-                with open(error_file_path, 'r', encoding='utf-8') as f:
-                    execution_info['error_log'] = f.read()
+                with open_log(error_file_path) as f:
+                    execution_info['error_log'] = f.read().decode('utf-8', errors='replace')
             except Exception as e:
                 execution_info['error_log'] = f'Error reading error file: {str(e)}'
         
@@ -874,24 +5158,47 @@ def api_execution_info(execution_dir):
 
 @app.route('/api/executions/<execution_dir>/output')
 def api_execution_output(execution_dir):
-    """API endpoint to get full execution output"""
+    """API endpoint to read a chunk of the execution output as text/plain
+
+    Query parameters: offset/length (bytes), from_line/tail_lines/lines (0-based lines).
+    The position to continue from is returned in the X-Next-Offset header.
+    """
     try:
         output_file = os.path.join(EXECUTION_LOG_DIR, execution_dir, 'output.log')
         
-        if not os.path.isfile(output_file):
+        if not log_exists(output_file):
             return jsonify({
                 'success': False,
                 'error': '輸出檔案不存在'
             }), 404
         
-        with open(output_file, 'r', encoding='utf-8') as f:
-            output_content = f.read()
+        try:
+            params = {}
+            for name in ('offset', 'length', 'from_line', 'tail_lines', 'lines'):
+                value = request.args.get(name)
+                if value not in (None, ''):
+                    params[name] = int(value)
+                    if params[name] < 0:
+                        raise ValueError(f"{name} must not be negative")
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': f'Invalid range: {str(e)}'
+            }), 400
+        
+        data, meta = read_output_chunk(output_file, **params)
         
-        return jsonify({
-            'success': True,
-            'output': output_content,
-            'size': len(output_content)
-        })
+        headers = {
+            'Content-Type': 'text/plain; charset=utf-8',
+            'Cache-Control': 'no-store',
+            'X-Offset': str(meta['offset']),
+            'X-Next-Offset': str(meta['next_offset']),
+            'X-File-Size': str(meta['size']),
+            'X-Total-Lines': str(meta['total_lines'])
+        }
+        if meta['start_line'] is not None:
+            headers['X-Start-Line'] = str(meta['start_line'])
+        return data, 200, headers
         
     except Exception as e:
         return jsonify({
@@ -899,35 +5206,257 @@ def api_execution_output(execution_dir):
             'error': str(e)
         }), 500
 
+def running_tasks_entry():
+    # elapsed_seconds 每次都不同，無法以版本快取
+    return response_cache.entry('api_running_tasks', None, lambda: json_bytes({
+        'success': True,
+        'tasks': [dict(task, expected_end=runtime_predictor.expected_end(task['task_uid']))
+                  for task in task_supervisor.running()]
+    }))
+
+@app.route('/api/tasks/running')
+def api_running_tasks():
+    """API endpoint to list tasks currently held by the supervisor"""
+    return cached_json_response(running_tasks_entry())
+
+def gpu_data_entry():
+    """GPU 快照或預約改變時才重新序列化；有預約時 age_seconds 會變，最多每秒重建一次"""
+    token = (broadcaster.topic_version('gpu'), gpu_reservations.version,
+             int(time.time()) if len(gpu_reservations) else None)
+    return response_cache.entry('gpu_data', token, lambda: json_bytes({
+        'gpus': gpu_info,
+        'processes': processes,
+        'reservations': gpu_reservations.snapshot()
+    }))
+
 @app.route('/gpu_data')
 def gpu_data():
+    return cached_json_response(gpu_data_entry())
+
+@app.route('/api/cluster')
+def api_cluster():
+    """API endpoint for the aggregated cluster view (aggregator mode)"""
+    if cluster is None:
+        return jsonify({'success': False, 'error': 'Not running in aggregator mode'}), 400
     return jsonify({
+        'success': True,
+        'nodes': cluster.describe(),
         'gpus': gpu_info,
-        'processes': processes
+        'processes': processes,
+        'reservations': gpu_reservations.snapshot()
     })
 
-@app.route('/disk_data')
-def disk_data():
+@app.route('/api/agent/launch', methods=['POST'])
+def api_agent_launch():
+    """API endpoint for an aggregator to launch a task on this agent's GPUs
+
+    Body: uid, command, required_gpu, gpu_ids, and optional required_memory, max_util, created_at, owner, priority.
+    以 uid 去重，逾時重送不會重複執行。
+    """
+    if cluster is not None:
+        return jsonify({'success': False, 'error': 'Aggregator does not run tasks'}), 400
+    if AGENT_TOKEN and not hmac.compare_digest(request.headers.get('X-Agent-Token', '').encode('utf-8'),
+                                               AGENT_TOKEN.encode('utf-8')):
+        return jsonify({'success': False, 'error': 'Invalid agent token'}), 403
+
+    data = request.get_json(silent=True) or {}
+    task_uid = data.get('uid')
+    command_text = data.get('command')
+    gpu_ids = data.get('gpu_ids')
+    required_memory = data.get('required_memory')
+    max_util = data.get('max_util')
+    owner = data.get('owner', DEFAULT_COMMAND_OWNER)
+    priority = data.get('priority', 0)
+    if not task_uid or not command_text or not isinstance(gpu_ids, list) or not gpu_ids:
+        return jsonify({'success': False, 'error': 'uid, command and gpu_ids are required'}), 400
+    if not isinstance(owner, str) or not owner.strip():
+        return jsonify({'success': False, 'error': 'owner must be a non-empty string'}), 400
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        return jsonify({'success': False, 'error': 'priority must be an integer'}), 400
+
+    with scheduler_lock:
+        if task_uid in remote_launches:
+            return jsonify({'success': True, 'gpu_ids': remote_launches[task_uid], 'duplicate': True})
+        if execution_index.task_status(task_uid) is not None:
+            # 已結束的任務不再留在 remote_launches，改由執行索引判斷是否重送
+            return jsonify({'success': True, 'gpu_ids': gpu_ids, 'duplicate': True})
+        for gpu_id in gpu_ids:
+            if gpu_id not in gpu_info:
+                return jsonify({'success': False, 'error': f'GPU {gpu_id} not found'}), 409
+            if not gpu_fits(gpu_id, gpu_info[gpu_id], required_memory, max_util):
+                return jsonify({'success': False, 'error': f'GPU {gpu_id} is not available'}), 409
+
+        task_info = {
+            'uid': task_uid,
+            'command': command_text,
+            'required_gpu': data.get('required_gpu', ','.join(str(gpu_id) for gpu_id in gpu_ids)),
+            'created_at': data.get('created_at'),
+            'required_memory': required_memory,
+            'max_util': max_util,
+            'owner': owner.strip(),
+            'priority': priority
+        }
+        gpu_reservations.reserve(task_uid, gpu_ids, required_memory)
+        if not execute_task(command_text, task_info['required_gpu'], task_uid, gpu_ids, task_info=task_info):
+            gpu_reservations.release(task_uid)
+            return jsonify({'success': False, 'error': 'Failed to launch task'}), 500
+        remote_launches[task_uid] = gpu_ids
+
+    logger.info(f"Remote task {task_uid} launched on GPUs {gpu_ids}")
+    return jsonify({'success': True, 'gpu_ids': gpu_ids, 'predicted_runtime': runtime_predictor.predict(command_text)})
+
+@app.route('/api/retention')
+def api_retention():
+    """Dry-run report of the retention policy: what would be removed and why
+
+    max_bytes、max_age_days、max_count、failed_extra_days 可覆寫目前的設定以預覽其他策略。
+    """
+    try:
+        policy = RetentionPolicy(
+            int(request.args.get('max_bytes', retention_policy.max_bytes)),
+            float(request.args.get('max_age_days', retention_policy.max_age_days)),
+            int(request.args.get('max_count', retention_policy.max_count)),
+            float(request.args.get('failed_extra_days', retention_policy.failed_extra_days))
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'Invalid policy: {str(e)}'}), 400
+
+    try:
+        evict, summary = plan_retention(policy)
+        return jsonify({
+            'success': True,
+            'dry_run': True,
+            'policy': policy.describe(),
+            'summary': summary,
+            'evict': evict
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/metrics/history')
+def api_metrics_history():
+    """API endpoint for GPU utilization, memory and process count history
+
+    since 為 Unix 時間（秒），負數表示距今多少秒；resolution 為 raw、1m、15m，
+    未指定時自動選擇涵蓋 since 的最細解析度。
+    """
+    try:
+        gpu_param = request.args.get('gpu', '').strip()
+        # 本機以整數編號記錄，aggregator 則是 "節點/編號"
+        gpu_ids = [g.strip() if cluster is not None else int(g) for g in gpu_param.split(',')
+                   if g.strip()] if gpu_param else None
+        since = float(request.args.get('since', -GPU_HISTORY_DEFAULT_WINDOW))
+        if since < 0:
+            since = time.time() + since
+        resolution = request.args.get('resolution') or gpu_history.resolution_for(since)
+        history = gpu_history.query(gpu_ids, since, resolution)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
     return jsonify({
+        'success': True,
+        'since': since,
+        'resolution': resolution,
+        'gpus': history
+    })
+
+metrics.gauge('queue_depth', 'Commands waiting in the queue', lambda: len(command_store))
+metrics.gauge('blocked_commands', 'Queued commands waiting for upstream tasks to finish',
+              lambda: command_store.waiting_count())
+metrics.gauge('running_tasks', 'Tasks currently held by the supervisor', lambda: task_supervisor.running_count())
+metrics.gauge('reserved_gpus', 'GPUs reserved for tasks that nvidia-smi does not show yet',
+              lambda: len(gpu_reservations.reserved_gpus()))
+metrics.gauge('scheduler_last_tick_timestamp_seconds', 'Unix time when the last scheduling pass finished',
+              lambda: scheduler_last_tick_time)
+metrics.gauge('collector_up', 'Whether the collector produced data recently (0 while failing or stale)', lambda: [
+    ((name,), int(health.status == 'ok')) for name, health in collector_engine.health.items()], ('collector',))
+metrics.gauge('collector_last_success_timestamp_seconds', 'Unix time of the last successful collection', lambda: [
+    ((name,), health.last_success) for name, health in collector_engine.health.items()], ('collector',))
+metrics.gauge('gpu_utilization_percent', 'GPU utilization', lambda: [
+    ((gpu_id, data.get('name', '')), data.get('util', 0)) for gpu_id, data in gpu_info.items()], ('gpu', 'name'))
+metrics.gauge('gpu_memory_used_bytes', 'GPU memory in use', lambda: [
+    ((gpu_id,), data.get('mem_used', 0) * 1024 * 1024) for gpu_id, data in gpu_info.items()], ('gpu',))
+metrics.gauge('gpu_memory_total_bytes', 'GPU memory capacity', lambda: [
+    ((gpu_id,), data.get('mem_total', 0) * 1024 * 1024) for gpu_id, data in gpu_info.items()], ('gpu',))
+metrics.gauge('gpu_processes', 'Processes running on the GPU', lambda: [
+    ((gpu_id,), gpu_process_count(gpu_id)) for gpu_id in gpu_info], ('gpu',))
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus text exposition of scheduler, collector and request metrics"""
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def disk_data_entry():
+    return response_cache.entry('disk_data', broadcaster.topic_version('disk'), lambda: json_bytes({
         'disks': disk_info
+    }))
+
+@app.route('/disk_data')
+def disk_data():
+    return cached_json_response(disk_data_entry())
+
+@app.route('/events')
+def events():
+    """Server-Sent Events：狀態改變時推送 gpu、disk、commands 主題的最新快照"""
+    try:
+        since = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        since = 0
+    if since > broadcaster.version:
+        # 伺服器重啟後版本重新計算，從頭送出所有快照
+        since = 0
+
+    def stream(since):
+        yield "retry: 3000\n\n"
+        while True:
+            changes = broadcaster.changes_since(since, timeout=SSE_KEEPALIVE_INTERVAL)
+            if not changes:
+                # 保持連線，並讓斷線的客戶端及早被偵測到
+                yield ": keepalive\n\n"
+                continue
+            for topic, version, data in changes:
+                yield f"id: {version}\nevent: {topic}\ndata: {data}\n\n"
+                since = version
+
+    return app.response_class(stream(since), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
 
 @app.route('/logs')
 def get_logs():
-    """獲取最近的日誌記錄"""
+    """獲取最近的日誌記錄
+
+    Query parameters: lines（預設 100），level（最低等級，例如 WARNING），
+    since / until（Unix 秒，負數表示距今多少秒），format=json 另外回傳解析後的 entries
+    """
     try:
-        if os.path.exists(LOG_FILE):
-            with open(LOG_FILE, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-            return jsonify({
-                'success': True,
-                'logs': lines[-100:]  # 返回最近100行日誌
-            })
-        else:
-            return jsonify({
-                'success': True,
-                'logs': []
-            })
+        try:
+            limit = max(1, min(int(request.args.get('lines', 100)), LOG_TAIL_MAX_LINES))
+            min_level = None
+            if request.args.get('level'):
+                min_level = logging.getLevelName(request.args['level'].upper())
+                if not isinstance(min_level, int):
+                    raise ValueError(f"Unknown level: {request.args['level']}")
+            since = until = None
+            if request.args.get('since'):
+                since = float(request.args['since'])
+                since = time.time() + since if since < 0 else since
+            if request.args.get('until'):
+                until = float(request.args['until'])
+                until = time.time() + until if until < 0 else until
+        except ValueError as e:
+            return jsonify({'success': False, 'error': f'Invalid query: {str(e)}'}), 400
+
+        entries, truncated = tail_log(LOG_FILE, limit, min_level, since, until)
+        result = {
+            'success': True,
+            'logs': [entry['raw'] + '\n' for entry in entries],
+            'truncated': truncated
+        }
+        if request.args.get('format') == 'json':
+            result['entries'] = [{k: v for k, v in entry.items() if k != 'raw'} for entry in entries]
+        return jsonify(result)
     except Exception as e:
         logger.error(f"Error reading logs: {e}")
         return jsonify({
@@ -937,42 +5466,260 @@ def get_logs():
 
 # ========== 指令管理 API ==========
 
+def commands_entry():
+    return response_cache.entry('get_commands_api', command_store.version, lambda: json_bytes({
+        'success': True,
+        'commands': get_commands()
+    }))
+
 @app.route('/commands', methods=['GET'])
 def get_commands_api():
     """獲取所有指令"""
-    commands = get_commands()
-    return jsonify({
-        'success': True,
-        'commands': commands
-    })
+    return cached_json_response(commands_entry())
+
+SWEEP_PLACEHOLDER = re.compile(r'\{(\w+)\}')  # 範本中的 {name}；其他大括號（例如 ${VAR}）保持原樣
+
+def validate_command_fields(data, default_owner, task_states=None):
+    """檢查單筆指令的欄位，回傳 (add_command 的參數, 錯誤訊息)，新增單筆與批次新增共用
+
+    task_states 快取上游任務的狀態，批次新增時同一個上游只查詢一次。
+    """
+    command_text = data.get('command', '')
+    required_gpu = data.get('required_gpu', '')
+    command_text = command_text.strip() if isinstance(command_text, str) else ''
+    required_gpu = required_gpu.strip() if isinstance(required_gpu, str) else ''
+    
+    if not command_text:
+        return None, '指令內容不能為空'
+    
+    if not required_gpu:
+        return None, '所需GPU不能為空'
+    
+    if required_gpu.lower().startswith('count:') and not parse_gpu_count(required_gpu):
+        return None, 'GPU 數量必須是大於0的整數，例如 count:2'
+    
+    if cluster is not None and any(part.strip().isdigit() for part in required_gpu.split(',')):
+        return None, '叢集模式請以 節點/編號 指定 GPU（例如 node1/0），以名稱指定時請包含型號以外的文字（例如 RTX 4070）'
+    
+    required_memory = data.get('required_memory')
+    if required_memory is not None and (not isinstance(required_memory, int) or isinstance(required_memory, bool)
+                                        or required_memory < 1):
+        return None, '所需記憶體必須是大於0的整數 (MiB)'
+    
+    max_util = data.get('max_util')
+    if max_util is not None and (not isinstance(max_util, int) or isinstance(max_util, bool)
+                                 or not 0 <= max_util <= 100):
+        return None, '最大使用率必須是0到100的整數'
+    
+    priority = data.get('priority', 0)
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        return None, '優先權必須是整數'
+    
+    owner = data.get('owner') or default_owner
+    if not isinstance(owner, str) or not owner.strip():
+        return None, '擁有者必須是非空字串'
+    
+    depends_on = data.get('depends_on') or []
+    if not isinstance(depends_on, list) or not all(isinstance(uid, str) and uid for uid in depends_on):
+        return None, 'depends_on 必須是任務 uid 的陣列'
+    depends_on = list(dict.fromkeys(depends_on))
+    
+    depends_condition = data.get('depends_condition', 'success')
+    if depends_condition not in DEPENDENCY_CONDITIONS:
+        return None, 'depends_condition 必須是 success 或 any'
+    
+    # 已結束的上游不必等待；在這之後才結束的上游由 reconcile_dependencies 補上
+    task_states = {} if task_states is None else task_states
+    waiting_on = []
+    for upstream in depends_on:
+        if upstream not in task_states:
+            task_states[upstream] = task_state(upstream)
+        state = task_states[upstream]
+        if state is None:
+            return None, f'找不到上游任務 {upstream}'
+        if state == 'failed' and depends_condition == 'success':
+            return None, f'上游任務 {upstream} 已失敗'
+        if state in ('queued', 'running'):
+            waiting_on.append(upstream)
+    
+    return {
+        'command_text': command_text,
+        'required_gpu': required_gpu,
+        'required_memory': required_memory,
+        'max_util': max_util,
+        'priority': priority,
+        'owner': owner.strip(),
+        'depends_on': depends_on,
+        'depends_condition': depends_condition,
+        'waiting_on': waiting_on
+    }, None
+
+def expand_command_sweep(template, grid=None, params=None):
+    """把指令範本依參數展開，回傳 (指令清單, 錯誤訊息)
+
+    grid 為 {名稱: [值, ...]}，依鍵的順序取所有組合（最後一個參數變化最快）；
+    params 為 [{名稱: 值}, ...]，逐筆代入。範本中的 {名稱} 以參數值取代。
+    """
+    if not isinstance(template, str) or not template.strip():
+        return None, '指令範本不能為空'
+    if (grid is None) == (params is None):
+        return None, '必須提供 grid 或 params 其中之一'
+    
+    if grid is not None:
+        if not isinstance(grid, dict) or not grid:
+            return None, 'grid 必須是非空物件'
+        if not all(isinstance(values, list) and values for values in grid.values()):
+            return None, 'grid 的每個參數都必須是非空陣列'
+        total = math.prod(len(values) for values in grid.values())
+        if total > BULK_MAX_COMMANDS:
+            return None, f'參數組合共 {total} 筆，超過上限 {BULK_MAX_COMMANDS}'
+        names = list(grid)
+        params = [dict(zip(names, combination)) for combination in itertools.product(*grid.values())]
+    else:
+        if not isinstance(params, list) or not params:
+            return None, 'params 必須是非空陣列'
+        if len(params) > BULK_MAX_COMMANDS:
+            return None, f'參數共 {len(params)} 筆，超過上限 {BULK_MAX_COMMANDS}'
+        if not all(isinstance(values, dict) for values in params):
+            return None, 'params 的每一筆都必須是物件'
+    
+    for values in params:
+        for value in values.values():
+            if not isinstance(value, (str, int, float)):
+                return None, '參數值必須是字串或數字'
+    
+    # 範本中出現在任一筆參數裡的 {名稱} 才是掃描參數，其餘（例如 ${HOME}）保持原樣
+    used = set(SWEEP_PLACEHOLDER.findall(template)) & set().union(*params)
+    if not used:
+        return None, '指令範本沒有使用任何參數（以 {名稱} 標示）'
+    for index, values in enumerate(params):
+        missing = sorted(used.difference(values))
+        if missing:
+            return None, f"params 第 {index + 1} 筆缺少參數：{', '.join(missing)}"
+    
+    def render(values):
+        return SWEEP_PLACEHOLDER.sub(
+            lambda m: str(values[m.group(1)]) if m.group(1) in values else m.group(0), template)
+    
+    return [render(values) for values in params], None
+
+def client_address():
+    """用戶端位址：直接連線的來源是信任的代理時，才往 X-Forwarded-For 的前一站追溯
+
+    由右往左取，每一站都是上一個信任代理所看到的來源，用戶端自己加上的項目在最左邊，不會被採用。
+    """
+    address = request.remote_addr
+    forwarded = [hop.strip() for hop in request.headers.get('X-Forwarded-For', '').split(',') if hop.strip()]
+    while forwarded and address in TRUSTED_PROXIES:
+        address = forwarded.pop()
+    return address
+
+def request_owner():
+    """未指定擁有者時依序採用信任的反向代理提供的使用者名稱、用戶端位址（經 worker 轉送時取原始位址）"""
+    if request.remote_addr in TRUSTED_PROXIES and request.headers.get('X-Remote-User'):
+        return request.headers['X-Remote-User']
+    return client_address()
 
 @app.route('/commands', methods=['POST'])
 def add_command_api():
     """新增指令"""
     try:
         data = request.get_json()
-        command_text = data.get('command', '').strip()
-        required_gpu = data.get('required_gpu', '').strip()
-        
-        if not command_text:
+        fields, error = validate_command_fields(data, request_owner())
+        if error:
             return jsonify({
                 'success': False,
-                'error': '指令內容不能為空'
+                'error': error
             }), 400
         
-        if not required_gpu:
+        new_command = add_command(**fields)
+        
+        if new_command:
+            return jsonify({
+                'success': True,
+                'command': new_command,
+                'message': '指令新增成功'
+            })
+        else:
+            return jsonify({
+                'success': False,
+                'error': '指令新增失敗'
+            }), 500
+            
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'服務器錯誤: {str(e)}'
+        }), 500
+
+@app.route('/commands/bulk', methods=['POST'])
+def add_commands_bulk_api():
+    """一次新增多筆指令：commands 陣列，或 template 加上 grid / params 展開的參數掃描
+
+    其餘頂層欄位（required_gpu、priority、owner 等）作為每筆指令的預設值，
+    所有指令驗證通過後才以單一筆日誌記錄寫入。
+    """
+    try:
+        data = request.get_json()
+        if not isinstance(data, dict):
             return jsonify({
                 'success': False,
-                'error': '所需GPU不能為空'
+                'error': '請求內容必須是 JSON 物件'
             }), 400
         
-        new_command = add_command(command_text, required_gpu)
+        defaults = {k: v for k, v in data.items() if k not in ('commands', 'template', 'grid', 'params')}
         
-        if new_command:
+        if 'template' in data:
+            if 'commands' in data:
+                return jsonify({
+                    'success': False,
+                    'error': 'commands 與 template 不能同時使用'
+                }), 400
+            texts, error = expand_command_sweep(data['template'], data.get('grid'), data.get('params'))
+            if error:
+                return jsonify({
+                    'success': False,
+                    'error': error
+                }), 400
+            items = [{'command': text} for text in texts]
+        else:
+            items = data.get('commands')
+            if not isinstance(items, list) or not items:
+                return jsonify({
+                    'success': False,
+                    'error': '必須提供非空的 commands 陣列或 template'
+                }), 400
+            if len(items) > BULK_MAX_COMMANDS:
+                return jsonify({
+                    'success': False,
+                    'error': f'指令共 {len(items)} 筆，超過上限 {BULK_MAX_COMMANDS}'
+                }), 400
+        
+        owner = request_owner()
+        task_states = {}
+        entries = []
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                return jsonify({
+                    'success': False,
+                    'error': f'第 {i + 1} 筆指令必須是物件'
+                }), 400
+            fields, error = validate_command_fields({**defaults, **item}, owner, task_states)
+            if error:
+                return jsonify({
+                    'success': False,
+                    'error': f'第 {i + 1} 筆指令: {error}'
+                }), 400
+            entries.append(fields)
+        
+        uids = add_commands(entries)
+        
+        if uids is not None:
             return jsonify({
                 'success': True,
-                'command': new_command,
-                'message': '指令新增成功'
+                'uids': uids,
+                'count': len(uids),
+                'message': f'已新增 {len(uids)} 筆指令'
             })
         else:
             return jsonify({
@@ -988,13 +5735,14 @@ def add_command_api():
 
 @app.route('/commands/<command_uid>', methods=['DELETE'])
 def delete_command_api(command_uid):
-    """刪除指令"""
+    """刪除指令（等待它成功的指令一併取消）"""
     try:
-        success = delete_command(command_uid)
+        cancelled = cancel_command(command_uid)
         
-        if success:
+        if cancelled is not None:
             return jsonify({
                 'success': True,
+                'cancelled': cancelled,
                 'message': '指令刪除成功'
             })
         else:
@@ -1041,6 +5789,118 @@ def update_command_order_api(command_uid):
             'error': f'服務器錯誤: {str(e)}'
         }), 500
 
+@app.route('/commands/<command_uid>/priority', methods=['PUT'])
+def update_command_priority_api(command_uid):
+    """調整指令優先權"""
+    try:
+        data = request.get_json()
+        priority = data.get('priority')
+        
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            return jsonify({
+                'success': False,
+                'error': '優先權必須是整數'
+            }), 400
+        
+        if command_store.update(command_uid, {'priority': priority}):
+            logger.info(f"Command priority updated: UID={command_uid}, priority={priority}")
+            return jsonify({
+                'success': True,
+                'command': command_store.get(command_uid),
+                'message': '指令優先權更新成功'
+            })
+        else:
+            return jsonify({
+                'success': False,
+                'error': '指令不存在或更新失敗'
+            }), 404
+            
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'服務器錯誤: {str(e)}'
+        }), 500
+
+@app.route('/api/tasks/<task_uid>')
+def api_task_state(task_uid):
+    """任務目前的狀態（queued、running、completed、failed），供依賴查詢與叢集 aggregator 使用"""
+    state = task_state(task_uid)
+    if state is None:
+        return jsonify({
+            'success': False,
+            'error': '找不到任務'
+        }), 404
+    
+    result = {'success': True, 'uid': task_uid, 'state': state}
+    if state == 'queued':
+        command = command_store.get(task_uid) or {}
+        result['waiting_on'] = command.get('waiting_on', [])
+    elif cluster is None:
+        row = execution_index.task_status(task_uid)
+        result['exit_code'] = row['exit_code']
+        result['execution'] = row['directory']
+    return jsonify(result)
+
+@app.route('/api/scheduler')
+def api_scheduler():
+    """排程狀態：backfill 保留與佇列前段任務的預測執行時間"""
+    limit = max(1, min(request.args.get('limit', 20, type=int), 200))
+    reservation = backfill_reservation
+    return jsonify({
+        'success': True,
+        'backfill': SCHEDULER_BACKFILL,
+        'reservation': reservation,
+        'queue': [{
+            'uid': cmd['uid'],
+            'order': cmd['order'],
+            'required_gpu': cmd['required_gpu'],
+            'blocked': bool(cmd.get('waiting_on')),
+            'predicted_runtime': runtime_predictor.predict(cmd['command'])
+        } for cmd in command_store.list()[:limit]]
+    })
+
+@app.route('/api/collectors')
+def api_collectors():
+    """各收集器的健康狀態；stale 表示超過預期時間沒有取得資料，顯示的是最後一次的結果"""
+    return jsonify({'success': True, 'collectors': collector_engine.describe()})
+
+@app.route('/api/topology')
+def api_topology():
+    """本機 GPU 之間的連線類型（nvidia-smi topo -m），"count:N" 依此挑選 GPU 組合"""
+    links = gpu_topology.links()
+    if not links:
+        return jsonify({'success': False, 'error': gpu_topology.error or 'GPU topology is not available'}), 503
+    return jsonify({
+        'success': True,
+        'links': {str(a): {str(b): label for b, label in row.items()} for a, row in links.items()},
+        'scores': {str(a): {str(b): topology_link_score(label) for b, label in row.items()} for a, row in links.items()}
+    })
+
+@app.route('/api/fair-share')
+def api_fair_share():
+    """各擁有者的公平分配狀態與佇列中的指令數"""
+    queued = {}
+    for cmd in command_store.list():
+        owner = cmd.get('owner', DEFAULT_COMMAND_OWNER)
+        queued[owner] = queued.get(owner, 0) + 1
+    owners = fair_share.describe()
+    for owner, count in queued.items():
+        owners.setdefault(owner, {
+            'recent_gpu_seconds': 0.0,
+            'running_gpus': 0,
+            'weight': fair_share.weight(owner),
+            'penalty': 0.0
+        })['queued'] = count
+    for info in owners.values():
+        info.setdefault('queued', 0)
+    return jsonify({
+        'success': True,
+        'half_life_seconds': fair_share.half_life,
+        'penalty_per_gpu': fair_share.penalty_per_gpu,
+        'aging_per_hour': QUEUE_AGING_PER_HOUR,
+        'owners': owners
+    })
+
 @app.route('/api/executions/<execution_dir>/command')
 def api_execution_command(execution_dir):
     """API endpoint to get the content of command.sh"""
@@ -1080,9 +5940,17 @@ def run_execution_with_error_handling(execution_dir):
         # Save the output and error logs
         with open(os.path.join(execution_path, 'output.log'), 'w', encoding='utf-8') as output_log:
             output_log.write(result.stdout)
+        
+        # 輸出記錄已被覆寫，舊的行索引與壓縮檔失效
+        line_index_path = os.path.join(execution_path, 'output.log' + LOG_INDEX_SUFFIX)
+        if os.path.exists(line_index_path):
+            os.remove(line_index_path)
+        remove_log_archive(os.path.join(execution_path, 'output.log'))
 
         with open(os.path.join(execution_path, 'error.log'), 'w', encoding='utf-8') as error_log:
             error_log.write(result.stderr)
+        remove_log_archive(os.path.join(execution_path, 'error.log'))
+        execution_index.update(execution_dir)
 
         # Check for errors in the command execution
         if result.returncode != 0:
@@ -1099,21 +5967,240 @@ def run_execution_with_error_handling(execution_dir):
 
 # 重複的路由已移除，保留原有的路由定義
 
+# ========== 正式環境服務 ==========
+
+# 由快照直接回應的端點 -> collector 上產生該回應內容的函數
+SNAPSHOT_ENDPOINTS = {
+    'gpu_data': gpu_data_entry,
+    'disk_data': disk_data_entry,
+    'get_commands_api': commands_entry,
+    'api_running_tasks': running_tasks_entry
+}
+# 只讀取 SQLite 索引與執行目錄的端點，worker 自行處理；其餘一律轉送給 collector
+WORKER_LOCAL_ENDPOINTS = ('static', 'index', 'executions_page', 'execution_detail_page', 'api_executions',
+                          'api_execution_info', 'api_execution_output', 'api_execution_command',
+                          'get_logs', 'events')
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te',
+                      'trailers', 'transfer-encoding', 'upgrade', 'host', 'content-length'}
+
+collector_lock_file = None
+
+def acquire_collector_lock():
+    """取得 collector 鎖，避免兩個行程同時排程而重複啟動同一個任務"""
+    global collector_lock_file
+    lock_file = open(COLLECTOR_LOCK_FILE, 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise SystemExit(f"Another collector is already running here ({COLLECTOR_LOCK_FILE} is locked)")
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    collector_lock_file = lock_file
+
+def start_background_threads():
+    """啟動收集、排程與維護線程；每個工作目錄只能有一個行程執行"""
+    acquire_collector_lock()
+
+    # aggregator 以叢集輪詢取代本機 nvidia-smi
+    cluster_thread = threading.Thread(target=cluster.run, daemon=True) if cluster is not None else None
+
+    index_thread = threading.Thread(target=reconcile_execution_index, daemon=True)
+    scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
+    archive_thread = threading.Thread(target=archive_finished_logs, daemon=True)
+    retention_thread = threading.Thread(target=run_retention, daemon=True)
+
+    if cluster_thread is not None:
+        cluster_thread.start()
+    start_collectors()
+    adopt_running_tasks()
+    index_thread.start()
+    scheduler_thread.start()
+    archive_thread.start()
+    retention_thread.start()
+
+    logger.info(f"Monitoring threads started (role: {CLUSTER_ROLE})")
+    logger.info("Auto task execution system enabled")
+
+def build_snapshot_topics():
+    """collector 端：各快照端點的回應內容與 SSE 主題"""
+    topics = {endpoint: build().body for endpoint, build in SNAPSHOT_ENDPOINTS.items()}
+    for topic, data in broadcaster.topics().items():
+        topics['event:' + topic] = data.encode('utf-8')
+    return topics
+
+def publish_shared_snapshot(writer):
+    """狀態改變時（或至少每 SNAPSHOT_INTERVAL 秒）重新發佈共享快照"""
+    logger.info(f"Publishing shared snapshot to {writer.path}")
+    version = 0
+    last_topics = None
+    while True:
+        try:
+            # 預約與執行中任務的變化不經過 broadcaster，靠逾時定期檢查
+            changes = broadcaster.changes_since(version, timeout=SNAPSHOT_INTERVAL)
+            if changes:
+                version = changes[-1][1]
+            topics = build_snapshot_topics()
+            if topics != last_topics:
+                writer.publish(topics)
+                last_topics = topics
+        except Exception as e:
+            logger.error(f"Error publishing shared snapshot: {e}")
+            time.sleep(SNAPSHOT_INTERVAL)
+
+snapshot_reader = SharedSnapshotReader(SNAPSHOT_FILE) if SERVE_MODE == 'worker' else None
+snapshot_follower_pid = None
+collector_idle_connections = []
+collector_connections_lock = threading.Lock()
+
+def follow_shared_snapshot(parent_pid=None):
+    """worker 端：快照序號改變時把 SSE 主題轉交給本行程的 broadcaster"""
+    seq = None
+    while True:
+        if parent_pid is not None and os.getppid() != parent_pid:
+            # 啟動本行程的 collector 已結束
+            logger.info("Collector process exited, stopping worker")
+            os._exit(0)
+        try:
+            current, topics = snapshot_reader.refresh()
+            if current != seq:
+                seq = current
+                for name, data in topics.items():
+                    if name.startswith('event:'):
+                        broadcaster.publish_data(name[len('event:'):], data.decode('utf-8'))
+        except Exception as e:
+            logger.error(f"Error reading shared snapshot: {e}")
+        time.sleep(SNAPSHOT_POLL_INTERVAL)
+
+def ensure_snapshot_follower():
+    """在實際處理請求的行程中啟動 follower（gunicorn --preload 會在 fork 前匯入模組）"""
+    global snapshot_follower_pid
+    if snapshot_follower_pid == os.getpid():
+        return
+    with collector_connections_lock:
+        if snapshot_follower_pid == os.getpid():
+            return
+        snapshot_follower_pid = os.getpid()
+        parent_pid = int(os.environ['GPU_MONITOR_PARENT_PID']) if os.environ.get('GPU_MONITOR_PARENT_PID') else None
+        threading.Thread(target=follow_shared_snapshot, args=(parent_pid,), daemon=True).start()
+
+def forward_to_collector():
+    """將請求原樣轉送給 collector，閒置連線保留重複使用"""
+    host, _, port = COLLECTOR_ADDRESS.rpartition(':')
+    path = request.full_path if request.query_string else request.path
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    # 追加本站看到的來源，collector 只會信任到這一站為止
+    forwarded = request.headers.get('X-Forwarded-For')
+    headers['X-Forwarded-For'] = f"{forwarded}, {request.remote_addr}" if forwarded else request.remote_addr
+    if request.remote_addr not in TRUSTED_PROXIES:
+        # 用戶端直接送來的使用者名稱不能轉送，否則 collector 會當成 worker 提供的
+        headers = {k: v for k, v in headers.items() if k.lower() != 'x-remote-user'}
+    body = request.get_data()
+
+    for attempt in range(2):
+        with collector_connections_lock:
+            connection = collector_idle_connections.pop() if collector_idle_connections else None
+        reused = connection is not None
+        if connection is None:
+            connection = http.client.HTTPConnection(host, int(port), timeout=CLUSTER_TIMEOUT * 10)
+        try:
+            connection.request(request.method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, ConnectionError, OSError) as e:
+            connection.close()
+            if reused and attempt == 0:
+                continue
+            logger.error(f"Error forwarding {request.method} {path} to collector: {e}")
+            return jsonify({'success': False, 'error': f'Collector unavailable: {e}'}), 502
+        if response.will_close:
+            connection.close()
+        else:
+            with collector_connections_lock:
+                collector_idle_connections.append(connection)
+        return app.response_class(data, status=response.status, headers=[
+            (k, v) for k, v in response.getheaders() if k.lower() not in HOP_BY_HOP_HEADERS
+        ])
+
+@app.before_request
+def serve_worker_request():
+    """worker 模式：快照端點直接回應、只讀端點本地處理、其餘轉送 collector"""
+    if snapshot_reader is None:
+        return None
+    ensure_snapshot_follower()
+    endpoint = request.endpoint
+    if endpoint in SNAPSHOT_ENDPOINTS and request.method in ('GET', 'HEAD'):
+        seq, topics = snapshot_reader.refresh()
+        data = topics.get(endpoint)
+        if data is None:
+            return jsonify({'success': False, 'error': 'Collector has not published a snapshot yet'}), 503
+        return cached_json_response(response_cache.entry(endpoint, seq, lambda: data))
+    if endpoint in WORKER_LOCAL_ENDPOINTS:
+        return None
+    return forward_to_collector()
+
+def spawn_web_worker(listen_fd):
+    """以新的直譯器啟動 worker，繼承對外的監聽 socket"""
+    env = dict(os.environ, SERVE_MODE='worker', LISTEN_FD=str(listen_fd),
+               GPU_MONITOR_PARENT_PID=str(os.getpid()))
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env, pass_fds=(listen_fd,))
+
+def supervise_web_workers(listen_fd, count):
+    """維持 count 個 worker 行程，結束的 worker 會被重新啟動"""
+    workers = [spawn_web_worker(listen_fd) for _ in range(count)]
+    logger.info(f"Started {count} web workers: {[w.pid for w in workers]}")
+
+    def stop_workers(signum, frame):
+        for worker in workers:
+            worker.terminate()
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+
+    def watch():
+        while True:
+            for i, worker in enumerate(workers):
+                if worker.poll() is not None:
+                    logger.warning(f"Web worker {worker.pid} exited with {worker.returncode}, restarting")
+                    workers[i] = spawn_web_worker(listen_fd)
+            time.sleep(1)
+    threading.Thread(target=watch, daemon=True).start()
+
 if __name__ == '__main__':
+    host = os.environ.get("HOST", "0.0.0.0")
+    port = int(os.environ.get("PORT", "5000"))
+    debug = os.environ.get("DEBUG", "True").lower() in ("1", "true", "yes")
+
+    if SERVE_MODE == 'worker':
+        # 由 production 模式啟動時沿用父行程的監聽 socket
+        listen_fd = int(os.environ['LISTEN_FD']) if os.environ.get('LISTEN_FD') else None
+        logger.info(f"Starting read-only web worker (snapshot: {SNAPSHOT_FILE}, collector: {COLLECTOR_ADDRESS})")
+        ensure_snapshot_follower()
+        make_server(host, port, app, threaded=True, fd=listen_fd).serve_forever()
+        raise SystemExit(0)
+
     logger.info("Starting GPU Monitor Application")
     logger.info(f"Commands file: {COMMANDS_FILE}")
     logger.info(f"Log file: {LOG_FILE}")
     logger.info(f"Task execution directory: {EXECUTION_LOG_DIR}")
-    
-    # 啟動監控線程
-    gpu_thread = threading.Thread(target=parse_nvidia_smi, daemon=True)
-    disk_thread = threading.Thread(target=parse_disk_usage, daemon=True)
-    
-    gpu_thread.start()
-    disk_thread.start()
-    
-    logger.info("Monitoring threads started")
-    logger.info("Auto task execution system enabled")
-    logger.info("Starting Flask web server on 0.0.0.0:5000")
-    
-    app.run(host='0.0.0.0', port=5000, debug=True)
+
+    if SERVE_MODE in ('production', 'collector'):
+        start_background_threads()
+        snapshot_writer = SharedSnapshotWriter(SNAPSHOT_FILE)
+        threading.Thread(target=publish_shared_snapshot, args=(snapshot_writer,), daemon=True).start()
+        if SERVE_MODE == 'production':
+            listener = socket.create_server((host, port), backlog=128)
+            listener.set_inheritable(True)
+            supervise_web_workers(listener.fileno(), WEB_WORKERS)
+            logger.info(f"Serving on {host}:{port} with {WEB_WORKERS} workers")
+        collector_host, _, collector_port = COLLECTOR_ADDRESS.rpartition(':')
+        logger.info(f"Starting collector server on {COLLECTOR_ADDRESS}")
+        make_server(collector_host, int(collector_port), app, threaded=True).serve_forever()
+    else:
+        # debug 的 reloader 會在監看行程與實際服務的子行程各執行一次這裡，只在子行程啟動背景線程
+        if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_background_threads()
+        logger.info(f"Starting Flask web server on {host}:{port}")
+        app.run(host=host, port=port, debug=debug)
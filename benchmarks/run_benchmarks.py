@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+"""app.py 的效能基準測試
+
+在暫存目錄中匯入 app（指令佇列、執行記錄與索引都建立在該目錄下，不會碰到正式資料），
+以合成資料量測下列項目，結果寫成 JSON 以便比較不同版本：
+
+    parse       nvidia-smi 表格與 CSV 解析（8 / 64 / 512 張 GPU，依 app.py 內的範例輸出產生）與 topo -m
+    scheduler   check_gpu_availability（含 "count:N" 拓撲挑選）與 auto_execute_tasks（10k 筆佇列）
+    queue       佇列新增、刪除、調整順序
+    executions  /api/executions、/info、/output（1k～100k 個執行目錄與大型 output.log）
+    responses   /gpu_data、/commands 的重新序列化、快取命中（gzip）與 304
+
+用法：
+    python benchmarks/run_benchmarks.py                      # 預設規模
+    python benchmarks/run_benchmarks.py --quick              # 小規模，快速檢查
+    python benchmarks/run_benchmarks.py --full               # 包含 100k 執行目錄
+    python benchmarks/run_benchmarks.py --only parse,queue
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/previous.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'fixtures'))
+
+from fake_nvidia_smi import generate_state, load_state, render_query, render_table, render_topo  # noqa: E402
+
+GROUPS = ('parse', 'scheduler', 'queue', 'executions', 'responses')
+
+SCALES = {
+    'quick': {'gpus': (8, 64), 'extra_processes': 4, 'queue_size': 1000, 'trees': (1000,),
+              'large_log_mb': 8, 'repeat': 5},
+    'default': {'gpus': (8, 64, 512), 'extra_processes': 8, 'queue_size': 10000, 'trees': (1000, 10000),
+                'large_log_mb': 64, 'repeat': 20},
+    'full': {'gpus': (8, 64, 512), 'extra_processes': 8, 'queue_size': 10000, 'trees': (1000, 10000, 100000),
+             'large_log_mb': 256, 'repeat': 20},
+}
+
+app = None  # 在暫存目錄中匯入
+
+
+class Results:
+    """收集每項量測的統計值"""
+
+    def __init__(self):
+        self.entries = {}
+
+    def measure(self, name, fn, repeat, setup=None, **params):
+        times = []
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        self.record(name, times, **params)
+
+    def record(self, name, times, **params):
+        ordered = sorted(times)
+        entry = {
+            'repeat': len(times),
+            'min': ordered[0],
+            'median': statistics.median(ordered),
+            'mean': statistics.fmean(ordered),
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            'max': ordered[-1],
+            'stdev': statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+            'params': params
+        }
+        self.entries[name] = entry
+        print(f"  {name:<48} median {format_seconds(entry['median']):>10}   min {format_seconds(entry['min']):>10}")
+
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f}us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.2f}ms"
+    return f"{seconds:.3f}s"
+
+
+def import_app(workdir):
+    """在暫存目錄中匯入 app，並把日誌降到 WARNING 以免寫檔干擾量測"""
+    global app
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as app_module
+    app = app_module
+    app.logger.setLevel(logging.WARNING)
+    return app
+
+
+def make_state(gpu_count, extra_processes):
+    # load_state 會補上 index、uuid 等欄位
+    state_file = os.path.join(tempfile.gettempdir(), f"bench_state_{os.getpid()}.json")
+    with open(state_file, 'w', encoding='utf-8') as f:
+        json.dump(generate_state(gpu_count, extra_processes), f)
+    os.environ['FAKE_NVIDIA_SMI_STATE'] = state_file
+    try:
+        return load_state()
+    finally:
+        del os.environ['FAKE_NVIDIA_SMI_STATE']
+        os.remove(state_file)
+
+
+# ========== parse ==========
+
+def bench_parse(results, scale):
+    print("parse")
+    for gpu_count in scale['gpus']:
+        state = make_state(gpu_count, scale['extra_processes'])
+        table = render_table(state)
+        gpu_rows = render_query('gpu', app.NVIDIA_SMI_GPU_FIELDS, state).splitlines()
+        app_rows = render_query('apps', app.NVIDIA_SMI_APP_FIELDS, state).splitlines()
+        params = {'gpus': gpu_count, 'processes': len(state['processes'])}
+
+        results.measure(f"parse_table[{gpu_count}]",
+                        lambda: app.parse_nvidia_smi_table(table), scale['repeat'], **params)
+
+        def parse_csv():
+            for row in gpu_rows:
+                app.parse_gpu_query_row(row)
+            for row in app_rows:
+                app.parse_compute_app_row(row)
+
+        results.measure(f"parse_csv_rows[{gpu_count}]", parse_csv, scale['repeat'], **params)
+
+    with open(os.path.join(REPO_ROOT, 'fixtures', 'topo', 'dgx_a100_8gpu.txt'), 'r', encoding='utf-8') as f:
+        topo = f.read()
+    results.measure("parse_topo[dgx_a100_8gpu]", lambda: app.parse_nvidia_smi_topo(topo), scale['repeat'])
+
+
+# ========== scheduler ==========
+
+def load_gpu_snapshot(gpu_count, extra_processes, all_busy=False):
+    gpu_snapshot, gpu_processes = app.parse_nvidia_smi_table(render_table(make_state(gpu_count, extra_processes)))
+    if all_busy:
+        for gpu_data in gpu_snapshot.values():
+            gpu_data['in_use'] = True
+    app.gpu_info = gpu_snapshot
+    app.processes = gpu_processes
+
+
+def fill_queue(count, make_command):
+    app.command_store.replace([])
+    app.command_store.add_many([make_command(i) for i in range(count)])
+
+
+def bench_scheduler(results, scale):
+    print("scheduler")
+    queue_size = scale['queue_size']
+    repeat = max(3, scale['repeat'] // 4)
+
+    def make_command(i):
+        # 混合各種 GPU 需求
+        required_gpu = ('any', '0', '1,2', 'RTX 4090', '3')[i % 5]
+        command = {'uid': str(uuid.uuid4()), 'command': f'python train.py --seed {i}',
+                   'required_gpu': required_gpu, 'created_at': datetime.now().isoformat()}
+        if i % 3 == 0:
+            command['required_memory'] = 2048
+            command['max_util'] = 90
+        return command
+
+    fill_queue(queue_size, make_command)
+    load_gpu_snapshot(8, scale['extra_processes'])
+    requests = [('any', None, None), ('0', None, None), ('1,2', None, None),
+                ('RTX 4090', None, None), ('any', 2048, 90)]
+
+    def check_all():
+        for required_gpu, required_memory, max_util in requests:
+            app.check_gpu_availability(required_gpu, required_memory, max_util)
+
+    results.measure("check_gpu_availability[5 requests, 8 gpus]", check_all, scale['repeat'])
+
+    # "count:N"：16 張閒置 GPU，count:4 窮舉 1820 種組合，count:8 超過上限改用貪婪法
+    load_gpu_snapshot(16, scale['extra_processes'])
+    for gpu_data in app.gpu_info.values():
+        gpu_data['in_use'] = False
+    app.gpu_topology._links = app.parse_nvidia_smi_topo(render_topo(16))
+    for count in (2, 4, 8):
+        results.measure(f"check_gpu_availability[count:{count}, 16 gpus]",
+                        lambda: app.check_gpu_availability(f'count:{count}'), scale['repeat'], count=count)
+    load_gpu_snapshot(8, scale['extra_processes'])
+
+    # 所有 GPU 都忙碌：掃描整個佇列但不啟動任何任務
+    load_gpu_snapshot(8, scale['extra_processes'], all_busy=True)
+    original_execute_task = app.execute_task
+    app.execute_task = lambda *args, **kwargs: True
+    try:
+        results.measure(f"auto_execute_tasks[{queue_size} queued, no fit]",
+                        app.auto_execute_tasks, repeat, queue=queue_size)
+
+        # 九成指令在等待尚未結束的上游任務：就緒索引讓排程器只看其餘一成
+        def make_blocked_command(i):
+            command = make_command(i)
+            if i % 10:
+                command['depends_on'] = command['waiting_on'] = ['upstream-still-running']
+            return command
+
+        fill_queue(queue_size, make_blocked_command)
+        results.measure(f"auto_execute_tasks[{queue_size} queued, 90% blocked, no fit]",
+                        app.auto_execute_tasks, repeat, queue=queue_size)
+        fill_queue(queue_size, make_command)
+
+        # GPU 有空位：每輪啟動數個任務並自佇列移除，之後重新填滿佇列
+        load_gpu_snapshot(8, scale['extra_processes'])
+
+        def reset():
+            app.gpu_reservations = app.GpuReservationLedger(app.GPU_RESERVATION_GRACE)
+            if len(app.command_store) < queue_size:
+                fill_queue(queue_size, make_command)
+
+        results.measure(f"auto_execute_tasks[{queue_size} queued, dispatch]",
+                        app.auto_execute_tasks, repeat, setup=reset, queue=queue_size)
+    finally:
+        app.execute_task = original_execute_task
+        app.gpu_reservations = app.GpuReservationLedger(app.GPU_RESERVATION_GRACE)
+        app.command_store.replace([])
+
+
+# ========== queue ==========
+
+def bench_queue(results, scale):
+    print("queue")
+    queue_size = scale['queue_size']
+    repeat = scale['repeat']
+    fill_queue(queue_size, lambda i: {'uid': str(uuid.uuid4()), 'command': f'echo {i}',
+                                      'required_gpu': 'any', 'created_at': datetime.now().isoformat()})
+    added = []
+
+    results.measure(f"add_command[{queue_size} queued]",
+                    lambda: added.append(app.add_command('echo bench', 'any')['uid']), repeat, queue=queue_size)
+    results.measure(f"delete_command[{queue_size} queued]",
+                    lambda: app.delete_command(added.pop()), repeat, queue=queue_size)
+
+    uids = app.command_store.uids()
+    results.measure(f"update_command_order[to front, {queue_size} queued]",
+                    lambda: app.update_command_order(uids[-1], 1), repeat, queue=queue_size)
+    results.measure(f"update_command_order[to back, {queue_size} queued]",
+                    lambda: app.update_command_order(uids[0], queue_size), repeat, queue=queue_size)
+    results.measure(f"get_commands[{queue_size} queued]", app.get_commands, repeat, queue=queue_size)
+
+    batch = 100
+    results.measure(f"add_many[{batch} at once, {queue_size} queued]",
+                    lambda: app.command_store.add_many([{'uid': str(uuid.uuid4()), 'command': 'echo batch',
+                                                         'required_gpu': 'any'} for _ in range(batch)]),
+                    max(3, repeat // 4), queue=queue_size, batch=batch)
+
+    # 參數掃描：逐筆新增與一次批次新增（單一筆日誌記錄）
+    sweep = 300
+    entries = [{'command_text': f'python train.py --seed {i}', 'required_gpu': 'any'} for i in range(sweep)]
+    results.measure(f"add_command x{sweep}[{queue_size} queued]",
+                    lambda: [app.add_command(**fields) for fields in entries],
+                    max(3, repeat // 20), queue=queue_size, batch=sweep)
+    results.measure(f"add_commands[{sweep} at once, {queue_size} queued]",
+                    lambda: app.add_commands(entries), max(3, repeat // 20), queue=queue_size, batch=sweep)
+    app.command_store.replace([])
+
+
+# ========== responses ==========
+
+def bench_responses(results, scale):
+    print("responses")
+    client = app.app.test_client()
+    repeat = scale['repeat']
+
+    def reset_cache():
+        app.response_cache = app.ResponseCache()
+
+    def measure_endpoint(url, label, **params):
+        results.measure(f"{url}[{label}, rebuild]", lambda: client.get(url), repeat, setup=reset_cache, **params)
+        etag = client.get(url, headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+        results.measure(f"{url}[{label}, cached gzip]",
+                        lambda: client.get(url, headers={'Accept-Encoding': 'gzip'}), repeat, **params)
+        results.measure(f"{url}[{label}, 304]",
+                        lambda: client.get(url, headers={'If-None-Match': etag}), repeat, **params)
+
+    for gpu_count in scale['gpus']:
+        gpu_snapshot, gpu_processes = app.parse_nvidia_smi_table(
+            render_table(make_state(gpu_count, scale['extra_processes'])))
+        app.publish_gpu_snapshot(gpu_snapshot, gpu_processes)
+        measure_endpoint('/gpu_data', f"{gpu_count} GPUs", gpus=gpu_count)
+
+    queue_size = scale['queue_size']
+    fill_queue(queue_size, lambda i: {'uid': str(uuid.uuid4()), 'command': f'echo {i}',
+                                      'required_gpu': 'any', 'created_at': datetime.now().isoformat()})
+    measure_endpoint('/commands', f"{queue_size} queued", queue=queue_size)
+    app.command_store.replace([])
+
+
+# ========== executions ==========
+
+def write_execution_dir(root, i, large_log_bytes=0):
+    """依 execute_task 的格式產生一個執行目錄"""
+    task_uid = str(uuid.UUID(int=i))
+    dir_name = f"20250101_{i // 3600 % 24:02d}{i // 60 % 60:02d}{i % 60:02d}_task_{task_uid}"
+    dir_path = os.path.join(root, dir_name)
+    os.makedirs(dir_path)
+    gpu_id = i % 8
+    with open(os.path.join(dir_path, 'command.txt'), 'w', encoding='utf-8') as f:
+        f.write(f"Task UID: {task_uid}\nRequired GPU: {gpu_id}\nActual GPU IDs: [{gpu_id}]\n"
+                f"\n=== Command to Execute ===\npython train.py --run {i}\n" + "=" * 50 + "\n")
+
+    status = i % 10  # 7 成功、2 失敗、1 執行中
+    with open(os.path.join(dir_path, 'output.log'), 'w', encoding='utf-8') as f:
+        f.write(f"=== Task Execution Log ===\nTask UID: {task_uid}\n")
+        if large_log_bytes:
+            line = f"step {{}} loss 0.{i:06d} lr 0.0001 throughput 1234.5 samples/s\n"
+            written = 0
+            step = 0
+            chunk = []
+            while written < large_log_bytes:
+                text = line.format(step)
+                chunk.append(text)
+                written += len(text)
+                step += 1
+                if len(chunk) >= 10000:
+                    f.write(''.join(chunk))
+                    chunk = []
+            f.write(''.join(chunk))
+        else:
+            f.write(f"epoch 1 loss 0.5\nepoch 2 loss 0.4\n")
+        if status < 9:
+            exit_code = 0 if status < 7 else 1
+            f.write("\n" + "=" * 60 + f"\nTask completed at: 2025-01-01T00:00:00+00:00\nExit code: {exit_code}\n" + "=" * 60 + "\n")
+    return dir_name
+
+
+def bench_executions(results, scale, workdir):
+    print("executions")
+    client = app.app.test_client()
+    repeat = scale['repeat']
+    large_log_bytes = scale['large_log_mb'] * 1024 * 1024
+
+    for tree_size in scale['trees']:
+        root = os.path.join(workdir, f"tree_{tree_size}")
+        log_dir = os.path.join(root, 'task_executions')
+        os.makedirs(log_dir)
+        start = time.perf_counter()
+        large_dir = write_execution_dir(log_dir, 0, large_log_bytes)
+        small_dir = None
+        for i in range(1, tree_size):
+            dir_name = write_execution_dir(log_dir, i)
+            small_dir = small_dir or dir_name
+        print(f"  (generated {tree_size} execution directories in {time.perf_counter() - start:.1f}s)")
+
+        app.EXECUTION_LOG_DIR = log_dir
+        app.execution_index = app.ExecutionIndex(os.path.join(root, 'task_executions.db'))
+        params = {'directories': tree_size}
+
+        start = time.perf_counter()
+        app.execution_index.reconcile()
+        results.record(f"execution_index_build[{tree_size}]", [time.perf_counter() - start], **params)
+        results.measure(f"execution_index_reconcile[{tree_size}]",
+                        app.execution_index.reconcile, max(3, repeat // 4), **params)
+
+        def get(url):
+            def call():
+                response = client.get(url)
+                assert response.status_code == 200, (url, response.status_code)
+                response.get_data()
+            return call
+
+        results.measure(f"api_executions[first page, {tree_size}]",
+                        get('/api/executions?limit=50'), repeat, **params)
+        results.measure(f"api_executions[sort output_size, {tree_size}]",
+                        get('/api/executions?limit=50&sort=output_size&order=desc'), repeat, **params)
+        results.measure(f"api_executions[status+gpu+command filter, {tree_size}]",
+                        get('/api/executions?limit=50&status=failed&gpu=3&command=train'), repeat, **params)
+
+        # 翻到中間頁
+        cursor = None
+        for _ in range(5):
+            response = client.get('/api/executions?limit=50' + (f'&cursor={cursor}' if cursor else ''))
+            cursor = response.get_json().get('next_cursor')
+        if cursor:
+            results.measure(f"api_executions[cursor page 6, {tree_size}]",
+                            get(f'/api/executions?limit=50&cursor={cursor}'), repeat, **params)
+
+        results.measure(f"api_execution_info[small log, {tree_size}]",
+                        get(f'/api/executions/{small_dir}/info'), repeat, **params)
+        results.measure(f"api_execution_info[{scale['large_log_mb']}MB log, {tree_size}]",
+                        get(f'/api/executions/{large_dir}/info'), repeat,
+                        log_bytes=large_log_bytes, **params)
+
+        index_file = os.path.join(log_dir, large_dir, 'output.log' + app.LOG_INDEX_SUFFIX)
+        results.measure(f"api_execution_output[tail 1000 lines, cold, {scale['large_log_mb']}MB]",
+                        get(f'/api/executions/{large_dir}/output?tail_lines=1000'), max(3, repeat // 4),
+                        setup=lambda: os.path.exists(index_file) and os.remove(index_file),
+                        log_bytes=large_log_bytes)
+        results.measure(f"api_execution_output[tail 1000 lines, warm, {scale['large_log_mb']}MB]",
+                        get(f'/api/executions/{large_dir}/output?tail_lines=1000'), repeat,
+                        log_bytes=large_log_bytes)
+        results.measure(f"api_execution_output[from_line middle, {scale['large_log_mb']}MB]",
+                        get(f'/api/executions/{large_dir}/output?from_line={large_log_bytes // 120}&lines=1000'), repeat,
+                        log_bytes=large_log_bytes)
+
+        shutil.rmtree(root)
+
+
+# ========== 輸出 ==========
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(current, previous_file):
+    with open(previous_file, 'r', encoding='utf-8') as f:
+        previous = json.load(f)['results']
+    print(f"\ncompared with {previous_file} (median):")
+    for name, entry in current.items():
+        if name not in previous:
+            continue
+        before, after = previous[name]['median'], entry['median']
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"  {name:<48} {format_seconds(before):>10} -> {format_seconds(after):>10}  {change:+6.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument('--quick', action='store_true', help='small sizes for a fast sanity run')
+    size.add_argument('--full', action='store_true', help='include 100k execution directories')
+    parser.add_argument('--only', help=f"comma separated groups: {','.join(GROUPS)}")
+    parser.add_argument('--output', help='result JSON path (default benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--compare', help='previous result JSON to compare against')
+    parser.add_argument('--keep-workdir', action='store_true', help='do not delete the temporary working directory')
+    args = parser.parse_args()
+
+    scale_name = 'quick' if args.quick else 'full' if args.full else 'default'
+    scale = SCALES[scale_name]
+    groups = args.only.split(',') if args.only else list(GROUPS)
+    unknown = set(groups) - set(GROUPS)
+    if unknown:
+        parser.error(f"unknown groups: {', '.join(sorted(unknown))}")
+
+    output = args.output or os.path.join(REPO_ROOT, 'benchmarks', 'results',
+                                         datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+    output = os.path.abspath(output)
+    compare_file = os.path.abspath(args.compare) if args.compare else None
+
+    workdir = tempfile.mkdtemp(prefix='gpu-monitor-bench-')
+    results = Results()
+    try:
+        import_app(workdir)
+        if 'parse' in groups:
+            bench_parse(results, scale)
+        if 'scheduler' in groups:
+            bench_scheduler(results, scale)
+        if 'queue' in groups:
+            bench_queue(results, scale)
+        if 'executions' in groups:
+            bench_executions(results, scale, workdir)
+        if 'responses' in groups:
+            bench_responses(results, scale)
+    finally:
+        os.chdir(REPO_ROOT)
+        if args.keep_workdir:
+            print(f"working directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'scale': scale_name,
+            'groups': groups
+        },
+        'results': results.entries
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nresults written to {output}")
+
+    if compare_file:
+        compare(results.entries, compare_file)
+
+
+if __name__ == '__main__':
+    main()
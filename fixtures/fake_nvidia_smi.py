@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""假的 nvidia-smi，用於在沒有 GPU 的機器上測試收集器
+
+用法：
+    NVIDIA_SMI_BIN=fixtures/fake_nvidia_smi.py python app.py
+
+支援的呼叫方式：
+    fake_nvidia_smi.py                                   # 預設文字表格
+    fake_nvidia_smi.py --query-gpu=... --format=csv,noheader,nounits [-lms N]
+    fake_nvidia_smi.py --query-compute-apps=... --format=csv,noheader,nounits [-lms N]
+    fake_nvidia_smi.py topo -m                           # GPU 拓撲矩陣
+
+環境變數：
+    FAKE_NVIDIA_SMI_GPUS        GPU 數量（預設 8，依範例資料循環產生）
+    FAKE_NVIDIA_SMI_STATE       JSON 狀態檔，每次取樣重新讀取：
+                                {"gpus": [{"name", "mem_used", "mem_total", "util"}],
+                                 "processes": [{"gpu", "pid", "type", "name", "mem"}]}
+    FAKE_NVIDIA_SMI_EXIT_AFTER  迴圈模式下輸出幾次取樣後結束（測試自動重啟）
+    FAKE_NVIDIA_SMI_HANG        檔案路徑；檔案存在時每次取樣前都卡住直到檔案被刪除（模擬驅動卡死）
+    FAKE_NVIDIA_SMI_TOPO        topo -m 輸出的檔案（例如 fixtures/topo/ 下擷取的範例）；
+                                未設定時依 GPU 數量產生：兩兩以 NVLink 相連，前半與後半分屬兩個 socket
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+# 與 app.py 中 parse_nvidia_smi_table 註解內的範例輸出相同
+SAMPLE_GPUS = [
+    {'name': 'NVIDIA GeForce RTX 4070', 'fan': 0, 'temp': 35, 'perf': 'P8', 'pwr': 8, 'cap': 200, 'mem_used': 15, 'mem_total': 12282, 'util': 0},
+    {'name': 'NVIDIA GeForce RTX 4090', 'fan': 12, 'temp': 45, 'perf': 'P2', 'pwr': 110, 'cap': 450, 'mem_used': 8124, 'mem_total': 24576, 'util': 56},
+    {'name': 'NVIDIA GeForce RTX 4080', 'fan': 20, 'temp': 49, 'perf': 'P2', 'pwr': 85, 'cap': 320, 'mem_used': 4200, 'mem_total': 16384, 'util': 70},
+    {'name': 'NVIDIA GeForce RTX 4070 Ti', 'fan': 5, 'temp': 40, 'perf': 'P3', 'pwr': 60, 'cap': 285, 'mem_used': 300, 'mem_total': 12282, 'util': 12},
+    {'name': 'NVIDIA GeForce RTX 4060', 'fan': 0, 'temp': 33, 'perf': 'P8', 'pwr': 6, 'cap': 115, 'mem_used': 10, 'mem_total': 8192, 'util': 0},
+    {'name': 'NVIDIA GeForce RTX 4070', 'fan': 45, 'temp': 60, 'perf': 'P1', 'pwr': 180, 'cap': 200, 'mem_used': 12000, 'mem_total': 12282, 'util': 95},
+    {'name': 'NVIDIA GeForce RTX 3080', 'fan': 18, 'temp': 51, 'perf': 'P2', 'pwr': 210, 'cap': 320, 'mem_used': 10000, 'mem_total': 10240, 'util': 88},
+    {'name': 'NVIDIA GeForce RTX 3060', 'fan': 2, 'temp': 37, 'perf': 'P8', 'pwr': 9, 'cap': 170, 'mem_used': 200, 'mem_total': 12288, 'util': 2},
+]
+
+SAMPLE_PROCESSES = [
+    {'gpu': 0, 'pid': 1059, 'type': 'G', 'name': '/usr/lib/xorg/Xorg', 'mem': 4},
+    {'gpu': 1, 'pid': 23450, 'type': 'C', 'name': 'python3', 'mem': 4096},
+    {'gpu': 1, 'pid': 23451, 'type': 'C', 'name': '/usr/bin/jupyter-notebook', 'mem': 4028},
+    {'gpu': 2, 'pid': 24500, 'type': 'C', 'name': '/usr/bin/python3', 'mem': 4200},
+    {'gpu': 3, 'pid': 24800, 'type': 'C', 'name': '/opt/render/render_worker', 'mem': 300},
+    {'gpu': 5, 'pid': 25333, 'type': 'C', 'name': '/home/jimmy/train_model.py', 'mem': 12000},
+    {'gpu': 6, 'pid': 26000, 'type': 'C', 'name': '/home/jimmy/stable_diffusion.py', 'mem': 8000},
+    {'gpu': 6, 'pid': 26001, 'type': 'C', 'name': '/usr/lib/python3.11/tensorflow', 'mem': 2000},
+    {'gpu': 7, 'pid': 26200, 'type': 'C', 'name': '/usr/lib/firefox', 'mem': 200},
+]
+
+
+def generate_state(gpu_count, extra_processes=0):
+    """依範例資料循環產生指定數量的 GPU 與程序
+
+    extra_processes 為每張 GPU 額外產生的小型運算程序數，用於模擬大量程序的機器。
+    """
+    gpus = []
+    procs = []
+    for idx in range(gpu_count):
+        base = idx % len(SAMPLE_GPUS)
+        gpus.append(dict(SAMPLE_GPUS[base]))
+        for proc in SAMPLE_PROCESSES:
+            if proc['gpu'] == base:
+                procs.append(dict(proc, gpu=idx, pid=proc['pid'] + (idx // len(SAMPLE_GPUS)) * 100000))
+        for n in range(extra_processes):
+            procs.append({'gpu': idx, 'pid': 1000000 + idx * 1000 + n, 'type': 'C',
+                          'name': f'/opt/jobs/worker_{n}.py', 'mem': 64})
+    return {'gpus': gpus, 'processes': procs}
+
+
+def load_state():
+    state_file = os.environ.get('FAKE_NVIDIA_SMI_STATE')
+    if state_file:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    else:
+        state = generate_state(int(os.environ.get('FAKE_NVIDIA_SMI_GPUS', '8')))
+
+    for idx, gpu in enumerate(state['gpus']):
+        gpu.setdefault('index', idx)
+        gpu.setdefault('uuid', f"GPU-{idx:08x}-fake-0000-0000-000000000000")
+        for key, default in (('fan', 0), ('temp', 30), ('perf', 'P8'), ('pwr', 0), ('cap', 0), ('util', 0), ('mem_used', 0)):
+            gpu.setdefault(key, default)
+    for proc in state['processes']:
+        proc.setdefault('type', 'C')
+        if isinstance(proc.get('mem'), str):
+            proc['mem'] = int(proc['mem'].rstrip('MiB') or 0)
+    return state
+
+
+def render_table(state):
+    """輸出與真實 nvidia-smi 相同版面的文字表格"""
+    out = [datetime.now().strftime("%a %b %d %H:%M:%S %Y")]
+    out.append("+-----------------------------------------------------------------------------------------+")
+    out.append("| NVIDIA-SMI 570.133.07             Driver Version: 570.133.07     CUDA Version: 12.8     |")
+    out.append("|-----------------------------------------+------------------------+----------------------+")
+    out.append("| GPU  Name                 Persistence-M | Bus-Id          Disp.A | Volatile Uncorr. ECC |")
+    out.append("| Fan  Temp   Perf          Pwr:Usage/Cap |           Memory-Usage | GPU-Util  Compute M. |")
+    out.append("|                                         |                        |               MIG M. |")
+    out.append("|=========================================+========================+======================|")
+    for gpu in state['gpus']:
+        bus = f"{gpu['index'] + 1:08X}:{(gpu['index'] + 1) % 256:02X}:00.0"
+        out.append(f"| {gpu['index']:>3}  {gpu['name'][:26]:<26}     Off | {bus}  Off  |                  N/A |")
+        pwr = f"{gpu['pwr']}W / {gpu['cap']}W"
+        mem = f"{gpu['mem_used']}MiB / {gpu['mem_total']}MiB"
+        out.append(f"| {gpu['fan']:>2}%   {gpu['temp']}C    {gpu['perf']}  {pwr:>20}   | {mem:>21}  |    {gpu['util']:>3}%      Default  |")
+        out.append("|                                         |                        |                  N/A |")
+        out.append("+-----------------------------------------+------------------------+----------------------+")
+    out.append("")
+    if state['processes']:
+        out.append("+-----------------------------------------------------------------------------------------+")
+        out.append("| Processes:                                                                              |")
+        out.append("|  GPU   GI   CI              PID   Type   Process name                        GPU Memory |")
+        out.append("|        ID   ID                                                               Usage      |")
+        out.append("|=========================================================================================|")
+        for proc in state['processes']:
+            out.append(f"|  {proc['gpu']:>3}   N/A  N/A   {proc['pid']:>12}      {proc['type']}   {proc['name'][:36]:<36} {str(proc['mem']) + 'MiB':>9} |")
+        out.append("+-----------------------------------------------------------------------------------------+")
+    return "\n".join(out) + "\n"
+
+
+def render_query(kind, fields, state):
+    timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S.%f")[:-3]
+    rows = []
+    if kind == 'gpu':
+        for gpu in state['gpus']:
+            values = {
+                'timestamp': timestamp,
+                'index': gpu['index'],
+                'uuid': gpu['uuid'],
+                'name': gpu['name'],
+                'memory.used': gpu['mem_used'],
+                'memory.total': gpu['mem_total'],
+                'utilization.gpu': gpu['util'],
+                'temperature.gpu': gpu['temp'],
+            }
+            rows.append(', '.join(str(values.get(field, '[N/A]')) for field in fields))
+    else:
+        uuids = {gpu['index']: gpu['uuid'] for gpu in state['gpus']}
+        for proc in state['processes']:
+            if proc['type'] not in ('C', 'C+G'):
+                continue
+            values = {
+                'timestamp': timestamp,
+                'gpu_uuid': uuids.get(proc['gpu'], ''),
+                'pid': proc['pid'],
+                'process_name': proc['name'],
+                'used_memory': proc['mem'],
+                'used_gpu_memory': proc['mem'],
+            }
+            rows.append(', '.join(str(values.get(field, '[N/A]')) for field in fields))
+    return "".join(row + "\n" for row in rows)
+
+
+def render_topo(gpu_count):
+    """輸出與 nvidia-smi topo -m 相同格式的矩陣"""
+    def link(a, b):
+        if a // 2 == b // 2:
+            return 'NV4'
+        return 'NODE' if a * 2 // gpu_count == b * 2 // gpu_count else 'SYS'
+
+    header = [f'GPU{i}' for i in range(gpu_count)] + ['CPU Affinity', 'NUMA Affinity', 'GPU NUMA ID']
+    out = ['\t' + '\t'.join(header)]
+    for a in range(gpu_count):
+        node = a * 2 // gpu_count
+        cells = [' X ' if a == b else link(a, b) for b in range(gpu_count)]
+        out.append(f"GPU{a}\t" + '\t'.join(cells) + f"\t{node * 16}-{node * 16 + 15}\t{node}\t\tN/A")
+    out.append("")
+    out.append("Legend:")
+    out.append("")
+    out.append("  X    = Self")
+    out.append("  SYS  = Connection traversing PCIe as well as the SMP interconnect between NUMA nodes (e.g., QPI/UPI)")
+    out.append("  NODE = Connection traversing PCIe as well as the interconnect between PCIe Host Bridges within a NUMA node")
+    out.append("  PHB  = Connection traversing PCIe as well as a PCIe Host Bridge (typically the CPU)")
+    out.append("  PXB  = Connection traversing multiple PCIe bridges (without traversing the PCIe Host Bridge)")
+    out.append("  PIX  = Connection traversing at most a single PCIe bridge")
+    out.append("  NV#  = Connection traversing a bonded set of # NVLinks")
+    return "\n".join(out) + "\n"
+
+
+def wait_while_hung():
+    hang_file = os.environ.get('FAKE_NVIDIA_SMI_HANG')
+    while hang_file and os.path.exists(hang_file):
+        time.sleep(0.1)
+
+
+def main(argv):
+    wait_while_hung()
+    if argv[:1] == ['topo']:
+        topo_file = os.environ.get('FAKE_NVIDIA_SMI_TOPO')
+        if topo_file:
+            with open(topo_file, 'r', encoding='utf-8') as f:
+                sys.stdout.write(f.read())
+        else:
+            sys.stdout.write(render_topo(len(load_state()['gpus'])))
+        return 0
+
+    kind = None
+    fields = []
+    loop_ms = None
+    args = iter(argv)
+    for arg in args:
+        if arg.startswith('--query-gpu='):
+            kind, fields = 'gpu', arg.split('=', 1)[1].split(',')
+        elif arg.startswith('--query-compute-apps='):
+            kind, fields = 'apps', arg.split('=', 1)[1].split(',')
+        elif arg in ('-lms', '--loop-ms'):
+            loop_ms = int(next(args))
+        elif arg.startswith('--loop-ms='):
+            loop_ms = int(arg.split('=', 1)[1])
+
+    if kind is None:
+        sys.stdout.write(render_table(load_state()))
+        return 0
+
+    exit_after = int(os.environ.get('FAKE_NVIDIA_SMI_EXIT_AFTER', '0'))
+    samples = 0
+    while True:
+        wait_while_hung()
+        sys.stdout.write(render_query(kind, fields, load_state()))
+        sys.stdout.flush()
+        samples += 1
+        if loop_ms is None or (exit_after and samples >= exit_after):
+            return 0
+        time.sleep(loop_ms / 1000)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
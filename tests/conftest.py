@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'fixtures')
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """在暫存目錄匯入 app，佇列、日誌等檔案都寫在那裡；以假的 nvidia-smi 取代真的驅動"""
+    os.chdir(tmp_path_factory.mktemp('app'))
+    os.environ.setdefault('NVIDIA_SMI_BIN', os.path.join(FIXTURES, 'fake_nvidia_smi.py'))
+    sys.path.insert(0, ROOT)
+    import app
+    return app
+
+
+def read_fixture(*parts):
+    with open(os.path.join(FIXTURES, *parts)) as f:
+        return f.read()
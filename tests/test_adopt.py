@@ -0,0 +1,40 @@
+"""重新啟動時接手上一次執行留下的任務"""
+import json
+
+
+class PagedIndex:
+    """只提供 adopt_running_tasks 需要的介面，依 limit 分頁回傳"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.limits = []
+
+    def reconcile(self):
+        pass
+
+    def query(self, limit=50, cursor=None, status=None):
+        self.limits.append(limit)
+        start = int(cursor or 0)
+        page = self.rows[start:start + limit]
+        next_cursor = str(start + limit) if start + limit < len(self.rows) else None
+        return page, next_cursor, len(self.rows)
+
+
+def test_adopt_pages_through_all_running_tasks(app_module, tmp_path, monkeypatch):
+    rows = []
+    for i in range(2500):
+        directory = f"20260101_000000_task_t{i}"
+        (tmp_path / directory).mkdir()
+        # 沒有 pid：主程序在啟動任務途中結束
+        (tmp_path / directory / 'status.json').write_text(json.dumps({'state': 'running'}))
+        rows.append({'directory': directory, 'task_uid': f"t{i}"})
+    index = PagedIndex(rows)
+    lost = []
+    monkeypatch.setattr(app_module, 'EXECUTION_LOG_DIR', str(tmp_path))
+    monkeypatch.setattr(app_module, 'execution_index', index)
+    monkeypatch.setattr(app_module, 'mark_task_lost',
+                        lambda task_uid, dir_name, status_file, reason: lost.append(task_uid))
+
+    app_module.adopt_running_tasks()
+    assert len(index.limits) == 3
+    assert lost == [f"t{i}" for i in range(2500)]
@@ -0,0 +1,74 @@
+"""聚合模式的單元測試：agent 設定解析、跨節點的 GPU 挑選與 GPU 編號檢查；實際啟動 agent 的測試在 test_cluster_agents.py"""
+import pytest
+
+from conftest import read_fixture
+
+
+@pytest.fixture
+def cluster(app_module, monkeypatch):
+    aggregator = app_module.ClusterAggregator(app_module.parse_cluster_agents('a=10.0.0.1:5000,b=10.0.0.2:5000'),
+                                              poll_interval=1, timeout=1)
+    for name, fixture in [('a', 'legacy_4gpu.txt'), ('b', 'pcie_dual_socket_8gpu.txt')]:
+        links = app_module.parse_nvidia_smi_topo(read_fixture('topo', fixture))
+        # agent 以 JSON 回報，鍵都是字串
+        aggregator.agents[name].topology = {str(a): {str(b): label for b, label in row.items()}
+                                            for a, row in links.items()}
+    monkeypatch.setattr(app_module, 'cluster', aggregator)
+    return aggregator
+
+
+def test_parse_cluster_agents(app_module):
+    agents = app_module.parse_cluster_agents('gpu1=http://10.0.0.1:5000, 10.0.0.2:5000')
+    assert [name for name, _ in agents] == ['gpu1', '10.0.0.2:5000']
+    assert agents[1][1].scheme == 'http'
+    with pytest.raises(ValueError):
+        app_module.parse_cluster_agents('a/b=10.0.0.1:5000')
+    with pytest.raises(ValueError):
+        app_module.parse_cluster_agents('ftp://10.0.0.1')
+
+
+def test_affinity_across_nodes(app_module, cluster):
+    assert app_module.gpu_affinity('b/0', 'b/1') == app_module.topology_link_score('NV4')
+    assert app_module.gpu_affinity('a/0', 'a/1') == app_module.topology_link_score('PIX')
+    assert app_module.gpu_affinity('a/0', 'b/0') == 0
+
+
+def test_earliest_free_gpu_set_prefers_better_node(app_module, cluster, monkeypatch):
+    busy = {'name': 'RTX 4090', 'mem_total': 24564, 'mem_used': 20000, 'mem_percent': 81.4, 'util': 90,
+            'in_use': True}
+    gpu_info = {f"{node}/{index}": dict(busy) for node, size in [('a', 4), ('b', 8)] for index in range(size)}
+    monkeypatch.setattr(app_module, 'gpu_info', gpu_info)
+    # 兩個節點同時空出兩張：a 的 0、1 在同一個 PCIe switch，b 的 0、4 跨 socket
+    free_at = {'a/0': 100.0, 'a/1': 100.0, 'b/0': 100.0, 'b/4': 100.0}
+    assert app_module.earliest_free_gpu_set({}, 2, free_at, 0.0) == ['a/0', 'a/1']
+    # b 空出 NVLink 相連的 0、1 時改選 b
+    free_at.update({'b/1': 100.0})
+    assert app_module.earliest_free_gpu_set({}, 2, free_at, 0.0) == ['b/0', 'b/1']
+    # 較早湊齊仍然優先於互連分數
+    free_at.update({'a/0': 50.0, 'a/2': 50.0})
+    assert app_module.earliest_free_gpu_set({}, 2, free_at, 0.0) == ['a/0', 'a/2']
+
+
+@pytest.mark.parametrize('required_gpu', ['0', '0,1', 'a/0, 3', '4070'])
+def test_bare_gpu_index_rejected(app_module, cluster, required_gpu):
+    fields, error = app_module.validate_command_fields({'command': 'python train.py', 'required_gpu': required_gpu},
+                                                       'alice')
+    assert fields is None
+    assert '節點/編號' in error
+
+
+@pytest.mark.parametrize('required_gpu', ['a/0', 'a/0,b/1', 'RTX 4070', 'count:2'])
+def test_node_gpu_accepted(app_module, cluster, required_gpu):
+    _, error = app_module.validate_command_fields({'command': 'python train.py', 'required_gpu': required_gpu},
+                                                  'alice')
+    assert error is None
+
+
+def test_metrics_history_node_gpu_filter(app_module, cluster, monkeypatch):
+    history = app_module.GpuHistory(app_module.GPU_HISTORY_TIERS)
+    monkeypatch.setattr(app_module, 'gpu_history', history)
+    gpu = {'name': 'RTX 4090', 'mem_total': 24564, 'mem_used': 1000, 'mem_percent': 4.1, 'util': 50, 'in_use': True}
+    history.record({'a/0': gpu, 'b/1': gpu}, [])
+    response = app_module.app.test_client().get('/api/metrics/history?gpu=b/1&since=-60')
+    assert response.status_code == 200
+    assert list(response.get_json()['gpus']) == ['b/1']
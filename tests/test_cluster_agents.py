@@ -0,0 +1,145 @@
+"""聚合模式的整合測試：在不同埠上啟動兩個使用假 nvidia-smi 的 agent 行程，由本行程聚合"""
+import http.server
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import pytest
+
+from conftest import FIXTURES, ROOT
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(predicate, timeout=20, interval=0.2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return False
+
+
+@pytest.fixture(scope='module')
+def agents(tmp_path_factory):
+    """兩個 agent，各有兩張閒置的 GPU；回傳 {名稱: (URL, Popen)}"""
+    state = {'gpus': [{'name': 'NVIDIA GeForce RTX 4090', 'mem_used': 0, 'mem_total': 24576, 'util': 0}] * 2,
+             'processes': []}
+    started = {}
+    for name in ('n1', 'n2'):
+        workdir = tmp_path_factory.mktemp(name)
+        state_file = workdir / 'state.json'
+        state_file.write_text(json.dumps(state))
+        port = free_port()
+        env = dict(os.environ, HOST='127.0.0.1', PORT=str(port), DEBUG='false', CLUSTER_ROLE='agent',
+                   NVIDIA_SMI_BIN=os.path.join(FIXTURES, 'fake_nvidia_smi.py'), FAKE_NVIDIA_SMI_STATE=str(state_file))
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'app.py')], cwd=workdir, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        started[name] = (f"http://127.0.0.1:{port}", process)
+    yield started
+    for _, process in started.values():
+        if process.poll() is None:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+
+@pytest.fixture
+def cluster(app_module, agents, monkeypatch):
+    spec = ','.join(f"{name}={url}" for name, (url, _) in agents.items())
+    aggregator = app_module.ClusterAggregator(app_module.parse_cluster_agents(spec), poll_interval=1, timeout=2)
+    monkeypatch.setattr(app_module, 'cluster', aggregator)
+    # 每個 agent 都要回報兩張 GPU 的快照才開始測試
+    assert wait_for(lambda: (aggregator.poll_all() or True)
+                    and all(agent.status == 'up' and len(agent.gpus) == 2 for agent in aggregator.agents.values()))
+    return aggregator
+
+
+def test_poll_merges_agents(app_module, cluster):
+    assert sorted(app_module.gpu_info) == ['n1/0', 'n1/1', 'n2/0', 'n2/1']
+    assert all(gpu['node'] == gpu_id.split('/')[0] for gpu_id, gpu in app_module.gpu_info.items())
+    # werkzeug 每個回應都關閉連線，這樣的連線不會留在閒置池中
+    agent = cluster.agents['n1']
+    for _ in range(3):
+        assert agent.request('GET', '/gpu_data')[0] == 200
+    assert agent._idle == []
+
+
+def test_agent_client_keep_alive(app_module):
+    """支援 keep-alive 的 agent（例如放在反向代理之後）只用一條連線"""
+    connections = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            connections.append(self.client_address)
+
+        def do_GET(self):
+            body = json.dumps({'success': True, 'path': self.path}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = urllib.parse.urlsplit(f"http://127.0.0.1:{server.server_address[1]}/prefix")
+        client = app_module.AgentClient('n', url, timeout=2)
+        for _ in range(3):
+            assert client.request('GET', '/gpu_data') == (200, {'success': True, 'path': '/prefix/gpu_data'})
+        assert len(connections) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_launch_dedup_and_fair_share(app_module, cluster):
+    task = {'uid': 'remote-1', 'command': 'sleep 1', 'required_gpu': 'n2/0', 'owner': 'alice', 'priority': 3,
+            'created_at': '2026-01-01T00:00:00'}
+    assert cluster.launch(task['command'], task['required_gpu'], task['uid'], ['n2/0'], task_info=task)
+    assert app_module.fair_share._running['remote-1'][:2] == ('alice', 1)
+
+    # 重送同一個 uid 不會再啟動一次
+    status, data = cluster.agents['n2'].request('POST', '/api/agent/launch', {
+        'uid': 'remote-1', 'command': 'sleep 1', 'gpu_ids': [0], 'owner': 'alice'})
+    assert status == 200 and data['duplicate']
+
+    # agent 把遠端任務記在轉送的擁有者名下
+    status, data = cluster.agents['n2'].request('GET', '/api/fair-share')
+    assert data['owners']['alice']['running_gpus'] == 1
+
+    # 結束後由 reconcile_running 記入擁有者的用量
+    def finished():
+        cluster.reconcile_running()
+        return 'remote-1' not in cluster._remote
+    assert wait_for(finished, timeout=15)
+    assert 'remote-1' not in app_module.fair_share._running
+    assert app_module.fair_share._decayed('alice', time.time()) > 0
+
+
+def test_node_down(app_module, cluster, agents):
+    _, process = agents['n1']
+    os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+    started = time.monotonic()
+    cluster.poll_all()
+    assert time.monotonic() - started < cluster.agents['n1'].timeout * 2 + 1
+    assert cluster.agents['n1'].status == 'down'
+    assert cluster.agents['n2'].status == 'up'
+    assert sorted(app_module.gpu_info) == ['n2/0', 'n2/1']
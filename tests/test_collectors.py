@@ -0,0 +1,86 @@
+"""收集引擎：探針逾時後強制結束子程序，上一次的子程序退出前不再啟動新的探針"""
+import asyncio
+import sys
+
+import pytest
+
+
+def run_engine(app_module, collect, interval, timeout, duration):
+    engine = app_module.CollectorEngine(jitter=0)
+    health = engine.periodic('probe', collect, interval, timeout)
+
+    async def main():
+        runner = asyncio.ensure_future(engine._runners[0]())
+        await asyncio.sleep(duration)
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        await asyncio.gather(*app_module.subprocess_reapers, return_exceptions=True)
+
+    asyncio.run(main())
+    return engine, health
+
+
+def test_backoff_doubles_and_caps(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'COLLECTOR_MAX_BACKOFF', 60)
+    engine = app_module.CollectorEngine(jitter=0)
+    health = app_module.CollectorHealth('probe')
+    assert engine.backoff(health, 5) == 5
+    for timeouts, expected in [(1, 10), (2, 20), (3, 40), (4, 60), (10, 60)]:
+        health.consecutive_timeouts = timeouts
+        assert engine.backoff(health, 5) == expected
+    # 間隔本身比上限長時不會縮短
+    assert engine.backoff(health, 300) == 300
+
+
+def test_timeout_counters_reset(app_module):
+    health = app_module.CollectorHealth('probe')
+    health.failure('timed out', timed_out=True)
+    health.failure('timed out', timed_out=True)
+    assert health.consecutive_timeouts == 2
+    health.failure('exit code 1')
+    assert health.consecutive_timeouts == 0
+    health.failure('timed out', timed_out=True)
+    health.success()
+    assert health.consecutive_timeouts == 0
+    assert health.timeouts == 3
+
+
+def test_hung_probe_is_killed_and_reaped(app_module):
+    processes = []
+
+    async def collect():
+        await app_module.run_subprocess([sys.executable, '-c', 'import time; time.sleep(60)'])
+
+    async def tracked():
+        task = asyncio.ensure_future(collect())
+        await asyncio.sleep(0.05)
+        processes.append(app_module.current_collector.get().process)
+        await task
+
+    _, health = run_engine(app_module, tracked, interval=0.01, timeout=0.3, duration=1.2)
+    assert health.timeouts >= 2
+    assert all(process.returncode is not None for process in processes)
+
+
+def test_no_new_probe_while_previous_alive(app_module):
+    class StuckProcess:
+        pid = 12345
+        returncode = None
+
+    calls = []
+
+    async def collect():
+        calls.append(1)
+        app_module.current_collector.get().process = StuckProcess()
+        await asyncio.sleep(1)
+
+    _, health = run_engine(app_module, collect, interval=0.01, timeout=0.05, duration=0.5)
+    assert len(calls) == 1
+    assert 'has not exited' in health.last_error
+    assert health.consecutive_timeouts >= 2
+
+
+def test_run_subprocess_outside_collector(app_module):
+    assert asyncio.run(app_module.run_subprocess([sys.executable, '-c', 'print("ok")'])) == 'ok\n'
+    with pytest.raises(RuntimeError, match='boom'):
+        asyncio.run(app_module.run_subprocess([sys.executable, '-c', 'import sys; sys.exit("boom")']))
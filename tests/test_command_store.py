@@ -0,0 +1,225 @@
+"""指令佇列：日誌重播與壓縮、手動排序、優先權、依賴的放行與連鎖取消，以及排程器喚醒"""
+import json
+
+import pytest
+
+
+@pytest.fixture
+def make_store(app_module, tmp_path):
+    def make(compact_threshold=1000):
+        return app_module.CommandStore(str(tmp_path / 'gpu_commands.json'), str(tmp_path / 'gpu_commands.journal'),
+                                       compact_threshold)
+    return make
+
+
+def command(uid, **fields):
+    return dict({'uid': uid, 'command': f"echo {uid}", 'required_gpu': 'any', 'owner': 'alice'}, **fields)
+
+
+@pytest.fixture
+def wakeups(app_module, make_store, monkeypatch):
+    reasons = []
+    monkeypatch.setattr(app_module, 'request_schedule', reasons.append)
+    store = make_store()
+    store.add_listener(app_module.on_command_queue_change)
+    return store, reasons
+
+
+def test_wakes_scheduler_on_add(wakeups):
+    store, reasons = wakeups
+    store.add(command('a'))
+    assert reasons == ['queue add']
+
+
+def test_wakes_scheduler_on_move(wakeups):
+    store, reasons = wakeups
+    store.add_many([command('a'), command('b')])
+    reasons.clear()
+    assert store.move('b', 1)
+    assert reasons == ['queue update']
+
+
+def test_wakes_scheduler_on_priority(wakeups):
+    store, reasons = wakeups
+    store.add(command('a'))
+    reasons.clear()
+    assert store.update('a', {'priority': 5})
+    assert reasons == ['queue update']
+
+
+def test_wakes_scheduler_on_delete_and_cancel(wakeups):
+    store, reasons = wakeups
+    store.add_many([command('a'), command('b'), command('c', waiting_on=['b'], depends_condition='any')])
+    reasons.clear()
+    assert store.delete('a')
+    assert store.cancel('b') == []
+    assert reasons == ['queue delete', 'queue delete']
+    # depends_condition='any' 的下游在上游取消後放行
+    assert store.waiting_count() == 0
+
+
+def uids(store):
+    return [cmd['uid'] for cmd in store.list()]
+
+
+def test_journal_replay(make_store):
+    store = make_store()
+    store.add_many([command('a'), command('b'), command('c')])
+    store.delete('b')
+    store.update('c', {'priority': 10})
+    store.add(command('d'))
+    expected = store.list()
+    assert uids(store) == ['c', 'a', 'd']
+
+    reloaded = make_store()
+    assert reloaded.list() == expected
+
+
+def test_corrupt_journal_tail_is_skipped(make_store, tmp_path):
+    store = make_store()
+    store.add_many([command('a'), command('b')])
+    store._journal.close()
+    with open(tmp_path / 'gpu_commands.journal', 'a', encoding='utf-8') as f:
+        f.write('{"op": "delete", "uid": "a"')  # 當機時只寫了一半
+    reloaded = make_store()
+    assert uids(reloaded) == ['a', 'b']
+    # 重播後已壓縮成快照並清空日誌
+    assert not (tmp_path / 'gpu_commands.journal').exists()
+    assert [cmd['uid'] for cmd in json.loads((tmp_path / 'gpu_commands.json').read_text())] == ['a', 'b']
+
+
+def test_corrupt_snapshot_is_set_aside(make_store, tmp_path):
+    (tmp_path / 'gpu_commands.json').write_text('[{"uid": ')
+    store = make_store()
+    assert len(store) == 0
+    assert [p.name for p in tmp_path.iterdir() if p.name.startswith('gpu_commands.json.corrupt-')]
+
+
+def test_failed_journal_write_leaves_queue_unchanged(make_store, monkeypatch):
+    store = make_store()
+    store.add(command('a'))
+    version = store.version
+
+    def fail(entry):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(store, '_append', fail)
+    assert not store.add(command('b'))
+    assert not store.update('a', {'priority': 3})
+    assert uids(store) == ['a'] and store.get('a')['priority'] == 0
+    assert store.version == version
+
+
+def test_compaction(make_store, tmp_path):
+    store = make_store(compact_threshold=3)
+    store.add(command('a'))
+    store.add(command('b'))
+    assert (tmp_path / 'gpu_commands.journal').exists()
+    store.move('b', 1)
+    assert not (tmp_path / 'gpu_commands.journal').exists()
+    store.add(command('c'))
+    assert uids(make_store()) == ['b', 'a', 'c']
+
+
+def test_legacy_move_op_replay(make_store, tmp_path):
+    store = make_store()
+    store.add_many([command('a'), command('b'), command('c')])
+    store._journal.close()
+    with open(tmp_path / 'gpu_commands.journal', 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'op': 'move', 'uid': 'c', 'order': 1}) + '\n')
+    reloaded = make_store()
+    assert uids(reloaded) == ['c', 'a', 'b']
+    assert reloaded.get('c')['sort_key'] and reloaded.get('c')['priority'] == 0
+
+
+@pytest.mark.parametrize('load', [4, 256])
+def test_move_keeps_display_order(app_module, make_store, monkeypatch, load):
+    # LOAD 很小時區塊會分裂與合併，順序統計仍要正確
+    monkeypatch.setattr(app_module.SortedKeyList, 'LOAD', load)
+    store = make_store()
+    expected = [f"c{i:02d}" for i in range(40)]
+    store.add_many([command(uid) for uid in expected])
+    for uid, order in [('c39', 1), ('c00', 40), ('c20', 5), ('c05', 6), ('c10', 2), ('c01', 100), ('c30', 0)]:
+        assert store.move(uid, order)
+        expected.remove(uid)
+        expected.insert(max(0, min(order - 1, len(expected))), uid)
+        assert uids(store) == expected
+        assert [cmd['order'] for cmd in store.list()] == list(range(1, 41))
+        assert store.get(uid)['order'] == expected.index(uid) + 1
+    # 只有被移動的指令記錄 sort_key，其他指令不變
+    assert not store.get('c02').get('sort_key')
+    assert uids(make_store()) == expected
+
+
+def test_same_score_move_uses_tie_break(make_store):
+    store = make_store()
+    store.add_many([command('a'), command('b'), command('c')])
+    store.move('c', 1)
+    store.move('b', 1)  # 移到 c 之前：前面沒有指令
+    store.move('a', 2)  # 夾在 b 與 c 之間，兩者的分數可能相同
+    assert uids(store) == ['b', 'a', 'c']
+
+
+def test_priority_resets_manual_position(make_store):
+    store = make_store()
+    store.add_many([command('a'), command('b'), command('c')])
+    store.move('c', 1)
+    assert uids(store) == ['c', 'a', 'b']
+    store.update('c', {'priority': 0})
+    assert 'sort_key' not in store.get('c')
+    assert uids(store) == ['a', 'b', 'c']
+    store.update('b', {'priority': 5})
+    assert uids(store) == ['b', 'a', 'c']
+
+
+def test_owner_heaps_skip_stale_entries(make_store):
+    store = make_store()
+    store.add_many([command('a'), command('b', owner='bob'), command('c')])
+    store.update('c', {'priority': 5})
+    store.delete('a')
+    queues = store.owner_queues()
+    live = {owner: [uid for key, uid in sorted(heap) if store.current(uid, key)] for owner, heap in queues.items()}
+    assert live == {'alice': ['c'], 'bob': ['b']}
+
+
+def test_dependencies_wait_until_upstream_finishes(make_store):
+    store = make_store()
+    store.add_many([command('a'), command('b', waiting_on=['a'])])
+    assert store.waiting_count() == 1
+    assert store.awaited() == ['a']
+    assert 'b' not in [uid for heap in store.owner_queues().values() for _, uid in heap]
+    assert store.finish('a', True) == []
+    assert store.waiting_count() == 0
+    assert 'waiting_on' not in store.get('b')
+    assert 'b' in [uid for heap in store.owner_queues().values() for _, uid in heap]
+    # 沒有指令等待的上游不寫日誌
+    version = store.version
+    assert store.finish('a', True) == []
+    assert store.version == version
+
+
+def test_cancel_cascades_through_dependents(make_store):
+    store = make_store()
+    store.add_many([
+        command('a'),
+        command('b', waiting_on=['a']),
+        command('c', waiting_on=['b']),
+        command('d', waiting_on=['a'], depends_condition='any'),
+        command('e', waiting_on=['c', 'd'], depends_condition='any'),
+    ])
+    cancelled = store.cancel('a')
+    assert sorted(cancelled) == [('b', 'a'), ('c', 'b')]
+    assert uids(store) == ['d', 'e']
+    # d 已放行；e 不再等 c，但 d 還沒執行
+    assert 'waiting_on' not in store.get('d')
+    assert store.get('e')['waiting_on'] == ['d']
+    # 重啟後重播出相同的結果
+    assert uids(make_store()) == ['d', 'e']
+
+
+def test_failed_upstream_cancels_success_dependents(make_store):
+    store = make_store()
+    store.add_many([command('b', waiting_on=['a']), command('c', waiting_on=['a'], depends_condition='any')])
+    assert store.finish('a', False) == [('b', 'a')]
+    assert uids(store) == ['c']
+    assert store.cancel('missing') is None
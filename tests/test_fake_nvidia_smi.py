@@ -0,0 +1,44 @@
+"""假的 nvidia-smi 的輸出要能被兩種收集模式解析"""
+import os
+import subprocess
+import sys
+
+from conftest import FIXTURES, read_fixture
+
+FAKE_NVIDIA_SMI = os.path.join(FIXTURES, 'fake_nvidia_smi.py')
+
+
+def run_fake(*args, **env):
+    result = subprocess.run([sys.executable, FAKE_NVIDIA_SMI, *args], capture_output=True, text=True, timeout=10,
+                            env={**os.environ, **env})
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def test_table_output(app_module):
+    gpu_info, processes = app_module.parse_nvidia_smi_table(run_fake(FAKE_NVIDIA_SMI_GPUS='4'))
+    assert sorted(gpu_info) == [0, 1, 2, 3]
+    assert all(gpu['mem_total'] > 0 for gpu in gpu_info.values())
+    assert all(gpu_info[process['gpu']]['in_use'] for process in processes)
+
+
+def test_query_output(app_module):
+    gpu_rows = run_fake('--query-gpu=' + ','.join(app_module.NVIDIA_SMI_GPU_FIELDS), '--format=csv,noheader,nounits',
+                        FAKE_NVIDIA_SMI_GPUS='4').splitlines()
+    gpus = [app_module.parse_gpu_query_row(row) for row in gpu_rows]
+    assert [gpu_id for _, gpu_id, _ in gpus] == [0, 1, 2, 3]
+    uuids = {gpu_uuid for gpu_uuid, _, _ in gpus}
+    app_rows = run_fake('--query-compute-apps=' + ','.join(app_module.NVIDIA_SMI_APP_FIELDS),
+                        '--format=csv,noheader,nounits', FAKE_NVIDIA_SMI_GPUS='4').splitlines()
+    for row in app_rows:
+        gpu_uuid, process = app_module.parse_compute_app_row(row)
+        assert gpu_uuid in uuids
+        assert process['pid'] > 0
+
+
+def test_topo_output(app_module):
+    links = app_module.parse_nvidia_smi_topo(run_fake('topo', '-m', FAKE_NVIDIA_SMI_GPUS='4'))
+    assert sorted(links) == [0, 1, 2, 3]
+    assert links[0][1].startswith('NV')
+    fixture = os.path.join(FIXTURES, 'topo', 'legacy_4gpu.txt')
+    assert run_fake('topo', '-m', FAKE_NVIDIA_SMI_TOPO=fixture) == read_fixture('topo', 'legacy_4gpu.txt')
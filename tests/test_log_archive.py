@@ -0,0 +1,71 @@
+"""分塊 gzip 記錄：壓縮、依未壓縮座標讀取，以及索引遺失時的重建"""
+import gzip
+import os
+
+import pytest
+
+
+def make_log(tmp_path, data):
+    path = tmp_path / 'output.log'
+    path.write_bytes(data)
+    return str(path)
+
+
+LOG = b''.join(f"step {i} loss {1 / (i + 1):.6f}\n".encode() for i in range(20000))
+
+
+def test_compress_and_read(app_module, tmp_path):
+    path = make_log(tmp_path, LOG)
+    assert app_module.compress_log(path, block_size=64 * 1024)
+    assert not os.path.exists(path)
+    with app_module.open_log(path) as reader:
+        assert reader.compressed and reader.size == len(LOG)
+        assert len(reader.archive_offsets) > 2
+        reader.seek(100000)
+        assert reader.read(5000) == LOG[100000:105000]
+        reader.seek(0)
+        assert reader.read() == LOG
+
+
+@pytest.mark.parametrize('scan_chunk', [1024, 1024 * 1024])
+def test_missing_index_is_rebuilt_and_saved(app_module, tmp_path, monkeypatch, scan_chunk):
+    path = make_log(tmp_path, LOG)
+    assert app_module.compress_log(path, block_size=64 * 1024)
+    index_path = path + app_module.LOG_ARCHIVE_INDEX_SUFFIX
+    with open(index_path, 'rb') as f:
+        original_index = f.read()
+    os.remove(index_path)
+
+    # 掃描的讀取塊比 member 小或大都要找到相同的邊界
+    monkeypatch.setattr(app_module, 'LOG_ARCHIVE_BLOCK', scan_chunk)
+    with app_module.open_log(path) as reader:
+        reader.seek(300000)
+        assert reader.read(1000) == LOG[300000:301000]
+    with open(index_path, 'rb') as f:
+        assert f.read() == original_index
+    assert not [name for name in os.listdir(tmp_path) if '.tmp' in name]
+
+
+def test_plain_gzip_member(app_module, tmp_path, monkeypatch):
+    # 一般 gzip 的單一 member，壓縮比很高：掃描時每次只展開一個讀取塊
+    data = b'\0' * (8 * 1024 * 1024) + LOG
+    archive = tmp_path / 'output.log.gz'
+    archive.write_bytes(gzip.compress(data))
+    monkeypatch.setattr(app_module, 'LOG_ARCHIVE_BLOCK', 64 * 1024)
+    with app_module.open_log(str(tmp_path / 'output.log')) as reader:
+        assert reader.size == len(data)
+        assert list(reader.archive_offsets) == [0, archive.stat().st_size]
+        reader.seek(len(data) - 100)
+        assert reader.read() == data[-100:]
+
+
+def test_corrupt_index_is_replaced(app_module, tmp_path):
+    path = make_log(tmp_path, LOG)
+    assert app_module.compress_log(path, block_size=64 * 1024)
+    index_path = path + app_module.LOG_ARCHIVE_INDEX_SUFFIX
+    with open(index_path, 'r+b') as f:
+        f.truncate(20)
+    with app_module.open_log(path) as reader:
+        assert reader.read() == LOG
+    with app_module.open_log(path) as reader:
+        assert list(reader.raw_offsets) == list(reader._load_index()[0])
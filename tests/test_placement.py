@@ -0,0 +1,91 @@
+"""GPU 拓撲解析與多卡任務的 GPU 挑選"""
+import pytest
+
+from conftest import read_fixture
+
+
+@pytest.fixture
+def pcie_topology(app_module):
+    app_module.gpu_topology.load(read_fixture('topo', 'pcie_dual_socket_8gpu.txt'))
+    yield app_module
+    app_module.gpu_topology._links = None
+
+
+def test_parse_dgx_all_nvlink(app_module):
+    links = app_module.parse_nvidia_smi_topo(read_fixture('topo', 'dgx_a100_8gpu.txt'))
+    assert sorted(links) == list(range(8))
+    assert links[0] == {gpu_id: 'NV12' for gpu_id in range(1, 8)}
+
+
+def test_parse_pcie_dual_socket(app_module):
+    links = app_module.parse_nvidia_smi_topo(read_fixture('topo', 'pcie_dual_socket_8gpu.txt'))
+    assert sorted(links) == list(range(8))
+    assert links[0][1] == links[1][0] == 'NV4'
+    for a, b in [(2, 3), (4, 5), (6, 7)]:
+        assert links[a][b] == links[b][a] == 'PIX'
+    assert links[0][2] == 'NODE'
+    assert links[5][7] == 'NODE'
+    assert links[0][4] == links[7][3] == 'SYS'
+
+
+def test_parse_legacy_space_aligned(app_module):
+    links = app_module.parse_nvidia_smi_topo(read_fixture('topo', 'legacy_4gpu.txt'))
+    assert sorted(links) == list(range(4))
+    assert links[0][1] == 'PIX'
+    assert links[2][3] == 'PXB'
+    assert links[0][2] == links[1][3] == 'PHB'
+
+
+def test_parse_without_gpu_rows(app_module):
+    assert app_module.parse_nvidia_smi_topo('') == {}
+    with pytest.raises(ValueError):
+        app_module.gpu_topology.load('no topology here')
+
+
+@pytest.mark.parametrize('gpu_ids, count, expected', [
+    (list(range(8)), 2, [0, 1]),
+    (list(range(8)), 4, [0, 1, 2, 3]),
+    (list(range(8)), 8, list(range(8))),
+    (list(range(1, 8)), 2, [2, 3]),
+    (list(range(1, 8)), 3, [1, 2, 3]),
+    ([0, 1, 4, 5, 6, 7], 2, [0, 1]),
+    ([1, 4, 5, 6, 7], 2, [4, 5]),
+])
+def test_best_gpu_set(pcie_topology, gpu_ids, count, expected):
+    assert pcie_topology.best_gpu_set(gpu_ids, count)[1] == expected
+
+
+def test_best_gpu_set_prefers_worst_link(pcie_topology):
+    # 0-1 的 NVLink 總分較高，但加上跨 socket 的 4 會讓最差連線變成 SYS
+    (worst, _), chosen = pcie_topology.best_gpu_set([0, 1, 4, 6, 7], 3)
+    assert chosen == [4, 6, 7]
+    assert worst == pcie_topology.topology_link_score('NODE')
+
+
+def test_earliest_free_gpu_set_uses_topology(pcie_topology, monkeypatch):
+    busy = {'name': 'RTX 4090', 'mem_total': 24564, 'mem_used': 20000, 'mem_percent': 81.4, 'util': 90,
+            'in_use': True}
+    gpu_info = {gpu_id: dict(busy) for gpu_id in range(8)}
+    monkeypatch.setattr(pcie_topology, 'gpu_info', gpu_info)
+    # 1、2、3、5 同時空出：挑同一個 PCIe switch 的 2、3，而不是編號最小的 1、2
+    free_at = {1: 100.0, 2: 100.0, 3: 100.0, 5: 100.0, 0: 500.0}
+    assert pcie_topology.earliest_free_gpu_set({}, 2, free_at, 0.0) == [2, 3]
+    # 0 先空出也要等湊齊兩張，屆時 0、1 的 NVLink 最好
+    free_at = {0: 50.0, 1: 200.0, 2: 200.0, 3: 200.0}
+    assert pcie_topology.earliest_free_gpu_set({}, 2, free_at, 0.0) == [0, 1]
+
+
+@pytest.mark.parametrize('required_gpu', ['count:0', 'count:-1', 'count:a', 'count:', 'count:1.5'])
+def test_invalid_gpu_count(app_module, required_gpu):
+    fields, error = app_module.validate_command_fields({'command': 'python train.py', 'required_gpu': required_gpu},
+                                                       'alice')
+    assert fields is None
+    assert error == 'GPU 數量必須是大於0的整數，例如 count:2'
+
+
+@pytest.mark.parametrize('required_gpu, count', [('count:2', 2), ('COUNT:4', 4), (' count:1 ', 1)])
+def test_valid_gpu_count(app_module, required_gpu, count):
+    fields, error = app_module.validate_command_fields({'command': 'python train.py', 'required_gpu': required_gpu},
+                                                       'alice')
+    assert error is None
+    assert app_module.parse_gpu_count(required_gpu.strip()) == count
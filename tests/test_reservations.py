@@ -0,0 +1,46 @@
+"""GPU 預約：任務的程序出現在 nvidia-smi 之前保留 GPU（或宣告的記憶體）"""
+import pytest
+
+
+@pytest.fixture
+def ledger(app_module):
+    return app_module.GpuReservationLedger(grace_period=60)
+
+
+def task_process(gpu, task, mib):
+    return {'gpu': gpu, 'pid': 1000, 'type': 'C', 'name': 'python', 'mem': f"{mib}MiB", 'task': task}
+
+
+def test_exclusive_released_when_process_appears(app_module, ledger):
+    ledger.reserve('t', [0, 1])
+    seq = app_module.gpu_snapshot_seq
+    ledger.reconcile([task_process(0, 't', 300), task_process(1, 't', 300)], seq + 1)
+    assert len(ledger) == 1  # 預約當下的快照之後至少要再隔一個快照
+    ledger.reconcile([task_process(0, 't', 300)], seq + 2)
+    assert ledger.is_reserved(1)
+    ledger.reconcile([task_process(0, 't', 300), task_process(1, 't', 300)], seq + 3)
+    assert len(ledger) == 0
+
+
+def test_shared_holds_remaining_memory(app_module, ledger):
+    ledger.reserve('t', [0], memory=8000)
+    seq = app_module.gpu_snapshot_seq
+    assert ledger.reserved_memory(0) == 8000
+    # 只建立了 CUDA context：已用掉的 400 MiB 算在 mem_used 裡，其餘仍保留
+    ledger.reconcile([task_process(0, 't', 400)], seq + 2)
+    assert ledger.reserved_memory(0) == 7600
+    # 其他任務的程序不影響這筆預約
+    ledger.reconcile([task_process(0, 't', 400), task_process(0, 'other', 6000)], seq + 3)
+    assert ledger.reserved_memory(0) == 7600
+    ledger.reconcile([task_process(0, 't', 8000)], seq + 4)
+    assert len(ledger) == 0
+    assert ledger.reserved_memory(0) == 0
+
+
+def test_shared_released_after_grace(app_module, ledger, monkeypatch):
+    ledger.reserve('t', [0], memory=8000)
+    seq = app_module.gpu_snapshot_seq
+    started = app_module.time.monotonic()
+    monkeypatch.setattr(app_module.time, 'monotonic', lambda: started + 61)
+    ledger.reconcile([task_process(0, 't', 400)], seq + 2)
+    assert len(ledger) == 0
@@ -0,0 +1,30 @@
+"""任務監管器：任務結束時記錄結束碼並通知排程器"""
+import json
+import threading
+
+
+def test_reaper_survives_exit_hook_error(app_module, tmp_path, monkeypatch):
+    exited = []
+    done = threading.Event()
+
+    def on_task_exit(task_uid, execution_dir_name):
+        exited.append(task_uid)
+        if task_uid == 'first':
+            raise RuntimeError('boom')
+        done.set()
+
+    monkeypatch.setattr(app_module, 'on_task_exit', on_task_exit)
+    supervisor = app_module.TaskSupervisor()
+    for task_uid, command in [('first', 'exit 3'), ('second', 'sleep 0.3')]:
+        workdir = tmp_path / task_uid
+        workdir.mkdir()
+        supervisor.launch(task_uid, ['/bin/sh', '-c', command], cwd=str(workdir), env=None,
+                          output_path=str(workdir / 'nohup.out'), status_file=str(workdir / 'status.json'),
+                          status_data={})
+
+    # 第一個任務的收尾拋出例外後，收割執行緒仍要處理第二個任務
+    assert done.wait(10)
+    assert exited == ['first', 'second']
+    assert supervisor.running_count() == 0
+    status = json.loads((tmp_path / 'first' / 'status.json').read_text())
+    assert status['state'] == 'exited' and status['exit_code'] == 3